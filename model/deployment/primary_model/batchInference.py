@@ -0,0 +1,144 @@
+import asyncio
+
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent single-row predictions into one batched forward pass.
+
+    Requests are queued as they arrive. The worker task takes the first waiting request, keeps
+    collecting until either max_batch_size rows are queued or max_wait_ms has passed, then runs
+    predict_fn once on the stacked rows and hands each caller its own action back.
+
+    predict_fn takes (states (n, 8) float32, user_features (n, 3) float32, game_types (n,) int64)
+    numpy arrays and returns an array of n actions. If any request of a batch gave a user id, the batch's
+    ids (None for the others) are passed as a fourth argument.
+
+    With an executor (see inferenceExecutor) batches are stacked and predicted on its threads, at most
+    executor.workers batches at a time, while the next one is collected. Without one they run on the loop.
+
+    If a batch fails, its rows are predicted again one at a time, so a bad row only fails its own request.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=64, max_wait_ms=2.0, executor=None):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self._queue = None
+        self._task = None
+        self._slots = None
+        self._running = set()
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max(getattr(self.executor, "workers", 1), 1))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+        # Anything still queued will never be served
+        leftover = []
+        while not self._queue.empty():
+            leftover.append(self._queue.get_nowait())
+        self._fail(leftover, RuntimeError("Micro-batcher stopped"))
+
+    async def submit(self, state, user_features, game_type, user_id=None):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((state, user_features, game_type, user_id, future))
+        return await future
+
+    async def _collect(self, batch):
+        loop = asyncio.get_running_loop()
+        batch.append(await self._queue.get())
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    @staticmethod
+    def _fail(batch, err):
+        for *_, future in batch:
+            if not future.done():
+                future.set_exception(err)
+
+    def _predict(self, batch):
+        states = np.array([b[0] for b in batch], dtype=np.float32)
+        user_features = np.array([b[1] for b in batch], dtype=np.float32)
+        game_types = np.array([b[2] for b in batch], dtype=np.int64)
+        user_ids = [b[3] for b in batch]
+        if any(u is not None for u in user_ids):
+            return self.predict_fn(states, user_features, game_types, user_ids)
+        return self.predict_fn(states, user_features, game_types)
+
+    def _predict_each(self, batch):
+        results = []
+        for row in batch:
+            try:
+                results.append(self._predict([row])[0])
+            except Exception as err:
+                results.append(err)
+        return results
+
+    async def _call(self, fn, batch):
+        if self.executor is None:
+            return fn(batch)
+        return await self.executor.run(fn, batch)
+
+    async def _dispatch(self, batch):
+        try:
+            try:
+                actions = await self._call(self._predict, batch)
+            except Exception:
+                if len(batch) == 1:
+                    raise
+                actions = await self._call(self._predict_each, batch)
+        except Exception as err:
+            self._fail(batch, err)
+            return
+        finally:
+            self._slots.release()
+
+        for (*_, future), action in zip(batch, actions):
+            if future.done():  # caller may have gone away
+                continue
+            if isinstance(action, Exception):
+                future.set_exception(action)
+            else:
+                future.set_result(int(action))
+
+    async def _run(self):
+        while True:
+            batch = []
+            await self._slots.acquire()
+            try:
+                await self._collect(batch)
+            except asyncio.CancelledError:
+                self._slots.release()
+                self._fail(batch, RuntimeError("Micro-batcher stopped"))
+                raise
+            if self.executor is None:
+                await self._dispatch(batch)
+                continue
+            task = asyncio.create_task(self._dispatch(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
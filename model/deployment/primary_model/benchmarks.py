@@ -0,0 +1,1255 @@
+"""
+Micro-benchmarks for the deployment service.
+
+Run from this directory, e.g.:
+    python benchmarks.py micro_batching --requests 5000 --concurrency 64
+"""
+import argparse
+import asyncio
+import base64
+import http.client
+import io
+import json
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import weakref
+
+import numpy as np
+import pandas as pd
+import torch
+from botocore.exceptions import EndpointConnectionError
+import torch.nn as nn
+
+import copy
+
+import customModel
+import dynamoFunctions
+from customModel import UserEmbeddingModel, QNetworkWithUserEmbedding, predict_actions, compile_policy, FusedPolicy, TorchPolicy
+from batchInference import MicroBatcher
+from inferenceExecutor import InferenceExecutor
+from numpyPolicy import NumpyPolicy, export_weight_bundle, save_weight_bundle
+from modelCache import ModelCache
+from localStores import LocalObjectStore, LocalDynamoTable, synthetic_state_items
+from modelRegistry import ModelRegistry
+from transitionStore import IncrementalTransitionBuilder
+from replayBuffer import ReplayBuffer
+from prioritizedReplay import SumTree, PrioritizedReplay
+from weightBuffers import DoubleBufferedWeights
+from targetSync import TargetSync
+from checkpointer import Checkpointer
+from embeddingCache import EmbeddingCache, EmbeddingCachedPolicy
+from predictionCache import PredictionCache, PredictionCachedPolicy
+from metrics import MetricsRegistry, MetricsMiddleware, render
+
+
+def build_models(seed=0):
+    # Same shapes as the deployed model, random weights
+    torch.manual_seed(seed)
+    model = QNetworkWithUserEmbedding(num_game_types=3, num_state_variables=8, num_actions=3)
+    model.game_embedding = nn.Embedding(5, 1)
+    embedder = UserEmbeddingModel(3, 4)
+    return model, embedder
+
+
+def random_rows(n, seed=0):
+    rng = np.random.default_rng(seed)
+    states = rng.random((n, 8), dtype=np.float32)
+    user_features = rng.random((n, 3), dtype=np.float32)
+    game_types = rng.integers(0, 5, size=n, dtype=np.int64)
+    return states, user_features, game_types
+
+
+def latency_summary(latencies_s, wall_s):
+    lat_ms = np.asarray(latencies_s) * 1000
+    return {
+        "requests": len(lat_ms),
+        "throughput_rps": round(len(lat_ms) / wall_s, 1),
+        "p50_ms": round(float(np.percentile(lat_ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(lat_ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(lat_ms, 99)), 4),
+        "p999_ms": round(float(np.percentile(lat_ms, 99.9)), 4),
+    }
+
+
+def bench_micro_batching(requests=5000, concurrency=64, max_batch_size=64, max_wait_ms=2.0):
+    """
+    Compares the per-request path of /predict against the micro-batcher under concurrent load.
+    """
+    model, embedder = build_models()
+    states, user_features, game_types = random_rows(requests)
+
+    def predict_rows(s, u, g):
+        return predict_actions(model, embedder, torch.from_numpy(s), torch.from_numpy(u), torch.from_numpy(g)).numpy()
+
+    async def direct(i):
+        return int(predict_rows(states[i:i + 1], user_features[i:i + 1], game_types[i:i + 1])[0])
+
+    async def drive(call):
+        latencies = []
+        next_index = iter(range(requests))
+
+        async def client():
+            for i in next_index:
+                start = time.perf_counter()
+                await call(i)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return latency_summary(latencies, time.perf_counter() - start)
+
+    async def run():
+        results = {"direct": await drive(direct)}
+        batcher = MicroBatcher(predict_rows, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        await batcher.start()
+
+        async def batched(i):
+            return await batcher.submit(states[i].tolist(), user_features[i].tolist(), int(game_types[i]))
+
+        results["micro_batched"] = await drive(batched)
+        await batcher.stop()
+        return results
+
+    return asyncio.run(run())
+
+
+def setup_api(table=None):
+    """
+    Points the /mod sub-application's module state at random models (and optionally a stand-in table),
+    without running its lifespan, so its functions can be benchmarked directly.
+    """
+    import src.pickl_fastapi as api
+
+    model, embedder = build_models()
+    api.embedding_caches = weakref.WeakKeyDictionary()
+    api.registry = ModelRegistry(api.build_policy)
+    api.registry.publish("benchmark", model, copy.deepcopy(model), embedder)
+    api.criterion = nn.MSELoss()
+    api.ushx_table = table
+    api.transition_builder = fresh_transition_builder()
+    api.training_weights = DoubleBufferedWeights(make_optimizer=lambda params: torch.optim.Adam(params, lr=0.0035))
+    api.target_sync = TargetSync("hard")
+    api.checkpointer = None
+    return api
+
+
+def fresh_transition_builder(capacity=1_000_000, embedding_dim=3):
+    # Empty replay buffer and ingestion state in a temporary directory, as the app sets them up: raw user features
+    # by default, embedding_dim 4 for ingesting with an embedder
+    root = tempfile.mkdtemp(prefix="transitions-")
+    return IncrementalTransitionBuilder(os.path.join(root, "ingest"), ReplayBuffer(os.path.join(root, "replay"),
+                                                                                   capacity=capacity,
+                                                                                   embedding_dim=embedding_dim))
+
+
+def bench_predict_batch(batch_sizes=(1, 64, 1024, 8192), repeats=5):
+    """
+    Per-item cost of /predict_batch (columnar and packed) against looping the /predict validation + forward path.
+    Request bodies are parsed from JSON so validation cost is included.
+    """
+    api = setup_api()
+    results = {}
+    for n in batch_sizes:
+        states, user_features, game_types = random_rows(n, seed=n)
+        singles = [json.dumps({"states": s.tolist(), "user_features": u.tolist(), "game_type": int(g)})
+                   for s, u, g in zip(states, user_features, game_types)]
+        columnar = json.dumps({"states": states.tolist(), "user_features": user_features.tolist(),
+                               "game_type": game_types.tolist()})
+        rows = np.hstack([states, user_features, game_types[:, None].astype(np.float32)]).astype("<f4")
+        packed = json.dumps({"packed": base64.b64encode(rows.tobytes()).decode()})
+
+        def loop():
+            out = []
+            for body in singles:
+                req = api.state_vars.model_validate_json(body)
+                out.append(int(api.predict_rows(np.array([req.states], dtype=np.float32),
+                                                np.array([req.user_features], dtype=np.float32),
+                                                np.array([req.game_type], dtype=np.int64))[0]))
+            return out
+
+        def batch(body):
+            def run():
+                return api.predict_rows(*api.batch_state_vars.model_validate_json(body).arrays).tolist()
+            return run
+
+        row = {}
+        expected = loop()
+        for name, fn in (("loop_predict", loop), ("columnar", batch(columnar)), ("packed", batch(packed))):
+            assert fn() == expected, f"{name} predictions differ from looping /predict"
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                fn()
+                timings.append(time.perf_counter() - start)
+            row[f"{name}_us_per_item"] = round(min(timings) / n * 1e6, 3)
+        results[n] = row
+    return results
+
+
+def time_per_call(fn, args, iterations, warmup=50):
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(*args)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn(*args)
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_compiled(batch_sizes=(1, 64, 1024), iterations=2000):
+    """
+    Latency of the eager embedder + Q-network against the traced, frozen graph on CPU.
+    """
+    model, embedder = build_models()
+    eager = FusedPolicy(model, embedder).eval()
+    start = time.perf_counter()
+    compiled = compile_policy(model, embedder)
+    results = {"compile_ms": round((time.perf_counter() - start) * 1000, 1)}
+    for n in batch_sizes:
+        args = tuple(torch.from_numpy(a) for a in random_rows(n, seed=n))
+        assert torch.equal(eager(*args), compiled(*args))
+        results[n] = {
+            "eager_us": round(time_per_call(eager, args, iterations) * 1e6, 2),
+            "compiled_us": round(time_per_call(compiled, args, iterations) * 1e6, 2),
+        }
+    return results
+
+
+def bench_numpy_backend(batch_sizes=(1, 64, 1024), iterations=2000, check_rows=100_000):
+    """
+    Startup time and latency of the numpy backend against eager PyTorch, and argmax agreement between them.
+    Startup is measured in a fresh interpreter: imports plus loading the weights.
+    """
+    model, embedder = build_models()
+    eager = FusedPolicy(model, embedder).eval()
+    policy = NumpyPolicy(export_weight_bundle(model.state_dict(), embedder.state_dict()))
+
+    states, user_features, game_types = random_rows(check_rows)
+    expected = eager(*(torch.from_numpy(a) for a in (states, user_features, game_types))).numpy()
+    results = {"argmax_mismatches": int((policy(states, user_features, game_types) != expected).sum()),
+               "rows_checked": check_rows}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        torch.save(model.state_dict(), os.path.join(tmp, "model.pt"))
+        save_weight_bundle(export_weight_bundle(model.state_dict(), embedder.state_dict()), os.path.join(tmp, "bundle.npz"))
+        startup = {
+            "torch": "import torch, customModel; m = customModel.QNetworkWithUserEmbedding(3, 8, 3); "
+                     "m.game_embedding = torch.nn.Embedding(5, 1); m.load_state_dict(torch.load('model.pt'))",
+            "numpy": "import numpyPolicy; numpyPolicy.NumpyPolicy(numpyPolicy.load_weight_bundle('bundle.npz'))",
+        }
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        for name, code in startup.items():
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=tmp, env=env, check=True)
+            results[f"{name}_startup_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    for n in batch_sizes:
+        rows = random_rows(n, seed=n)
+        tensors = tuple(torch.from_numpy(a) for a in rows)
+        results[n] = {
+            "torch_eager_us": round(time_per_call(eager, tensors, iterations) * 1e6, 2),
+            "numpy_us": round(time_per_call(policy, rows, iterations) * 1e6, 2),
+        }
+    return results
+
+
+def bench_model_cache(latency_ms=50.0, key="tst/models/primary_model.pt"):
+    """
+    Startup model loading against a local stand-in object store with latency_ms per call:
+    the old path (two downloads), a cold cache, a warm cache and a warm cache with the store unreachable.
+    """
+    model = QNetworkWithUserEmbedding(num_game_types=3, num_state_variables=8, num_actions=3)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        store = LocalObjectStore(os.path.join(tmp, "s3"), latency_s=latency_ms / 1000)
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        buffer.seek(0)
+        store.upload_fileobj(buffer, "neurobeacon", key)
+
+        previous_client, customModel._s3_client = customModel._s3_client, store
+        try:
+            start = time.perf_counter()
+            customModel.load_s3_object(key)
+            customModel.load_s3_object(key)
+            results["uncached_two_downloads_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+            cache = ModelCache(os.path.join(tmp, "cache"), client=store)
+            for name in ("cold_cache_ms", "warm_cache_ms"):
+                start = time.perf_counter()
+                primary = customModel.load_s3_object(key, cache=cache)
+                copy.deepcopy(primary)
+                results[name] = round((time.perf_counter() - start) * 1000, 1)
+
+            class Unreachable(LocalObjectStore):
+                def head_object(self, Bucket, Key):
+                    raise EndpointConnectionError(endpoint_url="http://stand-in")
+
+            cache.client = Unreachable(store.root)
+            start = time.perf_counter()
+            customModel.load_s3_object(key, cache=cache)
+            results["store_unreachable_fallback_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        finally:
+            customModel._s3_client = previous_client
+    return results
+
+
+def bench_retrain_isolation(items=5000, concurrency=16, idle_seconds=1.0):
+    """
+    /predict latency (direct path, one forward pass per request) with no retrain running, while a retrain runs
+    inline on the event loop (the old /retrain) and while it runs on the training worker thread.
+    """
+    from trainingWorker import TrainingWorker
+
+    api = setup_api(LocalDynamoTable(synthetic_state_items(items, num_users=max(items // 20, 1)), page_items=10**9))
+    row = tuple(a[:1] for a in random_rows(1))
+
+    async def load(until):
+        latencies = []
+
+        async def client():
+            while not until():
+                start = time.perf_counter()
+                await asyncio.sleep(0)  # wait for the loop like a request arriving at the server
+                api.predict_rows(*row)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return latency_summary(latencies, time.perf_counter() - start)
+
+    async def run():
+        results = {}
+        deadline = time.perf_counter() + idle_seconds
+        results["no_retrain"] = await load(lambda: time.perf_counter() > deadline)
+
+        async def inline():
+            await asyncio.sleep(0.05)
+            api.run_retrain(None)
+
+        task = asyncio.create_task(inline())
+        results["inline_retrain"] = await load(task.done)
+
+        api.transition_builder = fresh_transition_builder()  # same full first ingestion as the inline run
+        worker = TrainingWorker(api.run_retrain)
+        worker.start()
+        job = worker.submit()
+        results["worker_retrain"] = await load(lambda: job.status in ("done", "failed"))
+        worker.stop()
+        results["worker_retrain"]["job_seconds"] = round(job.finished_at - job.started_at, 2)
+        return results
+
+    return asyncio.run(run())
+
+
+def bench_weight_publish(iterations=200):
+    """
+    Cost of handing trained weights to serving: snapshotting the shadow (training thread), the reference swap
+    that activates it, and a full registry.publish including policy build and warm-up, plus memory per copy.
+    """
+    model, embedder = build_models()
+    registry = ModelRegistry(lambda m, e: TorchPolicy(FusedPolicy(m, e)), warmup_passes=1)
+    handle = registry.publish("benchmark", model, copy.deepcopy(model), embedder)
+    weights = DoubleBufferedWeights()
+    weights.shadow_for(handle)
+
+    def timed(fn):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        return round((time.perf_counter() - start) / iterations * 1e6, 2)
+
+    snapshot = weights.snapshot()
+    prepared = registry.prepare("benchmark", snapshot, handle.target_model, embedder)
+    model_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    return {
+        "snapshot_us": timed(weights.snapshot),
+        "reference_swap_us": timed(lambda: registry._activate(prepared)),
+        "full_publish_us": timed(lambda: registry.publish("benchmark", weights.snapshot(), handle.target_model, embedder)),
+        "model_bytes": model_bytes,
+        # serving snapshot + training shadow, against training the served model in place
+        "extra_bytes_vs_in_place": model_bytes,
+    }
+
+
+def bench_query_gsi(items=50000, page_items=1000, latency_ms=20.0, workers=(1, 2, 4, 8)):
+    """
+    Items/sec of the paginated history fetch against a stand-in table with latency_ms per query call,
+    sequential (1 worker) and with the sk range split over more workers. Raw pages only, no decoding.
+    """
+    from dynamoFunctions import query_gsi_pages, query_gsi_parallel_pages
+
+    now = int(time.time())
+    table = LocalDynamoTable(synthetic_state_items(items, num_users=500, start_sec=now),
+                             page_items=page_items, latency_s=latency_ms / 1000)
+    week_ago = str(now - 7 * 24 * 60 * 60)
+    results = {}
+    for n in workers:
+        start = time.perf_counter()
+        if n == 1:
+            pages = query_gsi_pages(table, "state", week_ago)
+        else:
+            pages = query_gsi_parallel_pages(table, "state", week_ago, num_workers=n, end_sec=now)
+        fetched = sum(len(page) for page in pages)
+        elapsed = time.perf_counter() - start
+        results[n] = {"items": fetched, "seconds": round(elapsed, 3), "items_per_sec": round(fetched / elapsed)}
+    return results
+
+
+def bench_decode(items=100_000):
+    """
+    Decoding a page of synthetic resource-layer items: clean_response per item (+ DataFrame of dicts)
+    against decode_items_columnar (+ DataFrame of columns).
+    """
+    from dynamoFunctions import clean_response, decode_items_columnar
+
+    raw = synthetic_state_items(items, num_users=max(items // 50, 1))
+    results = {"items": items}
+
+    start = time.perf_counter()
+    cleaned = [clean_response(item) for item in raw]
+    results["clean_response_s"] = round(time.perf_counter() - start, 3)
+    pd.DataFrame(cleaned)
+    results["clean_response_with_dataframe_s"] = round(time.perf_counter() - start, 3)
+
+    start = time.perf_counter()
+    columns = decode_items_columnar(raw)
+    results["columnar_s"] = round(time.perf_counter() - start, 3)
+    pd.DataFrame(columns)
+    results["columnar_with_dataframe_s"] = round(time.perf_counter() - start, 3)
+    results["speedup"] = round(results["clean_response_with_dataframe_s"] / results["columnar_with_dataframe_s"], 1)
+    return results
+
+
+def reference_process_into_dataframe(newData, embedder):
+    # processIntoDataframe before it was vectorized, kept to check and time the columnar pipeline against
+    newData['percent_correct_group_roll'] = newData['category'].apply(lambda x: x['percent_correct'])
+    newData['next_user'] = newData['user_embedding'].apply(lambda x: embedder(torch.tensor([[x['easy_percent'], x['medium_percent'], x['hard_percent']]])).tolist()[0])
+    newData['next_states'] = newData.apply(lambda x: [
+                    int(x['prev_is_correct']), 
+                    dynamoFunctions.applyMinMaxScaling(x['total_questions'], 'total_questions'), 
+                    dynamoFunctions.applyMinMaxScaling(x['total_correct'],'total_correct'), 
+                    x['percent_correct'], 
+                    x['percent_correct_group_roll'], 
+                    dynamoFunctions.applyMinMaxScaling(x['average_user_time'], 'average_user_time'), 
+                    int(x['prev_is_slow']), 
+                    x['total_weighted_reward']
+                    ], axis = 1)
+    newData['next_game_type'] = newData['game_type'].map(dynamoFunctions.gameTypeEmbed)
+    newData['next_game_type'] = newData['next_game_type'] - 3
+    newData['next_action'] = newData['difficulty'].map(dynamoFunctions.difficulty_mapping)
+    newData = newData[['next_states', 'next_action', 'reward', 'user_state_pk', 'next_user',
+            'next_game_type', 'created_at'
+            ]].rename(columns = {'reward': 'next_reward'})
+
+
+    newData['states'] = newData.groupby(['user_state_pk'])['next_states'].shift(-1)
+    newData['action'] = newData.groupby(['user_state_pk'])['next_action'].shift(-1)
+    newData['reward'] = newData.groupby(['user_state_pk'])['next_reward'].shift(-1)
+    newData['user'] = newData.groupby(['user_state_pk'])['next_user'].shift(-1)
+    newData['game_type'] = newData.groupby(['user_state_pk'])['next_game_type'].shift(-1)
+    newData = newData[['user_state_pk', 'states', 'action', 'reward', 'user', 'game_type', 'next_states', 'next_user', 'next_game_type']]
+    newData = newData.dropna()
+
+    return newData
+
+
+def synthetic_columns(n, num_users, seed=0):
+    # decode_items_columnar output for n synthetic items, generated directly as arrays (fast enough for 1M rows)
+    rng = np.random.default_rng(seed)
+    games = np.array(["math", "memory", "reaction", "sudoku", "trivia"], dtype=object)
+    users = rng.integers(0, num_users, size=n)
+    total_questions = rng.integers(1, 1750, size=n).astype(np.float64)
+    return {
+        "user_state_pk": np.array([f"U#{u:07d}" for u in users], dtype=object),
+        "sk": np.sort(rng.integers(0, 10**9, size=n))[::-1].astype(str).astype(object),
+        "prev_is_correct": rng.random(n) < 0.6,
+        "prev_is_slow": rng.random(n) < 0.3,
+        "total_questions": total_questions,
+        "total_correct": np.floor(total_questions * rng.random(n)),
+        "percent_correct": rng.random(n),
+        "average_user_time": rng.random(n) * 60000,
+        "total_weighted_reward": rng.random(n),
+        "reward": rng.random(n) * 2 - 1,
+        "difficulty": np.array(["easy", "medium", "hard"], dtype=object)[rng.integers(0, 3, size=n)],
+        "game_type": games[users % len(games)],
+        "category.percent_correct": rng.random(n),
+        "user_embedding.easy_percent": rng.random(n),
+        "user_embedding.medium_percent": rng.random(n),
+        "user_embedding.hard_percent": rng.random(n),
+        "created_at": rng.random(n),
+    }
+
+
+def bench_features(sizes=(10_000, 100_000, 1_000_000), reference_max_rows=100_000):
+    """
+    Transition building: the row-wise processIntoDataframe it replaced against processIntoDataframe (now columnar,
+    same DataFrame output) and buildTransitions (numpy arrays only). Checks the outputs are numerically identical
+    wherever the reference is run.
+    """
+    _, embedder = build_models()
+    results = {}
+    for n in sizes:
+        columns = synthetic_columns(n, num_users=max(n // 50, 1), seed=n)
+        frame = pd.DataFrame({name: values for name, values in columns.items() if "." not in name})
+        for nested in ("category", "user_embedding"):
+            subs = [name.split(".")[1] for name in columns if name.startswith(nested + ".")]
+            frame[nested] = [dict(zip(subs, values)) for values in zip(*(columns[f"{nested}.{sub}"].tolist() for sub in subs))]
+
+        row = {}
+        start = time.perf_counter()
+        dynamoFunctions.buildTransitions(columns, embedder)
+        row["buildTransitions_s"] = round(time.perf_counter() - start, 3)
+
+        start = time.perf_counter()
+        vectorized = dynamoFunctions.processIntoDataframe(frame.copy(), embedder)
+        row["processIntoDataframe_s"] = round(time.perf_counter() - start, 3)
+
+        if n <= reference_max_rows:
+            start = time.perf_counter()
+            reference = reference_process_into_dataframe(frame.copy(), embedder)
+            row["reference_s"] = round(time.perf_counter() - start, 3)
+            embedding_columns = ("user", "next_user")
+            row["identical"] = bool(
+                reference.index.equals(vectorized.index)
+                and list(reference.columns) == list(vectorized.columns)
+                and all(np.array_equal(np.array(reference[c].tolist(), dtype=np.float64),
+                                       np.array(vectorized[c].tolist(), dtype=np.float64))
+                        for c in reference.columns if c not in embedding_columns + ("user_state_pk",))
+                and reference["user_state_pk"].tolist() == vectorized["user_state_pk"].tolist()
+                and [str(t) for t in reference.dtypes] == [str(t) for t in vectorized.dtypes])
+            # One batched embedder pass rounds differently from per-row calls, so those columns are only float32-close
+            row["embedding_max_abs_diff"] = max(
+                float(np.abs(np.array(reference[c].tolist()) - np.array(vectorized[c].tolist())).max(initial=0))
+                for c in embedding_columns)
+        results[n] = row
+    return results
+
+
+
+def bench_incremental(history=100_000, new_events=(100, 1_000, 10_000), num_users=2_000):
+    """
+    Retrain ingestion cost: re-pulling and rebuilding the whole week (what /retrain did) against
+    IncrementalTransitionBuilder.update, which only queries and pairs the events newer than its watermark.
+    """
+    _, embedder = build_models()
+    now = int(time.time()) - 24 * 60 * 60
+    items = synthetic_state_items(history, num_users=num_users, start_sec=now)
+    week_ago = str(now - 7 * 24 * 60 * 60)
+
+    builder = fresh_transition_builder(embedding_dim=4)
+    start = time.perf_counter()
+    builder.update(LocalDynamoTable(items), embedder)
+    results = {"history": history, "first_update_s": round(time.perf_counter() - start, 3)}
+
+    for n in new_events:
+        # n events from the same users, all after the watermark
+        new = synthetic_state_items(n, num_users=num_users, seed=n)
+        for offset, item in enumerate(new):
+            item["sk"] = str(int(builder.watermark) + 1 + offset * 60 // n)
+        items = items + new
+        table = LocalDynamoTable(items)
+
+        start = time.perf_counter()
+        dynamoFunctions.buildTransitions(dynamoFunctions.query_gsi_columns(table, "state", week_ago), embedder)
+        full = time.perf_counter() - start
+
+        start = time.perf_counter()
+        emitted = builder.update(table, embedder)
+        incremental = time.perf_counter() - start
+        results[n] = {"full_rebuild_s": round(full, 3), "incremental_s": round(incremental, 4),
+                      "new_transitions": emitted, "stored_transitions": len(builder.store)}
+    return results
+
+
+def random_transitions(n, seed=0):
+    # n transitions shaped like buildTransitions output
+    rng = np.random.default_rng(seed)
+    return {
+        "states": rng.random((n, 8), dtype=np.float32), "action": rng.integers(0, 3, n),
+        "reward": rng.random(n, dtype=np.float32), "user": rng.random((n, 4), dtype=np.float32),
+        "game_type": rng.integers(0, 5, n), "next_states": rng.random((n, 8), dtype=np.float32),
+        "next_user": rng.random((n, 4), dtype=np.float32), "next_game_type": rng.integers(0, 5, n),
+    }
+
+
+def bench_replay(capacity=1_000_000, append_batch=1_000, batch_sizes=(10, 64, 1024), iterations=2_000):
+    """
+    ReplayBuffer append and uniform sampling throughput against DataFrame.sample on a processIntoDataframe-style
+    frame, reopening the buffer after a restart, and sampling from a second process that maps it read-only.
+    """
+    root = os.path.join(tempfile.mkdtemp(prefix="replay-"), "replay")
+    buffer = ReplayBuffer(root, capacity=capacity)
+    batch = random_transitions(append_batch)
+    appends = capacity * 2 // append_batch  # wraps around once
+    start = time.perf_counter()
+    for _ in range(appends):
+        buffer.append(batch)
+    elapsed = time.perf_counter() - start
+    results = {"capacity": capacity, "append_transitions_per_sec": round(appends * append_batch / elapsed),
+               "file_mb": round(sum(os.path.getsize(os.path.join(root, f)) for f in os.listdir(root)) / 2**20, 1)}
+
+    frame = pd.DataFrame({name: list(values) if values.ndim > 1 else values
+                          for name, values in random_transitions(100_000).items()})
+    rng = np.random.default_rng(0)
+    for size in batch_sizes:
+        results[f"sample_{size}_us"] = round(time_per_call(buffer.sample, (size, rng), iterations) * 1e6, 1)
+        results[f"dataframe_sample_{size}_us"] = round(time_per_call(frame.sample, (size,), iterations // 10) * 1e6, 1)
+
+    start = time.perf_counter()
+    reopened = ReplayBuffer(root)
+    results["reopen_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    results["reopened_len"] = len(reopened)
+
+    reader = ("import sys, numpy as np; from replayBuffer import ReplayBuffer; "
+              "b = ReplayBuffer(sys.argv[1], readonly=True); s = b.sample(1024); "
+              "print(len(b), s['states'].shape, b.columns['states'].flags.writeable)")
+    results["readonly_process"] = subprocess.run([sys.executable, "-c", reader, root], capture_output=True,
+                                                 text=True, check=True).stdout.strip()
+    return results
+
+
+def bench_prioritized(tree_capacity=10_000_000, buffer_capacity=1_000_000, batch_sizes=(64, 1024), iterations=500):
+    """
+    Sum-tree throughput at tree_capacity leaves (batched priority updates and prefix-sum sampling), and a full
+    prioritized sample + gather + priority update on a ReplayBuffer against uniform sampling of the same buffer.
+    """
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    tree = SumTree(tree_capacity)
+    tree.update(np.arange(tree_capacity), rng.random(tree_capacity))
+    results = {"tree_capacity": tree_capacity, "tree_build_s": round(time.perf_counter() - start, 2),
+               "tree_mb": round(tree.nodes.nbytes / 2**20)}
+    for size in batch_sizes:
+        positions = [rng.integers(0, tree_capacity, size) for _ in range(iterations)]
+        priorities = rng.random(size)
+        start = time.perf_counter()
+        for p in positions:
+            tree.update(p, priorities)
+        update = (time.perf_counter() - start) / iterations
+        start = time.perf_counter()
+        for _ in range(iterations):
+            tree.find(rng.random(size) * tree.total)
+        find = (time.perf_counter() - start) / iterations
+        results[f"tree_batch_{size}"] = {"update_us": round(update * 1e6, 1), "updates_per_sec": round(size / update),
+                                         "sample_us": round(find * 1e6, 1), "samples_per_sec": round(size / find)}
+
+    buffer = ReplayBuffer(os.path.join(tempfile.mkdtemp(prefix="replay-"), "replay"), capacity=buffer_capacity)
+    while len(buffer) < buffer_capacity:
+        buffer.append(random_transitions(min(buffer_capacity - len(buffer), 100_000)))
+    replay = PrioritizedReplay(buffer)
+    for size in batch_sizes:
+        td_errors = rng.standard_normal(size)
+
+        def prioritized_step():
+            _, positions, _ = replay.sample(size, rng)
+            replay.update_priorities(positions, td_errors)
+
+        results[f"replay_batch_{size}"] = {
+            "prioritized_step_us": round(time_per_call(prioritized_step, (), iterations) * 1e6, 1),
+            "uniform_sample_us": round(time_per_call(buffer.sample, (size, rng), iterations) * 1e6, 1),
+        }
+    return results
+
+
+def bench_train_steps(steps=1_000, batch_size=10, buffer_size=100_000):
+    """
+    Wall time per 1k gradient steps: the per-/retrain path (lists -> create_dataloader, new Adam, train) repeated
+    once per step, against train_steps with one persistent Adam on tensors sampled from a ReplayBuffer.
+    """
+    model, _ = build_models()
+    target = copy.deepcopy(model)
+    criterion = nn.MSELoss()
+    buffer = ReplayBuffer(os.path.join(tempfile.mkdtemp(prefix="replay-"), "replay"), capacity=buffer_size)
+    buffer.append(random_transitions(buffer_size))
+    rng = np.random.default_rng(0)
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        sample = {name: values.tolist() for name, values in buffer.sample(batch_size, rng).items()}
+        _, dataloader = customModel.create_dataloader(sample["states"], sample["action"], sample["reward"], sample["user"],
+                                                      sample["game_type"], sample["next_states"], sample["next_user"],
+                                                      sample["next_game_type"], batch_size=batch_size)
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.0035)
+        customModel.train(model, target, dataloader, optimizer, criterion, batch_size=batch_size)
+    per_call = time.perf_counter() - start
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.0035)
+    start = time.perf_counter()
+    customModel.train_steps(model, target, lambda: (customModel.transition_tensors(buffer.sample(batch_size, rng)), None, None),
+                            optimizer, criterion, steps)
+    engine = time.perf_counter() - start
+    scale = 1_000 / steps
+    return {"batch_size": batch_size, "per_retrain_call_s_per_1k": round(per_call * scale, 3),
+            "train_steps_s_per_1k": round(engine * scale, 3), "speedup": round(per_call / engine, 1)}
+
+
+def bench_batches(rows=100_000, batch_sizes=(10, 64, 1024), batches=200):
+    """
+    Building training batches from rows transitions: create_dataloader on Python lists (what /retrain fed it)
+    against TransitionBatches on the numpy columns. Reports time per batch (setup included, amortised over
+    batches), Python heap allocations (tracemalloc block count and peak) and how many bytes the setup copied.
+    """
+    arrays = random_transitions(rows)
+    lists = [arrays[name].tolist() for name in customModel.TRANSITION_COLUMNS]
+    results = {"rows": rows}
+
+    def measure(build):
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        source, batch_iter = build()
+        for _ in range(batches):
+            next(batch_iter)
+        elapsed = time.perf_counter() - start
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+        copied = sum(t.nbytes for t, name in zip(source, customModel.TRANSITION_COLUMNS)
+                     if t.data_ptr() != arrays[name].__array_interface__["data"][0])
+        return {"us_per_batch": round(elapsed / batches * 1e6, 1), "new_python_blocks": blocks,
+                "python_peak_mb": round(peak / 2**20, 2), "setup_copied_mb": round(copied / 2**20, 2)}
+
+    def dataloader(size):
+        dataset, loader = customModel.create_dataloader(*lists, batch_size=size)
+
+        def epochs():
+            while True:
+                yield from loader
+
+        return dataset.tensors, epochs()
+
+    def transition_batches(size):
+        batches_ = customModel.TransitionBatches(arrays, size)
+        return batches_.tensors, batches_.cycle()
+
+    for size in batch_sizes:
+        results[size] = {"create_dataloader": measure(lambda: dataloader(size)),
+                         "TransitionBatches": measure(lambda: transition_batches(size))}
+    return results
+
+
+def bench_target_sync(iterations=2_000, wide_hidden=1024):
+    """
+    Cost per target sync of TargetSync (in-place copy_ / lerp_) against rebuilding the target with
+    load_state_dict and with deepcopy, on the deployed Q-network and on a wider MLP (hidden width wide_hidden).
+    Also checks the in-place syncs keep the target's tensors (no reallocation).
+    """
+    model, _ = build_models()
+    wide = nn.Sequential(nn.Linear(64, wide_hidden), nn.ReLU(), nn.Linear(wide_hidden, wide_hidden), nn.ReLU(),
+                         nn.Linear(wide_hidden, 3))
+    results = {}
+    for name, network in (("q_network", model), ("wide_mlp", wide)):
+        target = copy.deepcopy(network)
+        pointers = [p.data_ptr() for p in target.parameters()]
+        sync = TargetSync("polyak", tau=0.005)
+        row = {"parameters": sum(p.numel() for p in network.parameters())}
+        row["hard_us"] = round(time_per_call(sync.hard, (network, target), iterations) * 1e6, 2)
+        row["polyak_lerp_us"] = round(time_per_call(sync.polyak, (network, target), iterations) * 1e6, 2)
+        row["load_state_dict_us"] = round(time_per_call(target.load_state_dict, (network.state_dict(),), iterations) * 1e6, 2)
+        row["deepcopy_us"] = round(time_per_call(copy.deepcopy, (network,), iterations // 10) * 1e6, 2)
+        row["in_place"] = pointers == [p.data_ptr() for p in target.parameters()]
+        results[name] = row
+    return results
+
+
+def bench_checkpoint(latency_ms=20.0, submissions=200, seconds=2.0, min_interval_s=0.25, keep=3):
+    """
+    Checkpointing retrained weights to a LocalObjectStore with latency_ms per call: the cost a publish pays for
+    Checkpointer.submit against serializing and uploading synchronously, how many of `submissions` spread over
+    `seconds` are actually written at min_interval_s, what garbage collection leaves, and the time to resume.
+    """
+    model, embedder = build_models()
+    registry = ModelRegistry(lambda m, e: TorchPolicy(FusedPolicy(m, e)), warmup_passes=1)
+    handle = registry.publish("tst/models/benchmark.pt", model, copy.deepcopy(model), embedder)
+    client = LocalObjectStore(tempfile.mkdtemp(prefix="s3-"), latency_s=latency_ms / 1000)
+    checkpointer = Checkpointer(client, "checkpoints", min_interval_s=min_interval_s, keep=keep)
+
+    start = time.perf_counter()
+    checkpointer.write(checkpointer.checkpoint(handle))
+    results = {"synchronous_write_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+    checkpointer.start()
+    submit = []
+    for _ in range(submissions):
+        start = time.perf_counter()
+        checkpointer.submit(handle)
+        submit.append(time.perf_counter() - start)
+        time.sleep(seconds / submissions)
+    checkpointer.stop()
+    results["submit_us_p50"] = round(float(np.percentile(submit, 50)) * 1e6, 1)
+    results["submit_us_p99"] = round(float(np.percentile(submit, 99)) * 1e6, 1)
+    results["submitted"] = submissions
+    results["written"] = checkpointer.written
+    results["kept"] = len(checkpointer.keys(handle.version))
+
+    start = time.perf_counter()
+    checkpoint = checkpointer.latest(handle.version)
+    restored = QNetworkWithUserEmbedding(num_game_types=3, num_state_variables=8, num_actions=3)
+    restored.game_embedding = nn.Embedding(5, 1)
+    restored.load_state_dict(checkpoint["model"])
+    results["resume_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    results["resumed_identical"] = all(torch.equal(v, restored.state_dict()[k]) for k, v in model.state_dict().items())
+    return results
+
+
+def bench_embedding_cache(batch_sizes=(1, 64), iterations=5_000, users=10_000, trace_requests=200_000,
+                          max_entries=2_000, zipf_a=1.2):
+    """
+    User embedding cache: hit-path lookup against the embedder forward pass it replaces and the end-to-end
+    eager policy with and without the cache, at each batch size; the hit rate of a Zipf(zipf_a) trace of
+    trace_requests over `users` user ids with max_entries cached; and invalidation after a weight change.
+    """
+    model, embedder = build_models()
+    results = {}
+    for batch_size in batch_sizes:
+        states, user_features, game_types = random_rows(batch_size)
+        cache = EmbeddingCache(embedder, max_entries=max(max_entries, batch_size))
+        cache.lookup(user_features)
+        fused = TorchPolicy(FusedPolicy(model, embedder))
+        cached = EmbeddingCachedPolicy(TorchPolicy(FusedPolicy(model)), cache)
+        results[f"batch_{batch_size}"] = {
+            "embedder_forward_us": round(time_per_call(cache.embed, (user_features,), iterations) * 1e6, 2),
+            "cache_hit_us": round(time_per_call(cache.lookup, (user_features,), iterations) * 1e6, 2),
+            "policy_uncached_us": round(time_per_call(fused, (states, user_features, game_types), iterations) * 1e6, 2),
+            "policy_cached_us": round(time_per_call(cached, (states, user_features, game_types), iterations) * 1e6, 2),
+            "same_actions": bool(np.array_equal(fused(states, np.round(user_features, 4), game_types),
+                                                cached(states, user_features, game_types))),
+        }
+
+    rng = np.random.default_rng(0)
+    user_features = rng.random((users, 3), dtype=np.float32)
+    trace = (rng.zipf(zipf_a, size=trace_requests) - 1) % users
+    user_ids = [str(u) for u in range(users)]
+    cache = EmbeddingCache(embedder, max_entries=max_entries)
+    start = time.perf_counter()
+    for user in trace:
+        cache.lookup(user_features[user:user + 1], [user_ids[user]])
+    results["trace"] = dict(cache.stats(), us_per_request=round((time.perf_counter() - start) / trace_requests * 1e6, 2))
+
+    with torch.no_grad():
+        embedder.fc.weight.mul_(2.0)
+    rows = np.round(user_features[:64], 4)
+    results["invalidated_on_weight_change"] = bool(
+        np.allclose(cache.lookup(rows, user_ids[:64]), cache.embed(rows)) and cache.invalidations == 1)
+    return results
+
+
+def skewed_trace(requests, users=2_000, zipf_a=1.3, seed=0):
+    """
+    /predict rows as sessions produce them: Zipf-distributed users with fixed features, each asking questions
+    in sessions of geometric length, mostly of their own game type. The first question of a session has an
+    all-zero state, later ones coarse scaled counts (0-5 out of 5) that grow with the question number.
+    """
+    rng = np.random.default_rng(seed)
+    user_features = np.round(rng.random((users, 3), dtype=np.float32), 2)
+    user = (rng.zipf(zipf_a, size=requests) - 1) % users
+    question = rng.geometric(0.15, size=requests) - 1
+    states = (np.minimum(rng.poisson(0.3 * question[:, None], size=(requests, 8)), 5) / 5).astype(np.float32)
+    game_types = np.where(rng.random(requests) < 0.8, user % 5, rng.integers(0, 5, size=requests)).astype(np.int64)
+    return states, user_features[user], game_types
+
+
+def bench_prediction_cache(requests=100_000, users=2_000, max_entries=(1_000, 10_000, 100_000), batch_size=1):
+    """
+    Replays a skewed_trace through the eager policy in batches of batch_size, uncached and behind a
+    PredictionCache of each size: per-request latency, hit rate, and whether every prediction matches.
+    """
+    model, embedder = build_models()
+    policy = TorchPolicy(FusedPolicy(model, embedder))
+    states, user_features, game_types = skewed_trace(requests, users)
+    batches = [slice(i, i + batch_size) for i in range(0, requests, batch_size)]
+
+    def replay(fn):
+        start = time.perf_counter()
+        actions = np.concatenate([fn(states[b], user_features[b], game_types[b]) for b in batches])
+        return actions, (time.perf_counter() - start) / requests * 1e6
+
+    expected, uncached_us = replay(policy)
+    results = {"distinct_rows": len(set(PredictionCache.keys(states, user_features, game_types))),
+               "uncached_us_per_request": round(uncached_us, 2)}
+    for entries in max_entries:
+        cache = PredictionCache(entries)
+        actions, cached_us = replay(PredictionCachedPolicy(policy, cache))
+        results[f"cache_{entries}"] = dict(cache.stats(), us_per_request=round(cached_us, 2),
+                                           same_actions=bool(np.array_equal(actions, expected)))
+    return results
+
+
+def serve_prefork_stubbed(workers, port):
+    """
+    prefork.serve on 127.0.0.1:port against a LocalObjectStore holding a random model and a LocalDynamoTable
+    history, all under a temporary directory. Runs until SIGTERM; bench_prefork starts it in its own process.
+    """
+    os.environ.setdefault("CHECKPOINT_PREFIX", "")
+    import prefork
+    from loadTest import stub_services
+
+    stub_services(tempfile.mkdtemp(prefix="prefork-"), items=5000, num_users=200)
+    return prefork.serve(workers, "127.0.0.1", port, log_level="warning")
+
+
+def http_call(port, method, path, body=None, connection=None):
+    conn = connection or http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    conn.request(method, path, body, {"Content-Type": "application/json"} if body else {})
+    response = conn.getresponse()
+    data = response.read()
+    if connection is None:
+        conn.close()
+    return response.status, data
+
+
+def predict_client(port, seconds, results):
+    """
+    One keep-alive connection sending /predict calls back to back for `seconds`. Requests are written and
+    responses read on the raw socket, so the clients take as little of the CPU the servers need as possible.
+    """
+    body = json.dumps({"states": [0.1] * 8, "user_features": [0.2, 0.3, 0.4], "game_type": 1}).encode()
+    request = (b"POST /mod/predict HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+               b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+    sock = socket.create_connection(("127.0.0.1", port), timeout=30)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    latencies, buffer = [], b""
+    deadline = time.perf_counter() + seconds
+    while (start := time.perf_counter()) < deadline:
+        sock.sendall(request)
+        while True:
+            end = buffer.find(b"\r\n\r\n")
+            if end >= 0:
+                length = int(re.search(rb"content-length: *(\d+)", buffer[:end].lower()).group(1))
+                if len(buffer) >= end + 4 + length:
+                    buffer = buffer[end + 4 + length:]
+                    break
+            buffer += sock.recv(65536)
+        latencies.append(time.perf_counter() - start)
+    sock.close()
+    results.put(latencies)
+
+
+def bench_prefork(workers=(1, 2, 4, 8), clients=16, seconds=5.0, port=8765, startup_timeout=120.0):
+    """
+    Throughput of /predict over HTTP from `clients` client processes against prefork.py with each number of
+    serving workers, and how long after a retrain finishes every worker serves the new generation.
+    Scaling is bounded by the cores of the machine, which are reported with the results.
+    """
+    context = multiprocessing.get_context("fork")
+    results = {"cpus": os.cpu_count()}
+    for count in workers:
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "prefork_server", "--workers", str(count),
+                                   "--port", str(port)], cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            deadline = time.time() + startup_timeout
+            while True:
+                try:
+                    if http_call(port, "GET", "/mod/health")[0] == 200:
+                        break
+                except OSError:
+                    pass
+                if time.time() > deadline or server.poll() is not None:
+                    raise RuntimeError(f"prefork server with {count} workers did not start")
+                time.sleep(0.2)
+            time.sleep(1.0)  # the other workers finish starting up
+
+            queue = context.Queue()
+            processes = [context.Process(target=predict_client, args=(port, seconds, queue)) for _ in range(clients)]
+            start = time.perf_counter()
+            for process in processes:
+                process.start()
+            latencies = [latency for _ in processes for latency in queue.get()]
+            for process in processes:
+                process.join()
+            row = latency_summary(latencies, time.perf_counter() - start)
+
+            job = json.loads(http_call(port, "GET", "/mod/retrain")[1])["job_id"]
+            while (status := json.loads(http_call(port, "GET", f"/mod/retrain/{job}")[1]))["status"] not in ("done", "failed"):
+                time.sleep(0.05)
+            finished = time.time()
+            generation = status["metrics"].get("generation")
+            # New connections are spread over the workers, so all of them answer within a few dozen calls
+            while True:
+                seen = {json.loads(http_call(port, "GET", "/mod/admin/model")[1])["generation"] for _ in range(8 * count)}
+                if seen == {generation} or time.time() - finished > 30:
+                    break
+                time.sleep(0.02)
+            row["retrain_status"] = status["status"]
+            row["all_workers_on_new_generation_s"] = round(time.time() - finished, 3) if seen == {generation} else None
+            results[f"workers_{count}"] = row
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(60)
+
+    base = results.get(f"workers_{workers[0]}", {}).get("throughput_rps")
+    for count in workers:
+        if base:
+            results[f"workers_{count}"]["speedup"] = round(results[f"workers_{count}"]["throughput_rps"] / base, 2)
+    return results
+
+
+def bench_inference_executor(workers=(0, 1, 2, 4), torch_threads=(1, 2, 4), concurrency=64, batch_clients=2,
+                             batch_rows=1024, seconds=3.0):
+    """
+    Sweeps the inference pool size and torch intra-op threads per pool thread (workers 0 runs inference on the
+    event loop). Each setting runs `concurrency` /predict clients through the micro-batcher and `batch_clients`
+    /predict_batch clients of batch_rows rows for `seconds`, and reports /predict latency, /predict_batch rows/s
+    and how late a 1 ms timer on the event loop fires, i.e. how long the loop is blocked.
+    """
+    api = setup_api()
+    states, user_features, game_types = random_rows(4096)
+    singles = [api.state_vars(states=s.tolist(), user_features=u.tolist(), game_type=int(g))
+               for s, u, g in zip(states, user_features, game_types)]
+    batch = api.batch_state_vars(states=states[:batch_rows].tolist(), user_features=user_features[:batch_rows].tolist(),
+                                 game_type=game_types[:batch_rows].tolist())
+
+    async def run(deadline):
+        latencies, batches, lags = [], [], []
+
+        async def predict_client(offset):
+            i = offset
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                await api.get_prediction(singles[i % len(singles)])
+                latencies.append(time.perf_counter() - start)
+                i += concurrency
+
+        async def batch_client():
+            while time.perf_counter() < deadline:
+                await asyncio.sleep(0)  # wait for the loop like a request arriving at the server
+                await api.get_batch_prediction(batch)
+                batches.append(batch_rows)
+
+        async def timer():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - start - 0.001)
+
+        await api.batcher.start()
+        start = time.perf_counter()
+        await asyncio.gather(timer(), *(predict_client(i) for i in range(concurrency)),
+                             *(batch_client() for _ in range(batch_clients)))
+        wall = time.perf_counter() - start
+        await api.batcher.stop()
+        row = latency_summary(latencies, wall)
+        row["batch_rows_per_s"] = round(sum(batches) / wall)
+        row["loop_lag_p50_ms"] = round(float(np.percentile(lags, 50)) * 1000, 3)
+        row["loop_lag_p99_ms"] = round(float(np.percentile(lags, 99)) * 1000, 3)
+        return row
+
+    results = {"cpus": os.cpu_count()}
+    for count in workers:
+        for threads in torch_threads:
+            api.executor = InferenceExecutor(workers=count, torch_threads=threads)
+            api.executor.start()
+            api.batcher = MicroBatcher(api.predict_rows, max_batch_size=64, max_wait_ms=2.0, executor=api.executor)
+            results[f"workers_{count}_threads_{threads}"] = asyncio.run(run(time.perf_counter() + seconds))
+            api.executor.stop()
+    return results
+
+
+def bench_metrics(iterations=200_000, requests=20_000):
+    """
+    Cost of the /metrics instrumentation: a histogram observation, a counter increment, the metrics middleware
+    around a trivial ASGI app, the timed validation and serialization of a /predict request, and rendering
+    /metrics. Per-request overhead is the middleware plus two observations around validation and serialization
+    plus one per forward pass.
+    """
+    api = setup_api()
+    registry = MetricsRegistry()
+    histogram = registry.histogram("bench_seconds", "bench", ("stage",))
+    counter = registry.counter("bench_total", "bench", ("route", "code"))
+
+    def per_call_us(fn, n):
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        return round((time.perf_counter() - start) / n * 1e6, 3)
+
+    results = {"observe_us": per_call_us(lambda: histogram.observe(0.0003, "forward"), iterations),
+               "inc_us": per_call_us(lambda: counter.inc("/predict", "200"), iterations)}
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    async def send(message):
+        pass
+
+    scope = {"type": "http", "path": "/predict"}
+    wrapped = MetricsMiddleware(app, counter, counter, histogram)
+
+    async def drive(asgi):
+        start = time.perf_counter()
+        for _ in range(requests):
+            await asgi(scope, None, send)
+        return (time.perf_counter() - start) / requests * 1e6
+
+    bare, instrumented = asyncio.run(drive(app)), asyncio.run(drive(wrapped))
+    results["middleware_us"] = round(instrumented - bare, 3)
+
+    body = json.dumps({"states": [0.1] * 8, "user_features": [0.2, 0.3, 0.4], "game_type": 1})
+    results["validation_us"] = per_call_us(lambda: api.state_vars.model_validate_json(body), requests)
+    results["serialization_us"] = per_call_us(lambda: api.serialize(api.Difficulty, prediction=1), requests)
+
+    for i in range(1000):
+        histogram.observe(i / 1e5, f"stage{i % 8}")
+        counter.inc(f"/route{i % 16}", "200")
+    snapshot = registry.snapshot()
+    results["render_ms"] = round(per_call_us(lambda: render(snapshot), 200) / 1000, 3)
+    results["render_8_processes_ms"] = round(per_call_us(lambda: render(*[snapshot] * 8), 50) / 1000, 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sub = subparsers.add_parser("micro_batching", help="per-request /predict path vs the micro-batcher")
+    sub.add_argument("--requests", type=int, default=5000)
+    sub.add_argument("--concurrency", type=int, default=64)
+    sub.add_argument("--max-batch-size", type=int, default=64)
+    sub.add_argument("--max-wait-ms", type=float, default=2.0)
+    sub.set_defaults(run=lambda a: bench_micro_batching(a.requests, a.concurrency, a.max_batch_size, a.max_wait_ms))
+
+    sub = subparsers.add_parser("predict_batch", help="per-item cost of /predict_batch vs looping /predict")
+    sub.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 64, 1024, 8192])
+    sub.set_defaults(run=lambda a: bench_predict_batch(a.batch_sizes))
+
+    sub = subparsers.add_parser("compiled", help="eager vs traced inference graph latency")
+    sub.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 64, 1024])
+    sub.add_argument("--iterations", type=int, default=2000)
+    sub.set_defaults(run=lambda a: bench_compiled(a.batch_sizes, a.iterations))
+
+    sub = subparsers.add_parser("numpy_backend", help="numpy vs torch startup time, latency and argmax agreement")
+    sub.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 64, 1024])
+    sub.add_argument("--iterations", type=int, default=2000)
+    sub.set_defaults(run=lambda a: bench_numpy_backend(a.batch_sizes, a.iterations))
+
+    sub = subparsers.add_parser("model_cache", help="cold vs warm startup model loading through the local cache")
+    sub.add_argument("--latency-ms", type=float, default=50.0)
+    sub.set_defaults(run=lambda a: bench_model_cache(a.latency_ms))
+
+    sub = subparsers.add_parser("retrain_isolation", help="/predict latency during inline vs background retraining")
+    sub.add_argument("--items", type=int, default=5000)
+    sub.add_argument("--concurrency", type=int, default=16)
+    sub.set_defaults(run=lambda a: bench_retrain_isolation(a.items, a.concurrency))
+
+    sub = subparsers.add_parser("weight_publish", help="cost of publishing trained weights to serving")
+    sub.add_argument("--iterations", type=int, default=200)
+    sub.set_defaults(run=lambda a: bench_weight_publish(a.iterations))
+
+    sub = subparsers.add_parser("query_gsi", help="paginated history fetch throughput by number of workers")
+    sub.add_argument("--items", type=int, default=50000)
+    sub.add_argument("--latency-ms", type=float, default=20.0)
+    sub.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    sub.set_defaults(run=lambda a: bench_query_gsi(a.items, latency_ms=a.latency_ms, workers=a.workers))
+
+    sub = subparsers.add_parser("decode", help="clean_response vs columnar decoding of DynamoDB items")
+    sub.add_argument("--items", type=int, default=100_000)
+    sub.set_defaults(run=lambda a: bench_decode(a.items))
+
+    sub = subparsers.add_parser("features", help="row-wise vs columnar transition building")
+    sub.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    sub.add_argument("--reference-max-rows", type=int, default=100_000)
+    sub.set_defaults(run=lambda a: bench_features(a.sizes, a.reference_max_rows))
+
+    sub = subparsers.add_parser("incremental", help="full weekly rebuild vs incremental transition ingestion")
+    sub.add_argument("--history", type=int, default=100_000)
+    sub.add_argument("--new-events", type=int, nargs="+", default=[100, 1_000, 10_000])
+    sub.add_argument("--num-users", type=int, default=2_000)
+    sub.set_defaults(run=lambda a: bench_incremental(a.history, a.new_events, a.num_users))
+
+    sub = subparsers.add_parser("replay", help="memory-mapped replay buffer append / sample vs DataFrame.sample")
+    sub.add_argument("--capacity", type=int, default=1_000_000)
+    sub.add_argument("--append-batch", type=int, default=1_000)
+    sub.add_argument("--batch-sizes", type=int, nargs="+", default=[10, 64, 1024])
+    sub.add_argument("--iterations", type=int, default=2_000)
+    sub.set_defaults(run=lambda a: bench_replay(a.capacity, a.append_batch, a.batch_sizes, a.iterations))
+
+    sub = subparsers.add_parser("prioritized", help="sum-tree update / sample throughput and prioritized replay cost")
+    sub.add_argument("--tree-capacity", type=int, default=10_000_000)
+    sub.add_argument("--buffer-capacity", type=int, default=1_000_000)
+    sub.add_argument("--batch-sizes", type=int, nargs="+", default=[64, 1024])
+    sub.add_argument("--iterations", type=int, default=500)
+    sub.set_defaults(run=lambda a: bench_prioritized(a.tree_capacity, a.buffer_capacity, a.batch_sizes, a.iterations))
+
+    sub = subparsers.add_parser("train_steps", help="per-call retrain training overhead vs the multi-step engine")
+    sub.add_argument("--steps", type=int, default=1_000)
+    sub.add_argument("--batch-size", type=int, default=10)
+    sub.set_defaults(run=lambda a: bench_train_steps(a.steps, a.batch_size))
+
+    sub = subparsers.add_parser("batches", help="create_dataloader on lists vs zero-copy TransitionBatches")
+    sub.add_argument("--rows", type=int, default=100_000)
+    sub.add_argument("--batch-sizes", type=int, nargs="+", default=[10, 64, 1024])
+    sub.add_argument("--batches", type=int, default=200)
+    sub.set_defaults(run=lambda a: bench_batches(a.rows, a.batch_sizes, a.batches))
+
+    sub = subparsers.add_parser("target_sync", help="cost per hard / Polyak target network sync")
+    sub.add_argument("--iterations", type=int, default=2_000)
+    sub.add_argument("--wide-hidden", type=int, default=1024)
+    sub.set_defaults(run=lambda a: bench_target_sync(a.iterations, a.wide_hidden))
+
+    sub = subparsers.add_parser("checkpoint", help="async checkpoint submit cost, rate limiting, GC and resume")
+    sub.add_argument("--latency-ms", type=float, default=20.0)
+    sub.add_argument("--submissions", type=int, default=200)
+    sub.add_argument("--seconds", type=float, default=2.0)
+    sub.add_argument("--min-interval-s", type=float, default=0.25)
+    sub.add_argument("--keep", type=int, default=3)
+    sub.set_defaults(run=lambda a: bench_checkpoint(a.latency_ms, a.submissions, a.seconds, a.min_interval_s, a.keep))
+
+    sub = subparsers.add_parser("embedding_cache", help="user embedding cache hit path, hit rate and invalidation")
+    sub.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 64])
+    sub.add_argument("--iterations", type=int, default=5_000)
+    sub.add_argument("--users", type=int, default=10_000)
+    sub.add_argument("--max-entries", type=int, default=2_000)
+    sub.set_defaults(run=lambda a: bench_embedding_cache(a.batch_sizes, a.iterations, a.users, max_entries=a.max_entries))
+
+    sub = subparsers.add_parser("prediction_cache", help="prediction cache on a skewed /predict trace")
+    sub.add_argument("--requests", type=int, default=100_000)
+    sub.add_argument("--users", type=int, default=2_000)
+    sub.add_argument("--max-entries", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    sub.add_argument("--batch-size", type=int, default=1)
+    sub.set_defaults(run=lambda a: bench_prediction_cache(a.requests, a.users, a.max_entries, a.batch_size))
+
+    sub = subparsers.add_parser("prefork", help="/predict throughput over HTTP by number of pre-fork workers")
+    sub.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    sub.add_argument("--clients", type=int, default=16)
+    sub.add_argument("--seconds", type=float, default=5.0)
+    sub.add_argument("--port", type=int, default=8765)
+    sub.set_defaults(run=lambda a: bench_prefork(a.workers, a.clients, a.seconds, a.port))
+
+    sub = subparsers.add_parser("inference_executor", help="/predict latency and loop blocking by inference pool size and torch threads")
+    sub.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    sub.add_argument("--torch-threads", type=int, nargs="+", default=[1, 2, 4])
+    sub.add_argument("--concurrency", type=int, default=64)
+    sub.add_argument("--batch-clients", type=int, default=2)
+    sub.add_argument("--batch-rows", type=int, default=1024)
+    sub.add_argument("--seconds", type=float, default=3.0)
+    sub.set_defaults(run=lambda a: bench_inference_executor(a.workers, a.torch_threads, a.concurrency, a.batch_clients,
+                                                            a.batch_rows, a.seconds))
+
+    sub = subparsers.add_parser("metrics", help="per-request cost of the /metrics instrumentation and of rendering it")
+    sub.add_argument("--iterations", type=int, default=200_000)
+    sub.add_argument("--requests", type=int, default=20_000)
+    sub.set_defaults(run=lambda a: bench_metrics(a.iterations, a.requests))
+
+    sub = subparsers.add_parser("prefork_server", help="(used by prefork) pre-fork server on local stand-in stores")
+    sub.add_argument("--workers", type=int, default=1)
+    sub.add_argument("--port", type=int, default=8765)
+    # Not a benchmark: exits with the server's status rather than printing a result
+    sub.set_defaults(run=lambda a: sys.exit(serve_prefork_stubbed(a.workers, a.port)))
+
+    args = parser.parse_args()
+    print(json.dumps(args.run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import io
+import logging
+import threading
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpointer:
+    """
+    Writes published model generations to S3 (or anything with the same client calls) off the request path.
+
+    submit(handle) only keeps a reference to the handle: published modules are frozen and never written to again,
+    so no copy of the weights is needed. A writer thread takes their state dicts, serializes and uploads them to
+    <prefix>/<model version, / replaced by __>/checkpoint-<ms timestamp>.pt, at most once every min_interval_s;
+    submissions in between are coalesced and only the newest is written. After each write all but the newest
+    `keep` checkpoints of that model version are deleted.
+
+    latest(version) loads the newest checkpoint retrained from a model version, so a restarted service can
+    resume from its retrained weights.
+    """
+
+    def __init__(self, client, prefix, bucket="neurobeacon", min_interval_s=60.0, keep=5):
+        self.client = client
+        self.prefix = prefix.strip("/")
+        self.bucket = bucket
+        self.min_interval_s = min_interval_s
+        self.keep = max(keep, 1)
+        self.written = 0
+        self.last_key = None
+        self._pending = None
+        self._last_write = 0.0
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="checkpointer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        # Writes a pending checkpoint straight away instead of waiting out the interval
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, handle):
+        with self._condition:
+            self._pending = handle
+            self._condition.notify()
+
+    @staticmethod
+    def checkpoint(handle):
+        return {
+            "version": handle.version,
+            "generation": handle.generation,
+            "model": handle.model.state_dict(),
+            "target_model": handle.target_model.state_dict(),
+            "embedder": handle.embedder.state_dict(),
+            "saved_at": time.time(),
+        }
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._pending is not None:
+                        wait = self._last_write + self.min_interval_s - time.monotonic()
+                        if wait <= 0 or self._stopping:
+                            break
+                    elif self._stopping:
+                        return
+                    else:
+                        wait = None
+                    self._condition.wait(wait)
+                handle, self._pending = self._pending, None
+                self._last_write = time.monotonic()
+            try:
+                self.write(self.checkpoint(handle))
+            except Exception:  # upload, serialization or disk errors alike, the next submission is tried again
+                logger.exception(f"Writing checkpoint of generation {handle.generation} failed")
+
+    def _version_prefix(self, version):
+        return f"{self.prefix}/{version.strip('/').replace('/', '__')}/checkpoint-"
+
+    def write(self, checkpoint):
+        buffer = io.BytesIO()
+        torch.save(checkpoint, buffer)
+        buffer.seek(0)
+        key = f"{self._version_prefix(checkpoint['version'])}{int(time.time() * 1000):013d}.pt"
+        self.client.upload_fileobj(buffer, self.bucket, key)
+        self.written += 1
+        self.last_key = key
+        logger.info(f"Checkpointed generation {checkpoint['generation']} of {checkpoint['version']} to {key}")
+        self.collect_garbage(checkpoint['version'])
+        return key
+
+    def keys(self, version):
+        # Checkpoint keys of a model version, oldest first (the timestamps sort lexically)
+        keys, kwargs = [], {"Bucket": self.bucket, "Prefix": self._version_prefix(version)}
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            keys += [obj["Key"] for obj in response.get("Contents", []) if obj["Key"].endswith(".pt")]
+            if not response.get("IsTruncated"):
+                return sorted(keys)
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def collect_garbage(self, version):
+        for key in self.keys(version)[:-self.keep]:
+            self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def latest(self, version):
+        """
+        The newest checkpoint of version as written by submit(), or None if there is none.
+        """
+        keys = self.keys(version)
+        if not keys:
+            return None
+        buffer = io.BytesIO()
+        self.client.download_fileobj(self.bucket, keys[-1], buffer)
+        buffer.seek(0)
+        checkpoint = torch.load(buffer, weights_only=True)
+        checkpoint["key"] = keys[-1]
+        return checkpoint
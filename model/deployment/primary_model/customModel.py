@@ -3,10 +3,26 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader, TensorDataset
 
+import copy
+import numpy as np
 import statistics
 import os
 import io
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# One S3 client per process, S3_ENDPOINT_URL points it at a local stand-in object store
+_s3_client = None
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        config = Config(connect_timeout=float(os.getenv("S3_CONNECT_TIMEOUT", "5")),
+                        read_timeout=float(os.getenv("S3_READ_TIMEOUT", "30")),
+                        retries={"max_attempts": 2})
+        _s3_client = boto3.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL"), config=config)
+    return _s3_client
 
 class QNetworkWithUserEmbedding(nn.Module):
     def __init__(self, num_game_types, num_state_variables, num_actions,
@@ -42,17 +58,69 @@ class QNetworkWithUserEmbedding(nn.Module):
             allWeights += "-" * 50 + "\n"
         return(allWeights)
 
-def train(model, target_model, replay_buffer, optimizer, criterion, batch_size=64, gamma=0.99):
-    model.train()
-    target_model.eval()
-    total_loss = 0
+def predict_actions(model, embedder, states, user_features, game_types):
+    # Batched greedy policy: states (batch, 8), user_features (batch, 3), game_types (batch,)
+    # Returns the argmax action for every row
+    with torch.no_grad():
+        user_embedding = embedder(user_features)
+        q_values = model(states, user_embedding, game_types)
+    return q_values.argmax(dim=1)
 
-    # if len(replay_buffer) < batch_size:
-    #     return 0  # Skip training if not enough data yet
+class FusedPolicy(nn.Module):
+    # User embedder and Q-network in one module, so both can be traced into a single inference graph.
+    # Without an embedder the policy takes precomputed user embeddings instead of user features
+    def __init__(self, model, embedder=None):
+        super(FusedPolicy, self).__init__()
+        self.model = model
+        self.embedder = embedder
 
-    # Sample random transitions from the buffer
-    batch = next(iter(replay_buffer))
+    def forward(self, states, user_features, game_types):
+        user_embedding = user_features if self.embedder is None else self.embedder(user_features)
+        q_values = self.model(states, user_embedding, game_types)
+        return q_values.argmax(dim=1)
+
+class TorchPolicy:
+    # Serves numpy rows from a torch policy module such as FusedPolicy or its compiled graph
+    def __init__(self, module):
+        self.module = module
+
+    def __call__(self, states, user_features, game_types):
+        with torch.no_grad():
+            actions = self.module(torch.from_numpy(states), torch.from_numpy(user_features), torch.from_numpy(game_types))
+        return actions.numpy()
+
+def compile_policy(model, embedder, example_batch_size=4):
+    """
+    Traces the embedder + Q-network (or the Q-network alone, on user embeddings, if embedder is None) into one
+    frozen TorchScript graph for CPU inference.
+    Freezing inlines the weights, so the graph has to be rebuilt whenever the weights change.
+    Raises if tracing fails or the graph disagrees with eager mode on a random probe batch.
+    """
+    policy = FusedPolicy(model, embedder).eval()
+    user_width = embedder.fc.in_features if embedder is not None else model.fc1.in_features - 8 - model.game_embedding.embedding_dim
+    example = (torch.rand(example_batch_size, 8), torch.rand(example_batch_size, user_width),
+               torch.arange(example_batch_size) % model.game_embedding.num_embeddings)
+    with torch.no_grad():
+        graph = torch.jit.trace(policy, example)
+        graph = torch.jit.optimize_for_inference(torch.jit.freeze(graph.eval()))
+
+        probe = (torch.rand(64, 8), torch.rand(64, user_width), torch.arange(64) % model.game_embedding.num_embeddings)
+        if not torch.equal(graph(*probe), policy(*probe)):
+            raise RuntimeError("Compiled policy does not match eager mode")
+    return graph
 
+def train_step(model, target_model, batch, optimizer, criterion, gamma=0.99, weights=None, embedder=None):
+    """
+    One gradient step on a tuple of batch tensors. Returns the detached loss and per-sample TD errors
+    (target - Q) as tensors, so callers decide when to synchronise on them.
+
+    weights are per-sample importance-sampling weights (prioritized replay): the criterion is applied per sample
+    and the weighted mean is minimised.
+
+    With an embedder the batch holds raw user features instead of user embeddings. A trainable embedder is trained
+    jointly with the Q-network (the optimizer must hold its parameters too), a frozen one only embeds. Next-state
+    users are embedded with it without gradients, like the rest of the target.
+    """
     # Unpack batch
     (states, actions, rewards, user_features, game_types, 
         next_states, next_user_features, next_game_types
@@ -67,6 +135,13 @@ def train(model, target_model, replay_buffer, optimizer, criterion, batch_size=6
     # dones = dones.float()  # 1 if terminal, 0 otherwise
     user_features = user_features.float() # 
     next_user_features = next_user_features.float()
+    game_types = game_types.long()
+    next_game_types = next_game_types.long()
+
+    if embedder is not None:
+        user_features = embedder(user_features)
+        with torch.no_grad():
+            next_user_features = embedder(next_user_features)
 
     # Compute current Q-values from primary model
     q_values = model(states, user_features, game_types)  # Shape: (batch_size, num_actions)
@@ -79,17 +154,127 @@ def train(model, target_model, replay_buffer, optimizer, criterion, batch_size=6
         target_q_value = rewards + gamma * max_next_q_values #* (1 - dones)  # Zero out if terminal state
 
     # Compute loss and backprop
-    loss = criterion(q_value, target_q_value) # calculate loss
+    if weights is None:
+        loss = criterion(q_value, target_q_value) # calculate loss
+    else:
+        per_sample = copy.copy(criterion)
+        per_sample.reduction = 'none'
+        loss = (torch.as_tensor(weights, dtype=torch.float32) * per_sample(q_value, target_q_value)).mean()
+    optimizer.zero_grad(set_to_none=True) # gradients of earlier steps must not leak into this one
     loss.backward() # computes gradients of the loss w.r.t. model parameters
     optimizer.step() # applies those gradients to update model weights
 
+    return loss.detach(), (target_q_value - q_value).detach()
+
+
+def train(model, target_model, replay_buffer, optimizer, criterion, batch_size=64, gamma=0.99,
+          weights=None, return_td_errors=False):
+    """
+    One gradient step on a batch from replay_buffer, a DataLoader or an already built tuple of batch tensors.
+    See train_step for weights. With return_td_errors, the batch's TD errors are returned as a third value.
+    """
+    model.train()
+    target_model.eval()
+    total_loss = 0
+
+    # if len(replay_buffer) < batch_size:
+    #     return 0  # Skip training if not enough data yet
+
+    # Sample random transitions from the buffer
+    batch = replay_buffer if isinstance(replay_buffer, (tuple, list)) else next(iter(replay_buffer))
+    loss, td_errors = train_step(model, target_model, batch, optimizer, criterion, gamma=gamma, weights=weights)
+
     total_loss = loss.item()
+    if return_td_errors:
+        return model, total_loss, td_errors
     return model, total_loss # Note: since pytorch models are mutable, no need to actually return model
 
 
+def train_steps(model, target_model, sample_batch, optimizer, criterion, steps, gamma=0.99, on_td_errors=None,
+                target_sync=None, embedder=None):
+    """
+    Runs steps gradient steps with the same optimizer, so its state (e.g. Adam moments) carries over between
+    steps and between calls. sample_batch() returns (batch tensors, weights or None, context) for each step;
+    on_td_errors(context, td_errors), if given, receives each step's TD errors (e.g. to update replay priorities).
+    target_sync (see targetSync.TargetSync) updates target_model after every step. See train_step for embedder.
+
+    Losses are summed on-tensor and read once at the end; returns the mean loss over the steps.
+    """
+    model.train()
+    target_model.eval()
+    if embedder is not None and any(p.requires_grad for p in embedder.parameters()):
+        embedder.train()  # a frozen embedder may be the one serving, it stays in eval mode
+    total_loss = torch.zeros(())
+    for _ in range(steps):
+        batch, weights, context = sample_batch()
+        loss, td_errors = train_step(model, target_model, batch, optimizer, criterion, gamma=gamma, weights=weights,
+                                     embedder=embedder)
+        total_loss += loss
+        if on_td_errors is not None:
+            on_td_errors(context, td_errors)
+        if target_sync is not None:
+            target_sync.step(model, target_model)
+    return total_loss.item() / max(steps, 1)
+
+
+TRANSITION_COLUMNS = ('states', 'action', 'reward', 'user', 'game_type', 'next_states', 'next_user', 'next_game_type')
+
+def transition_tensors(arrays):
+    # {column: numpy array} transitions (e.g. a replay buffer sample) -> batch tensor tuple in train_step order
+    return tuple(torch.as_tensor(arrays[name]) for name in TRANSITION_COLUMNS)
+
+
+class TransitionBatches:
+    """
+    Minibatches over {column: numpy array} transitions without going through Python lists, the array-based
+    counterpart of create_dataloader.
+
+    Each column is wrapped once with torch.from_numpy, sharing memory with the array (memory-mapped replay
+    buffer columns included). Shuffling permutes an index instead of the data, and each batch is one
+    index_select per column; unshuffled batches over all rows are plain views. indices limits the batches to
+    those rows, e.g. the valid positions of a ring buffer.
+    """
+
+    def __init__(self, arrays, batch_size=64, shuffle=True, indices=None, generator=None):
+        self.tensors = tuple(torch.from_numpy(np.ascontiguousarray(arrays[name])) for name in TRANSITION_COLUMNS)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.indices = None if indices is None else torch.as_tensor(indices, dtype=torch.long)
+        self.generator = generator
+
+    def __len__(self):
+        rows = len(self.tensors[0]) if self.indices is None else len(self.indices)
+        return -(-rows // self.batch_size)
+
+    def __iter__(self):
+        rows = len(self.tensors[0]) if self.indices is None else len(self.indices)
+        if not self.shuffle and self.indices is None:
+            for start in range(0, rows, self.batch_size):
+                yield tuple(t[start:start + self.batch_size] for t in self.tensors)
+            return
+        order = torch.randperm(rows, generator=self.generator) if self.shuffle else torch.arange(rows)
+        if self.indices is not None:
+            order = self.indices[order]
+        for start in range(0, rows, self.batch_size):
+            batch = order[start:start + self.batch_size]
+            yield tuple(t.index_select(0, batch) for t in self.tensors)
+
+    def cycle(self):
+        # Endless batches, reshuffled every epoch. Over no rows there would be none, and no end to looking for one
+        if len(self) == 0:
+            raise ValueError('Cannot cycle over batches of no transitions')
+
+        def batches():
+            while True:
+                yield from self
+
+        return batches()
+
+
 def create_dataloader(states, actions, rewards, users, game_types, next_states, next_users, next_game_types
                     #   , dones
                       , batch_size=64):
+    # Lists of lists -> DataLoader, copies every value. Use TransitionBatches for numpy arrays
     # Convert to tensors
     states_tensor = torch.tensor(states, dtype=torch.float32)
     actions_tensor = torch.tensor(actions, dtype=torch.long)
@@ -115,23 +300,29 @@ def save_obj_in_s3(obj, path):
     torch.save(obj, buffer)
     buffer.seek(0)
 
-    s3 = boto3.client("s3")
+    s3 = get_s3_client()
     bucket_name = 'neurobeacon'
 
     # Upload to S3
     s3.upload_fileobj(buffer, bucket_name, path)
 
-def load_s3_object(path):
+def build_q_network(state_dict):
+    num_game_types = state_dict['game_embedding.weight'].shape[0]
+    model = QNetworkWithUserEmbedding(num_game_types = num_game_types, num_state_variables = 8, num_actions = 3)
+    model.load_state_dict(state_dict)
+    return model
+
+def load_s3_object(path, cache=None):
+    # With a ModelCache the object is only downloaded when its ETag/version is not cached locally yet
+    if cache is not None:
+        return build_q_network(torch.load(cache.fetch(path)))
+
     buffer = io.BytesIO()
-    s3 = boto3.client("s3")
+    s3 = get_s3_client()
     bucket_name = "neurobeacon"
     s3.download_fileobj(bucket_name, path, buffer)
     buffer.seek(0)
-
-    # Directly return the loaded DataLoader
-    dataloader = QNetworkWithUserEmbedding(num_game_types = 3, num_state_variables = 8, num_actions = 3)
-    dataloader.load_state_dict(torch.load(buffer))
-    return dataloader
+    return build_q_network(torch.load(buffer))
 
 class UserEmbeddingModel(nn.Module):
     def __init__(self, input_size, embedding_dim):
@@ -140,4 +331,44 @@ class UserEmbeddingModel(nn.Module):
 
     def forward(self, x):
         return self.fc(x)
-    
\ No newline at end of file
+
+
+def embedder_path(model_path):
+    # The embedder artifact of a model version sits next to its Q-network: primary_model.pt -> primary_model.embedder.pt
+    root, ext = os.path.splitext(model_path)
+    return f"{root}.embedder{ext or '.pt'}"
+
+def seeded_user_embedder(seed=0, input_size=3, embedding_dim=4):
+    # The same initial weights in every process, without touching the global RNG
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(seed)
+        return UserEmbeddingModel(input_size, embedding_dim)
+
+def load_user_embedder(path, cache=None, seed=0):
+    """
+    Loads the UserEmbeddingModel state_dict stored at path (through the local model cache if given).
+    If there is no such object, returns seeded_user_embedder(seed) instead, so every worker and restart
+    still embeds users identically. Returns (embedder, whether it was loaded from path).
+    """
+    try:
+        if cache is not None:
+            state_dict = torch.load(cache.fetch(path), weights_only=True)
+        else:
+            buffer = io.BytesIO()
+            get_s3_client().download_fileobj("neurobeacon", path, buffer)
+            buffer.seek(0)
+            state_dict = torch.load(buffer, weights_only=True)
+    except ClientError as err:
+        if err.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+            raise
+        return seeded_user_embedder(seed), False
+    embedding_dim, input_size = state_dict['fc.weight'].shape
+    embedder = UserEmbeddingModel(input_size, embedding_dim)
+    embedder.load_state_dict(state_dict)
+    return embedder, True
+
+def save_user_embedder(embedder, path, client=None):
+    buffer = io.BytesIO()
+    torch.save(embedder.state_dict(), buffer)
+    buffer.seek(0)
+    (client or get_s3_client()).upload_fileobj(buffer, "neurobeacon", path)
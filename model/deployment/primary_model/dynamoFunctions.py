@@ -1,10 +1,15 @@
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key
 from boto3.dynamodb.types import TypeDeserializer
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+import os
 import time
 import datetime
 from decimal import Decimal
+import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
@@ -14,6 +19,19 @@ from customModel import UserEmbeddingModel, load_s3_object, QNetworkWithUserEmbe
 
 deserializer = TypeDeserializer()
 
+# One DynamoDB resource per process, sharing a connection pool big enough for parallel queries.
+# DYNAMODB_ENDPOINT_URL points it at a local stand-in.
+_dynamo_resource = None
+
+def get_dynamo_resource():
+    global _dynamo_resource
+    if _dynamo_resource is None:
+        config = Config(max_pool_connections=int(os.getenv("DYNAMODB_MAX_POOL_CONNECTIONS", "32")),
+                        retries={"max_attempts": 5, "mode": "adaptive"})
+        _dynamo_resource = boto3.resource('dynamodb', region_name='us-east-1',
+                                          endpoint_url=os.getenv("DYNAMODB_ENDPOINT_URL"), config=config)
+    return _dynamo_resource
+
 gameTypeEmbed = {
     'math': 3,
     'memory': 4,
@@ -63,26 +81,162 @@ def clean_response(item):
 
     return convert_decimals(deserialized_item)
 
-def query_gsi(table, gsi_index, unix_sec_str, limit=1):
-    try:
-        if limit != -1:
-            response = table.query(
-                IndexName='state_type_gsi',
-                KeyConditionExpression=Key('state_type').eq(gsi_index) & Key('sk').gt(unix_sec_str),
-                ScanIndexForward=False,  # Descending order to get most recent values
-                Limit=limit
-            )
+_NUMBER_TYPES = {Decimal, int, float}
+
+def _decode_column(values):
+    # One column of resource-layer values -> numpy array, typed by its first non-missing value
+    present = next((v for v in values if v is not None), None)
+    if isinstance(present, bool):
+        return np.array(values, dtype=bool if None not in values else object)
+    if isinstance(present, (Decimal, int, float)):
+        types = set(map(type, values))
+        if types <= _NUMBER_TYPES:
+            return np.fromiter(map(float, values), dtype=np.float64, count=len(values))
+        if types <= _NUMBER_TYPES | {type(None)}:
+            return np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)
+        return _decode_objects(values)  # mixed with strings or other types
+    if isinstance(present, dict):
+        return {sub: _decode_column([v.get(sub) if v is not None else None for v in values])
+                for sub in _column_names([v for v in values if v is not None])}
+    if isinstance(present, list):
+        return _decode_objects(values)
+    return np.array(values, dtype=object)
+
+def _decode_objects(values):
+    # Each value as clean_response decodes it, filled one by one so numpy keeps lists whole
+    decoded = np.empty(len(values), dtype=object)
+    for n, v in enumerate(values):
+        decoded[n] = None if v is None else clean_response({'v': v})['v']
+    return decoded
+
+def _column_names(items):
+    # Keys of the first item in order, then any keys only later items have
+    first = list(items[0]) if items else []
+    return first + sorted(set().union(*items).difference(first))
+
+def decode_items_columnar(items):
+    """
+    Decodes a page of resource-layer items column by column instead of item by item like clean_response.
+
+    Returns {column: numpy array}: numbers as float64 (NaN where missing, the same values clean_response gives),
+    booleans as bool and strings as object. Maps such as category and user_embedding are flattened into
+    "category.percent_correct" style columns, so the result can go straight into pd.DataFrame.
+    """
+    columns = {}
+
+    def flatten(prefix, decoded):
+        if isinstance(decoded, dict):
+            for sub, sub_decoded in decoded.items():
+                flatten(f"{prefix}.{sub}", sub_decoded)
         else:
-            response = table.query(
-                IndexName='state_type_gsi',
-                KeyConditionExpression=Key('state_type').eq(gsi_index) & Key('sk').gt(unix_sec_str),
-                ScanIndexForward=False
-            )
+            columns[prefix] = decoded
+
+    for name in _column_names(items):
+        try:
+            values = list(map(itemgetter(name), items))
+        except KeyError:  # not every item has it
+            values = [item.get(name) for item in items]
+        flatten(name, _decode_column(values))
+    return columns
+
+def query_gsi_pages(table, gsi_index, unix_sec_str, limit=-1, end_sec_str=None):
+    """
+    Yields the raw items of every page of state_type_gsi with sk > unix_sec_str (and <= end_sec_str if given),
+    most recent first, following LastEvaluatedKey until the range or the limit (-1 for none) is exhausted.
+    """
+    sk_condition = Key('sk').gt(unix_sec_str) if end_sec_str is None else Key('sk').between(unix_sec_str, end_sec_str)
+    kwargs = {
+        'IndexName': 'state_type_gsi',
+        'KeyConditionExpression': Key('state_type').eq(gsi_index) & sk_condition,
+        'ScanIndexForward': False,  # Descending order to get most recent values
+    }
+    remaining = limit
+    while True:
+        if limit != -1:
+            kwargs['Limit'] = remaining
+        response = table.query(**kwargs)
         items = response.get('Items', [])
+        if end_sec_str is not None:
+            items = [i for i in items if i['sk'] != unix_sec_str]  # between is inclusive, keep sk > unix_sec_str
+        yield items
+
+        remaining -= len(items)
+        if 'LastEvaluatedKey' not in response or (limit != -1 and remaining <= 0):
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def split_sk_range(unix_sec_str, end_sec, num_ranges):
+    # (lower exclusive, upper inclusive) sk bounds of num_ranges consecutive ranges covering (unix_sec_str, end_sec]
+    start = int(unix_sec_str)
+    bounds = [start + (end_sec - start) * i // num_ranges for i in range(num_ranges + 1)]
+    return [(str(lo), str(hi)) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+
+class ClientTable:
+    """
+    Queries a boto3 Table through its resource's client. Resources (Table included) must not be shared between
+    threads, clients can be. The resource registers its high-level interface on the client, so queries still
+    take Key conditions and return Python values.
+    """
+
+    def __init__(self, table):
+        self.client = table.meta.client
+        self.name = table.name
+
+    def query(self, **kwargs):
+        return self.client.query(TableName=self.name, **kwargs)
+
+def query_gsi_parallel_pages(table, gsi_index, unix_sec_str, num_workers=4, end_sec=None, executor=None):
+    """
+    Same pages as query_gsi_pages, but the sk range up to end_sec (now by default) is split into num_workers
+    sub-ranges that are fetched in parallel on a thread pool, through the table's client (see ClientTable).
+    Pages are still yielded most recent first; anything written after end_sec is fetched by the last range.
+    """
+    if hasattr(table, 'meta'):  # a boto3 Table, local stand-ins are thread-safe themselves
+        table = ClientTable(table)
+    end_sec = int(time.time()) if end_sec is None else end_sec
+    ranges = split_sk_range(unix_sec_str, end_sec, num_workers)
+    if not ranges:
+        yield from query_gsi_pages(table, gsi_index, unix_sec_str)
+        return
+
+    def fetch(lo, hi, newest):
+        return list(query_gsi_pages(table, gsi_index, lo, end_sec_str=None if newest else hi))
+
+    own_executor = executor is None
+    executor = executor or ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='query-gsi')
+    try:
+        futures = [executor.submit(fetch, lo, hi, n == len(ranges) - 1) for n, (lo, hi) in enumerate(ranges)]
+        for future in reversed(futures):
+            yield from future.result()
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def query_gsi_items(table, gsi_index, unix_sec_str, limit=-1, num_workers=1):
+    # The raw items of every page, most recent first
+    if limit == -1 and num_workers > 1:
+        pages = query_gsi_parallel_pages(table, gsi_index, unix_sec_str, num_workers=num_workers)
+    else:
+        pages = query_gsi_pages(table, gsi_index, unix_sec_str, limit=limit)
+    return [item for page in pages for item in page]
+
+def query_gsi_columns(table, gsi_index, unix_sec_str, limit=-1, num_workers=1):
+    """
+    query_gsi, decoded with decode_items_columnar instead of clean_response: returns {column: numpy array}.
+    """
+    return decode_items_columnar(query_gsi_items(table, gsi_index, unix_sec_str, limit=limit, num_workers=num_workers))
+
+def query_gsi(table, gsi_index, unix_sec_str, limit=1, num_workers=1):
+    try:
+        if limit == -1 and num_workers > 1:
+            pages = query_gsi_parallel_pages(table, gsi_index, unix_sec_str, num_workers=num_workers)
+        else:
+            pages = query_gsi_pages(table, gsi_index, unix_sec_str, limit=limit)
 
         clean_items = []
-        for i in items:
-            clean_items.append(clean_response(i))
+        for page in pages:
+            for i in page:
+                clean_items.append(clean_response(i))
         return clean_items
     except ClientError as err:
         print('Failed to query', err)
@@ -134,38 +288,127 @@ def processIntoDataframeRolling(newData, currentUserInfo, existingData):
         data = pd.concat([data, existingData])
     return data, finalPerUser
 
-def processIntoDataframe(newData, embedder):
-
-    
-    newData['percent_correct_group_roll'] = newData['category'].apply(lambda x: x['percent_correct'])
-    newData['next_user'] = newData['user_embedding'].apply(lambda x: embedder(torch.tensor([[x['easy_percent'], x['medium_percent'], x['hard_percent']]])).tolist()[0])
-    newData['next_states'] = newData.apply(lambda x: [
-                    int(x['prev_is_correct']), 
-                    applyMinMaxScaling(x['total_questions'], 'total_questions'), 
-                    applyMinMaxScaling(x['total_correct'],'total_correct'), 
-                    x['percent_correct'], 
-                    x['percent_correct_group_roll'], 
-                    applyMinMaxScaling(x['average_user_time'], 'average_user_time'), 
-                    int(x['prev_is_slow']), 
-                    x['total_weighted_reward']
-                    ], axis = 1)
-    newData['next_game_type'] = newData['game_type'].map(gameTypeEmbed)
-    newData['next_game_type'] = newData['next_game_type'] - 3
-    newData['next_action'] = newData['difficulty'].map(difficulty_mapping)
-    newData = newData[['next_states', 'next_action', 'reward', 'user_state_pk', 'next_user',
-            'next_game_type', 'created_at'
-            ]].rename(columns = {'reward': 'next_reward'})
+def minMaxScale(values, variable):
+    # Vectorized applyMinMaxScaling, same clipping and the same exact 0 at the minimum
+    maxVal = minMaxThresholds[variable]['max']
+    minVal = minMaxThresholds[variable]['min']
 
+    clipped = np.minimum(values, maxVal)
+    return np.where(clipped == minVal, 0.0, (clipped - minVal) / (maxVal - minVal))
+
+def frameToColumns(frame):
+    # DataFrame of clean_response items -> the flattened columns decode_items_columnar produces
+    columns = {}
+    for name in frame.columns:
+        values = frame[name].to_numpy()
+        if len(values) and isinstance(values[0], dict):
+            for sub in values[0]:
+                columns[f'{name}.{sub}'] = np.array([v[sub] for v in values])
+        else:
+            columns[name] = values
+    return columns
+
+# Decoded columns stateFeatures reads, plus the sort key
+STATE_COLUMNS = ('user_state_pk', 'sk', 'prev_is_correct', 'total_questions', 'total_correct', 'percent_correct',
+                 'category.percent_correct', 'average_user_time', 'prev_is_slow', 'total_weighted_reward',
+                 'user_embedding.easy_percent', 'user_embedding.medium_percent', 'user_embedding.hard_percent',
+                 'difficulty', 'reward', 'game_type')
+
+def stateFeatures(columns, embedder, float_dtype=np.float32):
+    """
+    Per-event features (the "next_*" side of a transition) for every row of the decoded columns, computed column-wise:
+    next_states (n, 8), next_user (n, 4) from one batched embedder pass, next_action, next_reward and next_game_type
+    (NaN where the difficulty or game type is unknown). Without an embedder next_user holds the raw (n, 3) user
+    features, for training the embedder jointly.
+    """
+    next_states = np.column_stack([
+        columns['prev_is_correct'].astype(np.float64),
+        minMaxScale(columns['total_questions'].astype(np.float64), 'total_questions'),
+        minMaxScale(columns['total_correct'].astype(np.float64), 'total_correct'),
+        columns['percent_correct'],
+        columns['category.percent_correct'],
+        minMaxScale(columns['average_user_time'].astype(np.float64), 'average_user_time'),
+        columns['prev_is_slow'].astype(np.float64),
+        columns['total_weighted_reward'],
+    ]).astype(float_dtype)
+
+    user_features = np.column_stack([columns['user_embedding.easy_percent'], columns['user_embedding.medium_percent'],
+                                     columns['user_embedding.hard_percent']]).astype(np.float32)
+    if embedder is None:
+        next_user = user_features.astype(float_dtype)
+    else:
+        with torch.no_grad():
+            next_user = embedder(torch.from_numpy(user_features)).numpy().astype(float_dtype)
+
+    return {
+        'user_state_pk': np.asarray(columns['user_state_pk']),
+        'next_states': next_states,
+        'next_user': next_user,
+        'next_action': pd.Series(columns['difficulty']).map(difficulty_mapping).to_numpy(dtype=np.float64),
+        'next_reward': np.asarray(columns['reward'], dtype=np.float64),
+        'next_game_type': pd.Series(columns['game_type']).map(gameTypeEmbed).to_numpy(dtype=np.float64) - 3,
+    }
 
-    newData['states'] = newData.groupby(['user_state_pk'])['next_states'].shift(-1)
-    newData['action'] = newData.groupby(['user_state_pk'])['next_action'].shift(-1)
-    newData['reward'] = newData.groupby(['user_state_pk'])['next_reward'].shift(-1)
-    newData['user'] = newData.groupby(['user_state_pk'])['next_user'].shift(-1)
-    newData['game_type'] = newData.groupby(['user_state_pk'])['next_game_type'].shift(-1)
-    newData = newData[['user_state_pk', 'states', 'action', 'reward', 'user', 'game_type', 'next_states', 'next_user', 'next_game_type']]
-    newData = newData.dropna()
+def successorWithinUser(user_state_pk):
+    """
+    (rows, successors): for every row that has one, the next row of the same user_state_pk in frame order.
+    This is what groupby('user_state_pk').shift(-1) pairs up, found with one stable sort instead of a groupby per column.
+    """
+    codes = pd.factorize(user_state_pk)[0]
+    order = np.argsort(codes, kind='stable')
+    same_user = (codes[order[:-1]] == codes[order[1:]]) & (codes[order[:-1]] >= 0)
+    rows, successors = order[:-1][same_user], order[1:][same_user]
+    in_frame_order = np.argsort(rows, kind='stable')
+    return rows[in_frame_order], successors[in_frame_order]
+
+def buildTransitions(columns, embedder, float_dtype=np.float32):
+    """
+    Columnar (s, a, r, s') pipeline: decoded columns (see decode_items_columnar) -> dict of numpy arrays.
+
+    Rows are paired exactly like processIntoDataframe always has: with items most recent first, s, a, r and the user
+    and game type come from the user's previous event and next_* from the event itself. Transitions with an unknown
+    difficulty, game type or reward are dropped. 'row' holds each transition's position in the input.
+    """
+    features = stateFeatures(columns, embedder, float_dtype)
+    rows, previous = successorWithinUser(features['user_state_pk'])
+
+    action = features['next_action'][previous]
+    reward = features['next_reward'][previous]
+    game_type = features['next_game_type'][previous]
+    next_game_type = features['next_game_type'][rows]
+    valid = ~(np.isnan(action) | np.isnan(reward) | np.isnan(game_type) | np.isnan(next_game_type))
+    rows, previous = rows[valid], previous[valid]
+
+    return {
+        'row': rows,
+        'user_state_pk': features['user_state_pk'][rows],
+        'states': features['next_states'][previous],
+        'action': action[valid].astype(np.int64),
+        'reward': reward[valid].astype(float_dtype),
+        'user': features['next_user'][previous],
+        'game_type': game_type[valid].astype(np.int64),
+        'next_states': features['next_states'][rows],
+        'next_user': features['next_user'][rows],
+        'next_game_type': next_game_type[valid].astype(np.int64),
+    }
 
-    return newData
+def processIntoDataframe(newData, embedder):
+    # DataFrame of clean_response items -> one row of list-valued transition columns per transition, via buildTransitions
+    transitions = buildTransitions(frameToColumns(newData), embedder, float_dtype=np.float64)
+    next_game_type = transitions['next_game_type']
+    if newData['game_type'].map(gameTypeEmbed).isna().any():
+        next_game_type = next_game_type.astype(np.float64)  # pandas keeps the column float once it held a NaN
+    return pd.DataFrame({
+        'user_state_pk': transitions['user_state_pk'],
+        'states': transitions['states'].tolist(),
+        'action': transitions['action'].astype(np.float64),
+        'reward': transitions['reward'],
+        'user': transitions['user'].tolist(),
+        'game_type': transitions['game_type'].astype(np.float64),
+        'next_states': transitions['next_states'].tolist(),
+        'next_user': transitions['next_user'].tolist(),
+        'next_game_type': next_game_type,
+    }, index=newData.index[transitions['row']])
 
 # gameTypeEmbed = {
 #     'math': 3,
@@ -233,26 +476,4 @@ def processIntoDataframe(newData, embedder):
 # print(f'Time to pull and process {endTime-startTime}')
 
 
-# allTimes = []
-# for i in range(1):
-#     startTime = time.time()
-#     currentRetrainBatch = df.sample(numInRetrainBatch)
-
-#     # print(primaryModel.print_model_weights())
-
-#     dataset, dataloader = create_dataloader(currentRetrainBatch['states'].to_list(), currentRetrainBatch['action'].to_list(), currentRetrainBatch['reward'].to_list(), 
-#                                             currentRetrainBatch['user'].to_list(), currentRetrainBatch['game_type'].to_list(), 
-#                                             currentRetrainBatch['next_states'].to_list(), currentRetrainBatch['next_user'].to_list(), 
-#                                             currentRetrainBatch['next_game_type'].to_list(), 
-#                                             batch_size=numInRetrainBatch)
-#     optimizer = optim.Adam(primaryModel.parameters(), lr=0.0035)
-#     train(primaryModel, targetModel, dataloader, optimizer, criterion, batch_size=10, gamma=0.99)
-#     endTime = time.time()
-#     # print(primaryModel.print_model_weights())
-#     allTimes.append(endTime-startTime)
-
-
-# print(f'Retraining took an average of {sum(allTimes)/len(allTimes)} seconds over 100 experiments')
-
-
-
+# Retraining latency under load is measured by loadTest.py, e.g. python loadTest.py --mix retrain=1
@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of UserEmbeddingModel outputs, so a returning user skips the embedder forward pass.
+
+    User features are quantized to `decimals` places and the embedding is computed from the quantized values,
+    so every input that rounds to the same key gets the same embedding. Entries are keyed on the user id when
+    the request gives one (and only used while that user's quantized features are unchanged), otherwise on the
+    quantized features. At most max_entries are kept, the least recently used are evicted first, and entries
+    older than ttl_s are recomputed.
+
+    The cache belongs to one embedder. Every lookup compares the embedder's parameter versions with those the
+    entries were computed with, so weights changed in place (load_state_dict, an optimizer step) clear it.
+
+    on_count(event, amount), if given, is told of every change of the hits, misses, evictions and invalidations
+    counters (stats() has their totals for this cache alone).
+    """
+
+    def __init__(self, embedder, max_entries=100_000, ttl_s=300.0, decimals=4, on_count=None):
+        self.embedder = embedder
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.scale = 10.0 ** decimals
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.on_count = on_count
+        self._params = list(embedder.parameters())
+        self._weights = self._fingerprint()
+        # Embeddings live in one preallocated array, so a batch of hits is gathered with a single index
+        self._embeddings = np.empty((max_entries, embedder.fc.out_features), dtype=np.float32)
+        self._entries = OrderedDict()  # key -> (feature key, row of _embeddings, expiry)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _fingerprint(self):
+        return tuple((p.data_ptr(), p._version) for p in self._params)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+        self._count(invalidations=1)
+
+    def _count(self, **amounts):
+        if self.on_count is not None:
+            for event, amount in amounts.items():
+                if amount:
+                    self.on_count(event, amount)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0, "evictions": self.evictions,
+                "invalidations": self.invalidations}
+
+    def embed(self, user_features):
+        with torch.no_grad():
+            return self.embedder(torch.from_numpy(np.ascontiguousarray(user_features, dtype=np.float32))).numpy()
+
+    def lookup(self, user_features, user_ids=None):
+        """
+        (n, embedding dim) float32 embeddings of (n, 3) user features. user_ids, if given, has one id or None
+        per row; rows with None are keyed on their features.
+        """
+        quantized = np.rint(np.asarray(user_features, dtype=np.float32) * self.scale).astype(np.int64)
+        # One fixed-width bytes key per row, built in a single vectorized view
+        feature_keys = quantized.view(f"S{quantized.shape[1] * 8}").ravel().tolist()
+        keys = feature_keys if user_ids is None else [f if u is None else u for u, f in zip(user_ids, feature_keys)]
+
+        hits, slots, missing = [], [], []
+        evictions = invalidations = 0
+        now = time.monotonic()
+        out = np.empty((len(keys), self._embeddings.shape[1]), dtype=np.float32)
+        with self._lock:
+            weights = self._fingerprint()
+            if weights != self._weights:
+                self._entries.clear()
+                self._weights = weights
+                invalidations = 1
+
+            entries = self._entries
+            for i, key in enumerate(keys):
+                entry = entries.get(key)
+                if entry is not None and entry[2] > now and entry[0] == feature_keys[i]:
+                    entries.move_to_end(key)
+                    hits.append(i)
+                    slots.append(entry[1])
+                else:
+                    missing.append(i)
+            self.hits += len(hits)
+            self.misses += len(missing)
+            if hits:
+                out[hits] = self._embeddings[slots]  # before misses can reuse the rows of evicted entries
+
+            if missing:
+                out[missing] = self.embed(quantized[missing] / self.scale)
+                expiry = now + self.ttl_s
+                for i in missing:
+                    key = keys[i]
+                    entry = entries.pop(key, None)
+                    if entry is not None:
+                        slot = entry[1]
+                    elif len(entries) < self.max_entries:
+                        slot = len(entries)  # entries only shrink by clear(), so rows 0..len-1 are the ones in use
+                    else:
+                        slot = entries.popitem(last=False)[1][1]
+                        evictions += 1
+                    entries[key] = (feature_keys[i], slot, expiry)
+                    self._embeddings[slot] = out[i]
+            self.evictions += evictions
+            self.invalidations += invalidations
+        self._count(hits=len(hits), misses=len(missing), evictions=evictions, invalidations=invalidations)
+        return out
+
+
+class EmbeddingCachedPolicy:
+    """
+    Serving policy that takes user embeddings from an EmbeddingCache and runs q_policy, a policy built on the
+    Q-network alone (FusedPolicy without an embedder, or NumpyPolicy with embedded=True), on them.
+    on_lookup(seconds), if given, is told how long each lookup took.
+    """
+
+    takes_user_ids = True
+
+    def __init__(self, q_policy, cache, on_lookup=None):
+        self.q_policy = q_policy
+        self.cache = cache
+        self.on_lookup = on_lookup
+
+    def uncached(self):
+        # The same policy without the cache, for warm-up passes that should neither fill the cache nor count in it
+        return lambda states, user_features, game_types, user_ids=None: self.q_policy(
+            states, self.cache.embed(user_features), game_types)
+
+    def __call__(self, states, user_features, game_types, user_ids=None):
+        if self.on_lookup is None:
+            return self.q_policy(states, self.cache.lookup(user_features, user_ids), game_types)
+        start = time.perf_counter()
+        embeddings = self.cache.lookup(user_features, user_ids)
+        self.on_lookup(time.perf_counter() - start)
+        return self.q_policy(states, embeddings, game_types)
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def configure_interop_threads(threads):
+    """
+    Sets torch's inter-op thread pool size. Torch only allows this before its first parallel work, so it is
+    called at startup; if the pool is already running with another size that is logged and left as it is.
+    """
+    if threads <= 0 or torch.get_num_interop_threads() == threads:
+        return
+    try:
+        torch.set_num_interop_threads(threads)
+    except RuntimeError:
+        logger.warning(f"Could not set {threads} inter-op threads, torch is already using "
+                       f"{torch.get_num_interop_threads()}")
+
+
+class InferenceExecutor:
+    """
+    Runs inference calls on a fixed pool of `workers` threads, so a forward pass never blocks the event loop.
+
+    Each pool thread runs torch with torch_threads intra-op threads: the models are tiny, so splitting one
+    forward pass over several cores costs more than it saves, and concurrent calls on several pool threads
+    would otherwise each start a thread per core. With workers 0 calls run inline on the caller's thread,
+    as the service did before.
+
+    Handlers await run(fn, *args). Calls beyond `workers` wait in the pool's queue; the micro-batcher keeps
+    at most `workers` batches in flight, so requests arriving meanwhile join the next batch instead.
+    """
+
+    def __init__(self, workers=1, torch_threads=1):
+        self.workers = workers
+        self.torch_threads = torch_threads
+        self._pool = None
+
+    def start(self):
+        if self.workers <= 0:
+            torch.set_num_threads(self.torch_threads)
+            return
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference",
+                                        initializer=torch.set_num_threads, initargs=(self.torch_threads,))
+
+    def stop(self):
+        # Lets calls already submitted finish
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    async def run(self, fn, *args):
+        if self._pool is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
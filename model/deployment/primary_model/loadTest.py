@@ -0,0 +1,371 @@
+"""
+Load test of the service (src.main:app), run in this process against local stand-ins for S3 and DynamoDB.
+
+Run from this directory, e.g.:
+    python loadTest.py --concurrency 64 --seconds 10 --output results.json
+    python loadTest.py --mix predict=90,predict_batch=9,retrain=1 --batch-rows 256 --output results.json
+    python loadTest.py --compare before.json after.json
+
+The app starts with its normal lifespan. Its model is a random network uploaded to a LocalObjectStore and its
+history table a LocalDynamoTable of synthetic events, both under a temporary directory. `concurrency` clients
+send requests back to back, each picking the endpoint by the weights of --mix:
+    predict         POST /mod/predict, one row
+    predict_batch   POST /mod/predict_batch, --batch-rows rows
+    retrain         GET /mod/retrain, after adding --new-items events to the table, as the app would have
+By default requests go straight to the ASGI app (no sockets, so the numbers are the app's own cost plus the
+client's); with --http they go over TCP to uvicorn running on a thread of this process.
+
+The results (throughput and p50/p95/p99/p999 latency per endpoint, errors, retraining job durations, and the
+commit and settings they were measured with) are printed and written to --output as JSON, for --compare.
+Settings the service reads from the environment (INFERENCE_WORKERS, PREDICT_MAX_BATCH_SIZE, ...) apply as usual.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import types
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import customModel
+from customModel import QNetworkWithUserEmbedding
+from localStores import LocalObjectStore, LocalDynamoTable, synthetic_state_items
+
+OPERATIONS = ("predict", "predict_batch", "retrain")
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def stub_services(root, items=20_000, num_users=1_000, seed=0):
+    """
+    Points the service at local stand-ins under root: a LocalObjectStore holding a random model at MODEL_PATH
+    (also used for checkpoints) and a LocalDynamoTable of `items` synthetic events. Directories the service
+    writes to default to root as well. Has to run before src.pickl_fastapi is first imported, which reads its
+    settings on import. Returns the (imported) src.pickl_fastapi module and the table.
+    """
+    for name, path in (("MODEL_CACHE_DIR", "cache"), ("TRANSITION_STORE_DIR", "transitions"),
+                       ("SHARED_WEIGHTS_DIR", "shared")):
+        os.environ.setdefault(name, os.path.join(root, path))
+    import src.pickl_fastapi as api
+
+    store = LocalObjectStore(os.path.join(root, "s3"))
+    torch.manual_seed(seed)
+    model = QNetworkWithUserEmbedding(num_game_types=3, num_state_variables=8, num_actions=3)
+    model.game_embedding = nn.Embedding(5, 1)
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    buffer.seek(0)
+    store.upload_fileobj(buffer, "neurobeacon", api.MODEL_PATH)
+    customModel._s3_client = store
+    table = LocalDynamoTable(synthetic_state_items(items, num_users, seed=seed), page_items=1000)
+    api.get_dynamo_resource = lambda: types.SimpleNamespace(Table=lambda name: table)
+    return api, table
+
+
+def parse_mix(text):
+    # "predict=90,predict_batch=9,retrain=1" -> {operation: weight}
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {name!r}, expected one of {', '.join(OPERATIONS)}")
+        mix[name.strip()] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("The mix needs at least one operation with a positive weight")
+    return mix
+
+
+def summarize(latencies_s, wall_s):
+    lat_ms = np.asarray(latencies_s) * 1000
+    if not len(lat_ms):
+        return {"requests": 0}
+    return {
+        "requests": len(lat_ms),
+        "throughput_rps": round(len(lat_ms) / wall_s, 1),
+        "mean_ms": round(float(lat_ms.mean()), 4),
+        "p50_ms": round(float(np.percentile(lat_ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(lat_ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(lat_ms, 99)), 4),
+        "p999_ms": round(float(np.percentile(lat_ms, 99.9)), 4),
+        "max_ms": round(float(lat_ms.max()), 4),
+    }
+
+
+class Workload:
+    """
+    Request bodies and the table writes of a run, generated up front from seed so every run sends the same ones.
+    """
+
+    def __init__(self, table, seed=0, batch_rows=64, new_items=200, num_users=1_000, user_ids=False, bodies=4096):
+        rng = np.random.default_rng(seed)
+        bodies = max(bodies, batch_rows)
+        self.table = table
+        self.new_items = new_items
+        self.num_users = num_users
+        self.seed = seed
+
+        states = rng.random((bodies, 8), dtype=np.float32).round(4)
+        user_features = rng.random((bodies, 3), dtype=np.float32).round(4)
+        game_types = rng.integers(0, 5, size=bodies)
+        users = rng.zipf(1.3, size=bodies) % num_users
+        self.predict = [json.dumps({"states": s.tolist(), "user_features": u.tolist(), "game_type": int(g),
+                                    **({"user_id": f"user-{int(i):06d}"} if user_ids else {})}).encode()
+                        for s, u, g, i in zip(states, user_features, game_types, users)]
+        self.predict_batch = []
+        for start in range(0, bodies, batch_rows)[:16]:
+            rows = slice(start, start + batch_rows)
+            body = {"states": states[rows].tolist(), "user_features": user_features[rows].tolist(),
+                    "game_type": game_types[rows].tolist()}
+            if user_ids:
+                body["user_ids"] = [f"user-{int(i):06d}" for i in users[rows]]
+            self.predict_batch.append(json.dumps(body).encode())
+
+        self._next_sk = int(time.time())
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def write_events(self):
+        # The app's writes between two retrains: new_items events, newer than everything in the table
+        with self._lock:
+            self._next_sk += 60
+            self._writes += 1
+            start_sec, seed = self._next_sk, self.seed + self._writes
+        self.table.put_items(synthetic_state_items(self.new_items, self.num_users, start_sec=start_sec, seed=seed,
+                                                   window_sec=60))
+
+
+async def send(client, workload, operation, rng):
+    # (status code, retraining job id or None)
+    if operation == "predict":
+        response = await client.post("/mod/predict", content=rng.choice(workload.predict), headers=JSON_HEADERS)
+    elif operation == "predict_batch":
+        response = await client.post("/mod/predict_batch", content=rng.choice(workload.predict_batch),
+                                     headers=JSON_HEADERS)
+    else:
+        if workload.new_items:
+            await asyncio.to_thread(workload.write_events)
+        response = await client.get("/mod/retrain")
+        if response.status_code == 200:
+            return response.status_code, response.json()["job_id"]
+    return response.status_code, None
+
+
+async def drive(client, workload, mix, concurrency, seconds, warmup_s, seed):
+    """
+    Runs `concurrency` clients for warmup_s (not recorded) and then `seconds`. Returns the latencies and
+    status codes of each operation, the retraining job ids and the measured wall time.
+    """
+    operations, weights = list(mix), list(mix.values())
+    latencies = {op: [] for op in operations}
+    statuses = {op: {} for op in operations}
+    job_ids = []
+    loop = asyncio.get_running_loop()
+    warm_until = loop.time() + warmup_s
+    deadline = warm_until + seconds
+
+    async def run_client(n):
+        rng = random.Random(seed * 1_000_003 + n)
+        while (now := loop.time()) < deadline:
+            operation = rng.choices(operations, weights)[0]
+            start = time.perf_counter()
+            try:
+                status, job_id = await send(client, workload, operation, rng)
+            except Exception as err:
+                status, job_id = type(err).__name__, None
+            elapsed = time.perf_counter() - start
+            if now >= warm_until:
+                latencies[operation].append(elapsed)
+                statuses[operation][str(status)] = statuses[operation].get(str(status), 0) + 1
+                if job_id is not None:
+                    job_ids.append(job_id)
+
+    await asyncio.gather(*(run_client(n) for n in range(concurrency)))
+    # Recorded requests started after warm_until, the last of them has just finished
+    return latencies, statuses, job_ids, loop.time() - warm_until
+
+
+async def drain_jobs(client, job_ids, timeout_s):
+    # Waits for the retraining jobs of the run to finish and returns their final states. The service only keeps
+    # the latest finished jobs, so an unknown job finished and was dropped since
+    deadline = time.monotonic() + timeout_s
+    jobs = {}
+    while True:
+        for job_id in set(job_ids):
+            if jobs.get(job_id, {}).get("status") not in ("done", "failed", "dropped"):
+                response = await client.get(f"/mod/retrain/{job_id}")
+                if response.status_code == 200:
+                    jobs[job_id] = response.json()
+                elif response.status_code == 404:
+                    jobs[job_id] = {"status": "dropped"}
+        if (all(jobs.get(j, {}).get("status") in ("done", "failed", "dropped") for j in job_ids)
+                or time.monotonic() > deadline):
+            return jobs
+        await asyncio.sleep(0.1)
+
+
+def job_summary(jobs, job_ids):
+    finished = [j for j in jobs.values() if j.get("status") in ("done", "failed")]
+    run_s = [j["finished_at"] - j["started_at"] for j in finished if j.get("started_at")]
+    queued_s = [j["started_at"] - j["submitted_at"] for j in finished if j.get("started_at")]
+    # Retrains requested while a job is queued join it, so there can be fewer jobs than requests
+    summary = {"requests": len(job_ids), "jobs": len(set(job_ids)), "done": sum(j["status"] == "done" for j in finished),
+               "failed": sum(j["status"] == "failed" for j in finished),
+               "dropped": sum(j["status"] == "dropped" for j in jobs.values())}
+    summary["unfinished"] = summary["jobs"] - summary["done"] - summary["failed"] - summary["dropped"]
+    for name, values in (("run", run_s), ("queued", queued_s)):
+        if values:
+            summary[f"{name}_p50_s"] = round(float(np.percentile(values, 50)), 4)
+            summary[f"{name}_p95_s"] = round(float(np.percentile(values, 95)), 4)
+            summary[f"{name}_max_s"] = round(float(max(values)), 4)
+    summary["new_transitions"] = sum(j["metrics"].get("new_transitions", 0) for j in finished if j.get("metrics"))
+    return summary
+
+
+async def run_asgi(app, test):
+    import httpx
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=60) as client:
+            return await test(client)
+
+
+async def run_http(app, port, test):
+    import httpx
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="load-test-server", daemon=True)
+    thread.start()
+    try:
+        while not server.started:
+            if not thread.is_alive():
+                raise RuntimeError(f"uvicorn did not start on port {port}")
+            await asyncio.sleep(0.05)
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60, limits=limits) as client:
+            return await test(client)
+    finally:
+        server.should_exit = True
+        await asyncio.to_thread(thread.join, 60)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_load_test(mix, concurrency=64, seconds=10.0, warmup_s=2.0, batch_rows=64, new_items=200, items=20_000,
+                  num_users=1_000, user_ids=False, http=False, port=8790, drain_s=120.0, seed=0):
+    root = tempfile.mkdtemp(prefix="load-test-")
+    api, table = stub_services(root, items=items, num_users=num_users, seed=seed)
+    from src.main import app
+
+    workload = Workload(table, seed=seed, batch_rows=batch_rows, new_items=new_items, num_users=num_users,
+                        user_ids=user_ids)
+
+    async def test(client):
+        latencies, statuses, job_ids, wall = await drive(client, workload, mix, concurrency, seconds, warmup_s, seed)
+        jobs = await drain_jobs(client, job_ids, drain_s) if job_ids else {}
+        return latencies, statuses, job_ids, jobs, wall
+
+    if http:
+        latencies, statuses, job_ids, jobs, wall = asyncio.run(run_http(app, port, test))
+    else:
+        latencies, statuses, job_ids, jobs, wall = asyncio.run(run_asgi(app, test))
+
+    results = {"overall": summarize([x for values in latencies.values() for x in values], wall)}
+    for operation, values in latencies.items():
+        results[operation] = dict(summarize(values, wall), status=statuses[operation])
+        results[operation]["errors"] = sum(n for code, n in statuses[operation].items()
+                                           if not (code.isdigit() and int(code) < 400))
+    results["overall"]["errors"] = sum(results[operation]["errors"] for operation in latencies)
+    if "predict_batch" in results and results["predict_batch"]["requests"]:
+        results["predict_batch"]["rows_per_s"] = round(results["predict_batch"]["throughput_rps"] * batch_rows)
+    if job_ids:
+        results["retrain"]["jobs"] = job_summary(jobs, job_ids)
+
+    settings = {name: getattr(api, name) for name in (
+        "INFERENCE_BACKEND", "INFERENCE_WORKERS", "INFERENCE_TORCH_THREADS", "PREDICT_MAX_BATCH_SIZE",
+        "PREDICT_MAX_WAIT_MS", "USER_EMBEDDING_CACHE_SIZE", "PREDICTION_CACHE_SIZE", "RETRAIN_STEPS",
+        "RETRAIN_BATCH_SIZE", "REPLAY_PRIORITY_ALPHA")}
+    return {
+        "meta": {"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                 "python": platform.python_version(), "torch": torch.__version__, "cpus": os.cpu_count(),
+                 "transport": "http" if http else "asgi", "mix": mix, "concurrency": concurrency,
+                 "seconds": seconds, "warmup_s": warmup_s, "batch_rows": batch_rows, "new_items": new_items,
+                 "items": items, "num_users": num_users, "user_ids": user_ids, "seed": seed, "settings": settings},
+        "results": results,
+    }
+
+
+def compare(before, after):
+    """
+    Change of throughput and latency percentiles per operation from one results file to another, in percent.
+    """
+    changes = {"before": before["meta"].get("commit"), "after": after["meta"].get("commit"),
+               # Runs are only comparable with the same load and settings
+               "differing_config": sorted(k for k in set(before["meta"]) | set(after["meta"])
+                                          if k not in ("commit", "time") and before["meta"].get(k) != after["meta"].get(k))}
+    for operation, old in before["results"].items():
+        new = after["results"].get(operation)
+        if not new:
+            continue
+        row = {}
+        for metric in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "p999_ms"):
+            if old.get(metric) and new.get(metric) is not None:
+                row[metric] = {"before": old[metric], "after": new[metric],
+                               "change_pct": round((new[metric] - old[metric]) / old[metric] * 100, 1)}
+        changes[operation] = row
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("predict=90,predict_batch=9,retrain=1"),
+                        help="operation weights, e.g. predict=90,predict_batch=9,retrain=1")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--warmup-seconds", type=float, default=2.0)
+    parser.add_argument("--batch-rows", type=int, default=64)
+    parser.add_argument("--new-items", type=int, default=200, help="events added to the table before each retrain")
+    parser.add_argument("--items", type=int, default=20_000, help="events in the table at startup")
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--user-ids", action="store_true", help="send user ids (keys of the user embedding cache)")
+    parser.add_argument("--http", action="store_true", help="send requests over TCP to uvicorn")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--drain-seconds", type=float, default=120.0,
+                        help="how long to wait for the run's retraining jobs to finish")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two results files")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            print(json.dumps(compare(json.load(f), json.load(g)), indent=2))
+        return
+
+    results = run_load_test(args.mix, args.concurrency, args.seconds, args.warmup_seconds, args.batch_rows,
+                            args.new_items, args.items, args.users, args.user_ids, args.http, args.port,
+                            args.drain_seconds, args.seed)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
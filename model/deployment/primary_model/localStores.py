@@ -0,0 +1,228 @@
+"""
+In-process stand-ins for the AWS services the deployment service talks to, for benchmarks and local runs.
+They implement only the calls this package makes, with the same signatures and error types as boto3.
+"""
+import bisect
+import hashlib
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import numpy as np
+
+from botocore.exceptions import ClientError
+
+
+def _not_found(operation, key):
+    return ClientError({"Error": {"Code": "404", "Message": f"Not Found: {key}"}}, operation)
+
+
+class LocalObjectStore:
+    """
+    S3 client stand-in that keeps objects as files under root/<bucket>/<key>.
+    latency_s is added to every call to imitate a remote store.
+    """
+
+    def __init__(self, root, latency_s=0.0):
+        self.root = root
+        self.latency_s = latency_s
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _wait(self):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def head_object(self, Bucket, Key):
+        self._wait()
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise _not_found("HeadObject", Key)
+        with open(path, "rb") as f:
+            etag = hashlib.md5(f.read()).hexdigest()
+        return {"ETag": f'"{etag}"', "ContentLength": os.path.getsize(path)}
+
+    def download_fileobj(self, Bucket, Key, Fileobj):
+        self._wait()
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise _not_found("GetObject", Key)
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, Fileobj)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        self._wait()
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".part", "wb") as f:
+            shutil.copyfileobj(Fileobj, f)
+        os.replace(path + ".part", path)
+
+    def list_objects_v2(self, Bucket, Prefix=""):
+        self._wait()
+        bucket_root = os.path.join(self.root, Bucket)
+        contents = []
+        for dirpath, _, filenames in os.walk(bucket_root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, bucket_root).replace(os.sep, "/")
+                if key.startswith(Prefix) and not key.endswith(".part"):
+                    contents.append({"Key": key, "Size": os.path.getsize(path),
+                                     "LastModified": datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)})
+        contents.sort(key=lambda c: c["Key"])
+        return {"Contents": contents, "KeyCount": len(contents), "IsTruncated": False}
+
+    def delete_object(self, Bucket, Key):
+        self._wait()
+        path = self._path(Bucket, Key)
+        if os.path.exists(path):
+            os.remove(path)
+        return {}
+
+
+def _condition_parts(condition):
+    # Flattens a boto3 KeyConditionExpression into (operator, attribute name, values) tuples
+    expression = condition.get_expression()
+    if expression["operator"] == "AND":
+        return [part for sub in expression["values"] for part in _condition_parts(sub)]
+    key, *values = expression["values"]
+    return [(expression["operator"], key.name, values)]
+
+_KEY_OPERATORS = {
+    "=": lambda v, args: v == args[0],
+    "<": lambda v, args: v < args[0],
+    "<=": lambda v, args: v <= args[0],
+    ">": lambda v, args: v > args[0],
+    ">=": lambda v, args: v >= args[0],
+    "BETWEEN": lambda v, args: args[0] <= v <= args[1],
+    "begins_with": lambda v, args: v.startswith(args[0]),
+}
+
+
+class LocalDynamoTable:
+    """
+    DynamoDB resource-layer Table stand-in for the UserStateHx table and its state_type_gsi index.
+
+    query() honours the key condition, ScanIndexForward, Limit and ExclusiveStartKey, and pages like DynamoDB:
+    at most page_items items per response with a LastEvaluatedKey when more remain. latency_s is added per call.
+    put_items() adds items, like the app writing new events while the table is being queried.
+    """
+
+    def __init__(self, items, page_items=1000, latency_s=0.0):
+        self.page_items = page_items
+        self.latency_s = latency_s
+        self._lock = threading.Lock()
+        self._index(items)
+
+    def _index(self, items):
+        items = sorted(items, key=lambda i: (i["sk"], i["user_state_pk"]))
+        keys = [(i["sk"], i["user_state_pk"]) for i in items]
+        with self._lock:
+            self.items, self.keys = items, keys
+
+    def put_items(self, items):
+        self._index(self.items + list(items))
+
+    def _sk_slice(self, keys, op, args):
+        # Index range of the items an sk condition can match, found by bisection on the sorted keys
+        lo, hi = 0, len(keys)
+        if op in (">", ">=", "BETWEEN", "="):
+            first = (args[0], "") if op != ">" else (args[0] + "\0", "")
+            lo = bisect.bisect_left(keys, first)
+        if op in ("<", "<=", "BETWEEN", "="):
+            last = args[-1]
+            hi = bisect.bisect_left(keys, (last, "")) if op == "<" else bisect.bisect_left(keys, (last + "\0", ""))
+        return lo, hi
+
+    def query(self, KeyConditionExpression, IndexName=None, ScanIndexForward=True, Limit=None,
+              ExclusiveStartKey=None, **kwargs):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        with self._lock:
+            items, keys = self.items, self.keys  # one consistent version while items are added
+        parts = _condition_parts(KeyConditionExpression)
+        lo, hi = 0, len(items)
+        for op, name, args in parts:
+            if name == "sk" and op != "begins_with":
+                lo, hi = self._sk_slice(keys, op, args)
+        others = [(op, name, args) for op, name, args in parts if name != "sk" or op == "begins_with"]
+
+        page_size = min(self.page_items, Limit) if Limit else self.page_items
+        if ExclusiveStartKey is not None:
+            start_key = (ExclusiveStartKey["sk"], ExclusiveStartKey["user_state_pk"])
+            position = bisect.bisect_left(keys, start_key)
+            if ScanIndexForward:
+                lo = max(lo, position + 1)
+            else:
+                hi = min(hi, position)
+        positions = range(lo, hi) if ScanIndexForward else range(hi - 1, lo - 1, -1)
+
+        page, more = [], False
+        for n in positions:
+            item = items[n]
+            if all(_KEY_OPERATORS[op](item.get(name), args) for op, name, args in others):
+                if len(page) == page_size:
+                    more = True
+                    break
+                page.append(item)
+
+        response = {"Items": page, "Count": len(page), "ScannedCount": len(page)}
+        if more:
+            last = page[-1]
+            response["LastEvaluatedKey"] = {k: last[k] for k in ("user_state_pk", "sk", "state_type")}
+        return response
+
+
+def synthetic_state_items(n, num_users=100, start_sec=None, seed=0, window_sec=7 * 24 * 60 * 60):
+    """
+    n "state" items shaped like the ones the app writes to UserStateHx (numbers as Decimal, like boto3 returns),
+    spread over num_users users and the window_sec (a week by default) before start_sec.
+    """
+    rng = np.random.default_rng(seed)
+    start_sec = int(time.time()) if start_sec is None else start_sec
+    games = ["math", "memory", "reaction", "sudoku", "trivia"]
+    difficulties = ["easy", "medium", "hard"]
+    sks = np.sort(rng.integers(start_sec - window_sec, start_sec, size=n))
+    users = rng.integers(0, num_users, size=n)
+
+    def dec(x):
+        return Decimal(str(round(float(x), 6)))
+
+    items = []
+    for sk, user in zip(sks, users):
+        game = games[user % len(games)]
+        total_questions = int(rng.integers(1, 1750))
+        total_correct = int(rng.integers(0, total_questions + 1))
+        items.append({
+            "user_state_pk": f"{game.upper()}#user-{user:06d}",
+            "sk": str(sk),
+            "state_type": "state",
+            "prev_is_slow": bool(rng.random() < 0.3),
+            "prev_is_correct": bool(rng.random() < 0.6),
+            "total_questions": Decimal(total_questions),
+            "total_correct": Decimal(total_correct),
+            "percent_correct": dec(total_correct / total_questions),
+            "total_elapsed_time": Decimal(int(rng.integers(0, 10**7))),
+            "average_user_time": dec(rng.random() * 60000),
+            "score": Decimal(int(rng.integers(0, 1000))),
+            "reward_weight": dec(rng.random()),
+            "reward": dec(rng.random() * 2 - 1),
+            "reward_weight_cumulative": dec(rng.random() * 10),
+            "reward_cumulative": dec(rng.random() * 10),
+            "total_weighted_reward": dec(rng.random()),
+            "difficulty": difficulties[int(rng.integers(0, 3))],
+            "predicted_difficulty": Decimal(int(rng.integers(0, 3))),
+            "target_difficulty": Decimal(int(rng.integers(0, 3))),
+            "game_type": game,
+            "category": {"category": game, "total_questions": Decimal(total_questions),
+                         "total_correct": Decimal(total_correct), "percent_correct": dec(rng.random())},
+            "user_embedding": {"easy_percent": dec(rng.random()), "medium_percent": dec(rng.random()),
+                               "hard_percent": dec(rng.random())},
+            "created_at": Decimal(int(sk)),
+            "updated_at": Decimal(int(sk)),
+        })
+    return items
@@ -0,0 +1,233 @@
+import bisect
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+# Upper bounds in seconds, from a cached embedding lookup to a slow request
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+# From a retrain stage with no new items to a long history query
+RETRAIN_BUCKETS = (1e-3, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        lock = self._lock
+        lock.acquire()  # cheaper than `with` on the request path
+        try:
+            self._values[values] = self._values.get(values, 0) + amount
+        finally:
+            lock.release()
+
+    def series(self):
+        with self._lock:
+            return [[list(values), value] for values, value in self._values.items()]
+
+
+class Gauge:
+    """
+    Read when collected, from read(), which returns {label values tuple: value}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), read=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.read = read
+
+    def series(self):
+        return [[list(values), value] for values, value in (self.read() if self.read else {}).items()]
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values per label values, with fixed bucket upper bounds.
+
+    observe() is a bucket bisection and two additions under a lock, well under a microsecond, so it is cheap enough
+    to call several times per request.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [count per bucket (the last one past every bound), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *values):
+        i = bisect.bisect_left(self.buckets, value)
+        lock = self._lock
+        lock.acquire()
+        try:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+        finally:
+            lock.release()
+
+    def series(self):
+        with self._lock:
+            return [[list(values), list(series)] for values, series in self._series.items()]
+
+
+class MetricsRegistry:
+    """
+    A set of metrics, collected as a snapshot: a JSON-serializable dict that render() turns into the Prometheus
+    text exposition format. Snapshots of several processes can be rendered together, see render().
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), read=None):
+        return self.register(Gauge(name, help, labels, read))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def snapshot(self):
+        return {name: {"kind": metric.kind, "help": metric.help, "labels": list(metric.labels),
+                       "buckets": list(getattr(metric, "buckets", ())), "series": metric.series()}
+                for name, metric in self.metrics.items()}
+
+
+def _merge(family, series):
+    # Counters and histograms of several processes add up, gauges keep the highest value
+    merged = {}
+    for values, value in series:
+        key = tuple(values)
+        if key not in merged:
+            merged[key] = list(value) if family["kind"] == "histogram" else value
+        elif family["kind"] == "histogram":
+            merged[key] = [a + b for a, b in zip(merged[key], value)]
+        elif family["kind"] == "counter":
+            merged[key] += value
+        else:
+            merged[key] = max(merged[key], value)
+    return merged
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(*snapshots):
+    """
+    Prometheus text format (version 0.0.4) of one or more snapshots. Series with the same name and label values
+    in several snapshots are merged.
+    """
+    families = {}
+    for snapshot in snapshots:
+        for name, family in snapshot.items():
+            families.setdefault(name, dict(family, series=[]))["series"].extend(family["series"])
+
+    lines = []
+    for name, family in families.items():
+        lines.append(f"# HELP {name} {_escape(family['help'])}")
+        lines.append(f"# TYPE {name} {family['kind']}")
+        names = family["labels"]
+        for values, value in _merge(family, family["series"]).items():
+            if family["kind"] != "histogram":
+                lines.append(f"{name}{_labels(names, values)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(family["buckets"] + [math.inf], value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(names, values, [('le', _number(float(bound)))])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, values)} {_number(float(value[-1]))}")
+            lines.append(f"{name}_count{_labels(names, values)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def write_snapshot(path, snapshot):
+    # Replaced atomically, so a reader never sees a partly written snapshot
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".metrics-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def read_snapshots(directory):
+    snapshots = []
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.endswith(".json"):
+            try:
+                with open(os.path.join(directory, file_name)) as f:
+                    snapshots.append(json.load(f))
+            except FileNotFoundError:
+                pass
+    return snapshots
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting requests by route and status code and errors by route and kind ("client" for 4xx,
+    "server" for 5xx or an exception), and observing request durations by route. Routes are the path templates, e.g. /retrain/{job_id},
+    so the number of series stays bounded.
+    """
+
+    def __init__(self, app, requests, errors, duration):
+        self.app = app
+        self.requests = requests
+        self.errors = errors
+        self.duration = duration
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        except Exception:
+            status = 500
+            raise
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            self.duration.observe(time.perf_counter() - start, route)
+            self.requests.inc(route, str(status))
+            if status >= 400:
+                self.errors.inc(route, "client" if status < 500 else "server")
@@ -0,0 +1,66 @@
+import logging
+import os
+import tempfile
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCache:
+    """
+    Content-addressed local cache of S3 model objects.
+
+    Each object is stored as <cache_dir>/<key with / replaced by __>/<version or ETag>, so a new upload under the
+    same key is downloaded once and an unchanged one never again. If S3 cannot be reached or is too slow (the
+    client's timeouts decide), the most recently used cached copy of the key is served instead.
+
+    client is anything with the boto3 S3 client head_object / download_fileobj methods.
+    """
+
+    def __init__(self, cache_dir, client, bucket="neurobeacon"):
+        self.cache_dir = cache_dir
+        self.client = client
+        self.bucket = bucket
+
+    def _key_dir(self, key):
+        return os.path.join(self.cache_dir, key.strip("/").replace("/", "__"))
+
+    def newest_cached(self, key):
+        key_dir = self._key_dir(key)
+        if not os.path.isdir(key_dir):
+            return None
+        entries = [os.path.join(key_dir, f) for f in os.listdir(key_dir) if not f.startswith(".")]
+        return max(entries, key=os.path.getmtime, default=None)
+
+    def fetch(self, key):
+        """
+        Returns a local path holding the current version of key, downloading it only if it is not cached yet.
+        """
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+            tag = (head.get("VersionId") or head["ETag"]).strip('"')
+            path = os.path.join(self._key_dir(key), tag)
+            if not os.path.exists(path):
+                self._download(key, path)
+        except (BotoCoreError, ClientError) as err:
+            cached = self.newest_cached(key)
+            if cached is None:
+                raise
+            logger.warning(f"Could not fetch s3://{self.bucket}/{key} ({err}), using cached copy {cached}")
+            return cached
+
+        os.utime(path)  # newest_cached goes by last use
+        return path
+
+    def _download(self, key, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Download next to the final path and rename, so a crash never leaves a partial file in the cache
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".download-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                self.client.download_fileobj(self.bucket, key, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
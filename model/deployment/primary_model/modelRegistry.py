@@ -0,0 +1,113 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ModelHandle:
+    """
+    One immutable, servable model version. Requests read registry.active once and keep using that
+    handle, so a swap never changes the model under a request that is already running.
+    """
+    version: str
+    generation: int  # increases on every publish, also after a retrain of the same version
+    model: Any
+    target_model: Any
+    embedder: Any
+    policy: Callable  # numpy (states, user_features, game_types) rows -> actions
+    loaded_at: float
+
+
+class ModelRegistry:
+    """
+    Holds the active ModelHandle and swaps in new versions without a restart.
+
+    build_policy(model, embedder) turns the modules into the serving callable (see INFERENCE_BACKEND).
+    A swap loads and warms the new version in a worker thread, then replaces the active handle with
+    a single reference assignment. on_activate(handle), if given, is called with every handle that becomes
+    active, e.g. to pass it on to other processes.
+    """
+
+    def __init__(self, build_policy, warmup_passes=5, on_activate=None):
+        self.build_policy = build_policy
+        self.warmup_passes = warmup_passes
+        self.on_activate = on_activate
+        self._generation = itertools.count(1)
+        self._active = None
+        self._lock = threading.Lock()  # only taken by publishers, never on the request path
+        self._task = None
+        self.swap_status = {"state": "idle"}
+
+    @property
+    def active(self):
+        return self._active
+
+    def prepare(self, version, model, target_model, embedder, generation=None):
+        # generation is only given for generations numbered by another registry (see sharedWeights)
+        policy = self.build_policy(model, embedder)
+        self.warm_up(policy)
+        generation = next(self._generation) if generation is None else generation
+        return ModelHandle(version=version, generation=generation, model=model,
+                           target_model=target_model, embedder=embedder, policy=policy, loaded_at=time.time())
+
+    def warm_up(self, policy):
+        # A few synthetic passes so the first real requests don't pay for lazy allocations. Caching policies are
+        # warmed without their caches, which synthetic rows would only fill with entries nobody asks for
+        policy = policy.uncached() if hasattr(policy, "uncached") else policy
+        rng = np.random.default_rng(0)
+        for batch_size in [1, 64] * self.warmup_passes:
+            policy(rng.random((batch_size, 8), dtype=np.float32), rng.random((batch_size, 3), dtype=np.float32),
+                   rng.integers(0, 3, size=batch_size))
+
+    def publish(self, version, model, target_model, embedder, replaces=None, generation=None):
+        """
+        Builds and activates a new handle. With replaces, the handle is only activated if replaces is still
+        the active one, so a retrain that started before a swap cannot roll the swap back. Returns the new
+        handle, or None if it was discarded.
+        """
+        handle = self.prepare(version, model, target_model, embedder, generation)
+        return handle if self._activate(handle, replaces) else None
+
+    def _activate(self, handle, replaces=None):
+        with self._lock:
+            if replaces is not None and self._active is not replaces:
+                logger.warning(f"Discarding generation {handle.generation}, the model it was based on is no longer active")
+                return False
+            self._active = handle
+            if self.on_activate is not None:
+                self.on_activate(handle)  # under the lock, so activations are passed on in order
+        return True
+
+    @property
+    def swapping(self):
+        return self._task is not None and not self._task.done()
+
+    def start_swap(self, version, loader):
+        """
+        Loads loader() -> (model, target_model, embedder) in the background and makes it the active version.
+        Returns False if another swap is still running.
+        """
+        if self.swapping:
+            return False
+        self.swap_status = {"state": "loading", "version": version, "started_at": time.time()}
+        self._task = asyncio.create_task(self._swap(version, loader))
+        return True
+
+    async def _swap(self, version, loader):
+        try:
+            handle = await asyncio.to_thread(lambda: self.prepare(version, *loader()))
+        except Exception as err:
+            logger.exception(f"Loading model version {version} failed")
+            self.swap_status = {"state": "failed", "version": version, "error": str(err)}
+            return
+        self._activate(handle)
+        self.swap_status = {"state": "idle", "version": version, "finished_at": time.time()}
+        logger.info(f"Serving model version {version} (generation {handle.generation})")
@@ -0,0 +1,53 @@
+import numpy as np
+
+# Only numpy is imported here so the policy can be served from a bundle without loading torch.
+# Bundle keys are the state_dict keys, prefixed "q." for the Q-network and "embedder." for UserEmbeddingModel.
+
+
+def export_weight_bundle(model_state, embedder_state):
+    """
+    Flattens the Q-network and embedder state_dicts into one dict of float32 numpy arrays.
+    """
+    bundle = {}
+    for prefix, state in (("q.", model_state), ("embedder.", embedder_state)):
+        for name, tensor in state.items():
+            bundle[prefix + name] = tensor.detach().cpu().numpy().astype(np.float32)
+    return bundle
+
+def save_weight_bundle(bundle, path):
+    np.savez(path, **bundle)
+
+def load_weight_bundle(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+class NumpyPolicy:
+    """
+    Greedy policy of QNetworkWithUserEmbedding + UserEmbeddingModel computed with numpy matmuls.
+
+    Takes the same (states (n, 8), user_features (n, 3), game_types (n,)) numpy rows as the torch path
+    and returns the argmax action per row. With embedded=True it takes user embeddings (n, 4) instead of
+    user features and skips the embedder, whose weights the bundle then does not need.
+    """
+
+    def __init__(self, bundle, embedded=False):
+        # Linear layers are stored pre-transposed so the forward pass is x @ W + b
+        self.embedded = embedded
+        if not embedded:
+            self.embed_w = np.ascontiguousarray(bundle["embedder.fc.weight"].T)
+            self.embed_b = bundle["embedder.fc.bias"]
+        self.game_embedding = bundle["q.game_embedding.weight"]
+        self.layers = [(np.ascontiguousarray(bundle[f"q.{fc}.weight"].T), bundle[f"q.{fc}.bias"])
+                       for fc in ("fc1", "fc2", "fc3")]
+
+    def q_values(self, states, user_features, game_types):
+        user_embedding = user_features if self.embedded else user_features @ self.embed_w + self.embed_b
+        x = np.concatenate([states, user_embedding, self.game_embedding[game_types]], axis=1)
+        (w1, b1), (w2, b2), (w3, b3) = self.layers
+        x = np.maximum(x @ w1 + b1, 0)
+        x = np.maximum(x @ w2 + b2, 0)
+        return x @ w3 + b3
+
+    def __call__(self, states, user_features, game_types):
+        return self.q_values(states, user_features, game_types).argmax(axis=1)
@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PredictionCache:
+    """
+    Bounded LRU memo of predicted actions, keyed on the packed float32 input row (8 states, 3 user features,
+    game type) as bytes. Only exact repeats hit, so cached and computed predictions never differ.
+
+    A cache holds the predictions of one model generation: build_policy gives every published policy its own,
+    so a swap or retrain starts from an empty cache and the old one is dropped with the old handle. on_count(event,
+    amount), if given, is told of every change of the hits, misses and evictions counters, so totals can outlive
+    the cache (stats() has this cache's own).
+    """
+
+    def __init__(self, max_entries=100_000, on_count=None):
+        self.max_entries = max_entries
+        self.on_count = on_count
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # packed row -> action
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0, "evictions": self.evictions}
+
+    @staticmethod
+    def keys(states, user_features, game_types):
+        rows = np.empty((len(game_types), states.shape[1] + user_features.shape[1] + 1), dtype=np.float32)
+        rows[:, :states.shape[1]] = states
+        rows[:, states.shape[1]:-1] = user_features
+        rows[:, -1] = game_types
+        return rows.view(f"S{rows.shape[1] * 4}").ravel().tolist()
+
+    def get(self, keys):
+        # (actions with -1 where missing, indices of the missing rows)
+        actions = np.full(len(keys), -1, dtype=np.int64)
+        missing = []
+        entries = self._entries
+        with self._lock:
+            for i, key in enumerate(keys):
+                action = entries.get(key)
+                if action is None:
+                    missing.append(i)
+                else:
+                    entries.move_to_end(key)
+                    actions[i] = action
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        self._count(hits=len(keys) - len(missing), misses=len(missing))
+        return actions, missing
+
+    def _count(self, **amounts):
+        if self.on_count is not None:
+            for event, amount in amounts.items():
+                if amount:
+                    self.on_count(event, amount)
+
+    def put(self, keys, actions):
+        entries = self._entries
+        with self._lock:
+            for key, action in zip(keys, actions.tolist()):
+                entries[key] = action
+                entries.move_to_end(key)
+            evictions = max(len(entries) - self.max_entries, 0)
+            for _ in range(evictions):
+                entries.popitem(last=False)
+            self.evictions += evictions
+        self._count(evictions=evictions)
+
+
+class PredictionCachedPolicy:
+    """
+    Serving policy that answers repeated input rows from a PredictionCache and runs `policy` on the rest only.
+    """
+
+    def __init__(self, policy, cache):
+        self.policy = policy
+        self.cache = cache
+        self.takes_user_ids = getattr(policy, "takes_user_ids", False)
+
+    def uncached(self):
+        # The same policy without its caches, for warm-up passes
+        return self.policy.uncached() if hasattr(self.policy, "uncached") else self.policy
+
+    def __call__(self, states, user_features, game_types, user_ids=None):
+        keys = self.cache.keys(states, user_features, game_types)
+        actions, missing = self.cache.get(keys)
+        if not missing:
+            return actions
+        if len(missing) == len(keys):
+            computed = self.policy(states, user_features, game_types, *(() if user_ids is None else (user_ids,)))
+        else:
+            ids = () if user_ids is None else ([user_ids[i] for i in missing],)
+            computed = self.policy(states[missing], user_features[missing], game_types[missing], *ids)
+        actions[missing] = computed
+        self.cache.put([keys[i] for i in missing], actions[missing])
+        return actions
@@ -0,0 +1,186 @@
+"""
+Pre-fork serving: several uvicorn worker processes on one port, sharing one copy of the model weights.
+
+Run from this directory, e.g.:
+    python prefork.py --workers 4 --host 0.0.0.0 --port 8000
+
+The parent loads the startup models once and publishes them to SharedWeights under SHARED_WEIGHTS_DIR, binds
+the listening socket and forks:
+    - `workers` serving workers, which accept on the shared socket and serve the published weights, mapped
+      read-only, following every generation published after them;
+    - one training process, which owns retraining, swaps and checkpoints. Workers forward /retrain and
+      /admin/swap to it over a queue, and each generation it activates is published to all workers at once.
+Every process shares a snapshot of its metrics under SHARED_WEIGHTS_DIR/metrics, so /metrics on any worker
+reports the whole service.
+The parent forks before running any inference or starting any thread, and afterwards only supervises: on
+SIGTERM or SIGINT it stops the children, and if one of them exits on its own it stops the rest and exits too.
+"""
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+from dataclasses import dataclass
+from typing import Any
+
+import torch
+
+from inferenceExecutor import configure_interop_threads
+from sharedWeights import SharedWeights
+from trainingWorker import SharedJobs
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PreforkRole:
+    role: str  # "worker" or "trainer"
+    shared_weights: SharedWeights
+    control: Any  # multiprocessing queue of (kind, argument) messages to the trainer
+    jobs: SharedJobs
+    metrics_dir: str  # every process writes a snapshot of its metrics here, /metrics renders them all
+    startup: tuple | None = None  # (version, model, target_model, embedder), the trainer starts from these
+
+
+def available_cpus():
+    """
+    Cores this process may actually use: the CPUs it is pinned to, capped by a cgroup CPU quota (a container's
+    --cpus) if there is one. os.cpu_count() counts every core of the host.
+    """
+    cpus = len(os.sched_getaffinity(0))
+    for quota_file, period_file in (("/sys/fs/cgroup/cpu.max", None),  # cgroup v2: "<quota|max> <period>"
+                                    ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us")):
+        try:
+            with open(quota_file) as f:
+                quota, _, period = f.read().strip().partition(" ")
+            if period_file is not None:
+                with open(period_file) as f:
+                    period = f.read().strip()
+        except OSError:
+            continue
+        if quota not in ("max", "-1"):
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+        break
+    return cpus
+
+
+def fork(target):
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 1
+    try:
+        target()
+        code = 0
+    except BaseException:
+        logger.exception(f"Pre-fork child {os.getpid()} failed")
+    finally:
+        os._exit(code)
+
+
+def run_worker(api, app, sock, role, threads, log_level):
+    import uvicorn
+
+    api.prefork = role
+    # The workers share the cores instead of each using all of them; inference threads use INFERENCE_TORCH_THREADS
+    torch.set_num_threads(threads)
+    uvicorn.Server(uvicorn.Config(app, log_level=log_level)).run(sockets=[sock])
+
+
+def run_trainer(api, sock, role):
+    sock.close()
+    api.prefork = role
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        async with api.lifespan_mechanism(api.sub_application_pickl_test):
+            await api.serve_control(stop)
+
+    asyncio.run(main())
+
+
+def serve(workers, host="0.0.0.0", port=8000, log_level="info"):
+    import src.pickl_fastapi as api
+    from src.main import app
+
+    shared_weights = SharedWeights(api.SHARED_WEIGHTS_DIR)
+    control = multiprocessing.get_context("fork").Queue()
+    jobs = SharedJobs(os.path.join(api.SHARED_WEIGHTS_DIR, "jobs"), control)
+    metrics_dir = os.path.join(api.SHARED_WEIGHTS_DIR, "metrics")
+    shutil.rmtree(metrics_dir, ignore_errors=True)  # the snapshots of a previous run's processes
+    os.makedirs(metrics_dir)
+
+    # Loaded once, here: the trainer inherits these modules and the workers map their published copy
+    configure_interop_threads(api.TORCH_INTEROP_THREADS)  # before torch does any work, the children inherit it
+    api.open_model_stores()
+    startup = api.load_startup_models()
+    shared_weights.publish(startup[0], 1, *startup[1:])
+
+    # With the protocol given explicitly asyncio sets TCP_NODELAY on accepted connections, otherwise a response's
+    # body waits for the client to ACK its headers
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+
+    threads = max(1, available_cpus() // workers)
+    children = [fork(lambda: run_worker(api, app, sock,
+                                        PreforkRole("worker", shared_weights, control, jobs, metrics_dir),
+                                        threads, log_level))
+                for _ in range(workers)]
+    children.append(fork(lambda: run_trainer(api, sock, PreforkRole("trainer", shared_weights, control, jobs,
+                                                                     metrics_dir, startup))))
+    sock.close()
+    logger.info(f"Serving on {host}:{port} with {workers} workers and a training process (pids {children})")
+    return supervise(children)
+
+
+def supervise(children):
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    code = 0
+    remaining = set(children)
+    while remaining:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        remaining.discard(pid)
+        if not stopping:
+            logger.error(f"Pre-fork child {pid} exited with status {os.waitstatus_to_exitcode(status)}, stopping")
+            code = 1
+            stop()
+    return code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("PREFORK_WORKERS") or available_cpus()))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+    raise SystemExit(serve(args.workers, args.host, args.port, args.log_level))
+
+
+if __name__ == "__main__":
+    main()
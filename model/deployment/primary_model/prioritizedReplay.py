@@ -0,0 +1,120 @@
+import numpy as np
+
+
+class SumTree:
+    """
+    Binary tree of priorities in one flat array, each node holding the sum of its children, with capacity leaves
+    rounded up to a power of two. Batches of updates and prefix-sum lookups are vectorized over the batch and
+    take one pass per tree level, so both are O(log capacity) per element.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.leaves = 1 << max(capacity - 1, 1).bit_length()
+        self.depth = self.leaves.bit_length() - 1
+        self.nodes = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.nodes[1]
+
+    def __getitem__(self, positions):
+        return self.nodes[np.asarray(positions) + self.leaves]
+
+    def update(self, positions, priorities):
+        # With repeated positions the last priority wins, like a sequence of single updates
+        nodes = np.asarray(positions) + self.leaves
+        self.nodes[nodes] = priorities
+        if len(nodes) > self.leaves // 64:
+            self.rebuild()
+            return
+        for _ in range(self.depth):
+            # Children are final by the time a level is summed, so parents shared by several nodes
+            # are just written more than once with the same value
+            nodes //= 2
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+
+    def rebuild(self):
+        # Recomputes every internal node from the leaves, level by level
+        width = self.leaves
+        while width > 1:
+            children = self.nodes[width:2 * width]
+            self.nodes[width // 2:width] = children[0::2] + children[1::2]
+            width //= 2
+
+    def find(self, values):
+        """
+        Leaf positions whose priority interval [prefix sum, prefix sum + priority) contains each value.
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.leaves:
+            left = 2 * nodes
+            go_right = (values >= self.nodes[left]) & (self.nodes[left + 1] > 0)  # rounding can overshoot
+            values -= np.where(go_right, self.nodes[left], 0.0)
+            nodes = left + go_right
+        return nodes - self.leaves
+
+
+class PrioritizedReplay:
+    """
+    Proportional prioritized sampling over a ReplayBuffer: a transition is drawn with probability p^alpha / sum,
+    where p is its last |TD error| + eps. New transitions get the highest priority seen so far, so each is
+    likely to be trained on at least once.
+
+    sample() returns the batch, its buffer positions and importance-sampling weights (N * P)^-beta, normalised by
+    the batch maximum; pass the weights to train() and its TD errors back to update_priorities().
+
+    It stands in for the buffer as the store of an IncrementalTransitionBuilder. Priorities are kept in memory
+    only; after a restart every stored transition starts again at the same priority.
+    """
+
+    def __init__(self, buffer, alpha=0.6, beta=0.4, eps=1e-3):
+        self.buffer = buffer
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.tree = SumTree(buffer.capacity)
+        self.max_priority = 1.0
+        self._reset()
+
+    def _reset(self):
+        self.tree.nodes[:] = 0.0
+        if len(self.buffer):
+            self.tree.update(self.buffer.positions(np.arange(len(self.buffer))), self.max_priority)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    @property
+    def watermark(self):
+        return self.buffer.watermark
+
+    def append(self, transitions, watermark=None):
+        self.buffer.append(transitions, watermark)
+        self.tree.update(self.buffer.newest(), self.max_priority)
+
+    def discard_after(self, watermark):
+        self.buffer.discard_after(watermark)
+        self._reset()
+
+    def sample(self, batch_size, rng=None):
+        """
+        (batch, positions, weights): batch_size transitions, one from each of batch_size equal slices of the
+        total priority, with their float32 importance-sampling weights.
+        """
+        if len(self) == 0:
+            raise ValueError('Cannot sample from an empty replay buffer')
+        rng = np.random.default_rng() if rng is None else rng
+        total = self.tree.total
+        values = (np.arange(batch_size) + rng.random(batch_size)) * (total / batch_size)
+        positions = self.tree.find(np.minimum(values, np.nextafter(total, 0)))
+
+        probabilities = self.tree[positions] / total
+        weights = (len(self) * probabilities) ** -self.beta
+        return self.buffer.gather(positions), positions, (weights / weights.max()).astype(np.float32)
+
+    def update_priorities(self, positions, td_errors):
+        priorities = (np.abs(np.asarray(td_errors, dtype=np.float64)) + self.eps) ** self.alpha
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(positions, priorities)
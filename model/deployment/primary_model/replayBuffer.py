@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+
+# Index of each counter in the buffer's meta array
+_SIZE, _CURSOR, _WATERMARK, _PREV_SIZE, _PREV_CURSOR, _PREV_WATERMARK, _LAST_COUNT = range(7)
+
+
+class ReplayBuffer:
+    """
+    Fixed-capacity ring buffer of transitions in preallocated numpy arrays, each memory-mapped from a .npy file
+    under root, so the buffer survives restarts and other processes can map it read-only (readonly=True).
+
+    Columns: float32 states / next_states (capacity, 8), float32 user / next_user (capacity, embedding_dim),
+    float32 reward and int8 action, game_type and next_game_type. Appending writes in place and overwrites
+    the oldest transitions once the buffer is full; sampling is uniform over the stored transitions.
+
+    It can be the store of an IncrementalTransitionBuilder: append() records the ingestion watermark next to the
+    counters and discard_after() undoes the last append if the builder never persisted its watermark.
+    Readers in other processes see the counters move only after the rows are written, but a row being
+    overwritten at the ring boundary can be read mid-write.
+    """
+
+    def __init__(self, root, capacity=1_000_000, embedding_dim=4, num_states=8, readonly=False):
+        self.root = root
+        self.readonly = readonly
+        shapes = {
+            'states': (np.float32, (num_states,)),
+            'action': (np.int8, ()),
+            'reward': (np.float32, ()),
+            'user': (np.float32, (embedding_dim,)),
+            'game_type': (np.int8, ()),
+            'next_states': (np.float32, (num_states,)),
+            'next_user': (np.float32, (embedding_dim,)),
+            'next_game_type': (np.int8, ()),
+        }
+        if not readonly:
+            os.makedirs(root, exist_ok=True)
+        self.meta = self._open('meta', np.int64, (7,))
+        self.columns = {}
+        for name, (dtype, shape) in shapes.items():
+            self.columns[name] = self._open(name, dtype, (capacity,) + shape)
+        self.capacity = len(self.columns['action'])
+
+    def _open(self, name, dtype, shape):
+        # Existing files keep their shape, so a buffer reopens with the capacity it was created with
+        path = os.path.join(self.root, f'{name}.npy')
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r' if self.readonly else 'r+')
+        if self.readonly:
+            raise FileNotFoundError(path)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    def __len__(self):
+        return int(self.meta[_SIZE])
+
+    @property
+    def watermark(self):
+        watermark = int(self.meta[_WATERMARK])
+        return str(watermark) if watermark else None
+
+    def append(self, transitions, watermark=None):
+        """
+        Writes a batch of transitions ({column: array}, as buildTransitions returns) at the cursor, in at most
+        two slices when it wraps around. Only the newest capacity rows of an oversized batch are kept.
+        """
+        count = len(transitions['action'])
+        start = count - min(count, self.capacity)
+        cursor = int(self.meta[_CURSOR])
+        first = min(count - start, self.capacity - cursor)
+        for name, column in self.columns.items():
+            values = np.asarray(transitions[name])
+            column[cursor:cursor + first] = values[start:start + first]
+            column[:count - start - first] = values[start + first:]
+        self.flush()
+
+        self.meta[[_PREV_SIZE, _PREV_CURSOR, _PREV_WATERMARK]] = self.meta[[_SIZE, _CURSOR, _WATERMARK]]
+        self.meta[_LAST_COUNT] = count - start
+        self.meta[_CURSOR] = (cursor + count - start) % self.capacity
+        self.meta[_SIZE] = min(int(self.meta[_SIZE]) + count - start, self.capacity)
+        if watermark is not None:
+            self.meta[_WATERMARK] = int(watermark)
+        self.meta.flush()
+
+    def discard_after(self, watermark):
+        # Rolls back an append whose ingestion watermark was never persisted. The rows it overwrote are lost,
+        # so only the counters go back and the ring keeps fewer valid transitions. Without any persisted
+        # watermark the ingestion starts over, so the buffer is emptied.
+        if watermark is None:
+            self.meta[:] = 0
+            self.meta.flush()
+        elif self.watermark is not None and int(self.watermark) > int(watermark):
+            size, written = int(self.meta[_PREV_SIZE]), int(self.meta[_LAST_COUNT])
+            overwritten = max(size + written - self.capacity, 0)
+            self.meta[_SIZE] = max(size - overwritten, 0)
+            self.meta[_CURSOR] = self.meta[_PREV_CURSOR]
+            self.meta[_LAST_COUNT] = 0
+            self.meta[_WATERMARK] = self.meta[_PREV_WATERMARK]
+            self.meta.flush()
+
+    def flush(self):
+        for column in self.columns.values():
+            column.flush()
+
+    def positions(self, offsets):
+        # Row positions of the stored transitions at offsets from the oldest one
+        return (np.asarray(offsets) + (int(self.meta[_CURSOR]) - len(self))) % self.capacity
+
+    def newest(self, count=None):
+        # Row positions of the last append's transitions (or the newest count)
+        count = int(self.meta[_LAST_COUNT]) if count is None else count
+        return self.positions(np.arange(len(self) - count, len(self)))
+
+    def sample(self, batch_size, rng=None):
+        """
+        batch_size transitions drawn uniformly with replacement, as {column: array} copies.
+        """
+        if len(self) == 0:
+            raise ValueError('Cannot sample from an empty replay buffer')
+        rng = np.random.default_rng() if rng is None else rng
+        return self.gather(self.positions(rng.integers(0, len(self), size=batch_size)))
+
+    def gather(self, positions):
+        return {name: column[positions] for name, column in self.columns.items()}
@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from customModel import QNetworkWithUserEmbedding, UserEmbeddingModel
+
+_ALIGN = 64  # every tensor starts on a cache line
+
+
+class SharedWeights:
+    """
+    Model generations handed from one process to many through memory-mapped weight files.
+
+    publish() writes the Q-network, target network and user embedder of a generation into one file under root
+    and then atomically replaces the `current.json` manifest naming it, so a reader sees either the previous
+    generation or the complete new one. Each publish gets the next `sequence` number, which readers compare to
+    tell whether anything changed. On a tmpfs such as /dev/shm the file lives in shared memory.
+
+    attach() maps a generation read-only and builds the modules on top of the mapping: their parameters are
+    the mapped pages themselves, so every process serving that generation shares one copy of the weights.
+    The files of the newest `keep` generations are kept, so a reader that has just read the manifest can
+    still open the file it names.
+    """
+
+    PARTS = ("model", "target_model", "embedder")
+
+    def __init__(self, root, keep=3):
+        self.root = root
+        self.keep = max(keep, 1)
+        self.manifest_path = os.path.join(root, "current.json")
+        self._stat = None
+        self._manifest = None
+        os.makedirs(root, exist_ok=True)
+
+    def publish(self, version, generation, model, target_model, embedder):
+        """
+        Publishes the modules of a generation and returns its manifest.
+        """
+        current = self.current()
+        sequence = 1 if current is None else current["sequence"] + 1
+
+        tensors, offset = [], 0
+        for part, module in zip(self.PARTS, (model, target_model, embedder)):
+            for name, tensor in module.state_dict().items():
+                array = tensor.detach().cpu().numpy()
+                tensors.append((f"{part}.{name}", array, offset))
+                offset += -(-array.nbytes // _ALIGN) * _ALIGN
+
+        # Written under a temporary name and renamed, so an existing file is never changed under its readers
+        file_name = f"weights-{sequence:010d}.bin"
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".weights-")
+        with os.fdopen(fd, "wb") as f:
+            f.truncate(max(offset, 1))
+            for _, array, start in tensors:
+                f.seek(start)
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(tmp_path, os.path.join(self.root, file_name))
+
+        manifest = {"version": version, "generation": generation, "sequence": sequence, "file": file_name,
+                    "published_at": time.time(),
+                    "tensors": [[name, array.dtype.str, list(array.shape), start] for name, array, start in tensors]}
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".current-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+        self.collect_garbage()
+        return manifest
+
+    def collect_garbage(self):
+        files = sorted(f for f in os.listdir(self.root) if f.startswith("weights-"))
+        for file_name in files[:-self.keep]:
+            os.remove(os.path.join(self.root, file_name))
+
+    def current(self):
+        """
+        The manifest of the newest published generation, or None. Only re-read when the manifest file changed.
+        """
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key != self._stat:
+            with open(self.manifest_path) as f:
+                self._manifest = json.load(f)
+            self._stat = key
+        return self._manifest
+
+    def tensors(self, manifest):
+        # {part: state_dict} of read-only tensors backed by the generation's mapped file
+        data = np.memmap(os.path.join(self.root, manifest["file"]), dtype=np.uint8, mode="r")
+        states = {part: {} for part in self.PARTS}
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)  # torch warns that the arrays are not writable
+            for name, dtype, shape, start in manifest["tensors"]:
+                dtype = np.dtype(dtype)
+                count = int(np.prod(shape, dtype=np.int64))
+                array = data[start:start + count * dtype.itemsize].view(dtype).reshape(shape)
+                part, key = name.split(".", 1)
+                states[part][key] = torch.from_numpy(array)
+        return states
+
+    def attach(self, manifest):
+        """
+        (model, target_model, embedder) of a published generation, frozen, with parameters on the shared mapping.
+        """
+        states = self.tensors(manifest)
+        num_game_types = states["model"]["game_embedding.weight"].shape[0]
+        embedding_dim, input_size = states["embedder"]["fc.weight"].shape
+        modules = (QNetworkWithUserEmbedding(num_game_types=num_game_types, num_state_variables=8, num_actions=3),
+                   QNetworkWithUserEmbedding(num_game_types=num_game_types, num_state_variables=8, num_actions=3),
+                   UserEmbeddingModel(input_size, embedding_dim))
+        for part, module in zip(self.PARTS, modules):
+            module.load_state_dict(states[part], assign=True)  # use the mapped tensors instead of copying them
+            module.eval().requires_grad_(False)
+        return modules
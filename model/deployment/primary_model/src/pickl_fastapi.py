@@ -1,12 +1,14 @@
 ## Lab 3
+import asyncio
 import logging
+import queue
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Header, HTTPException, Response
+from fastapi.responses import PlainTextResponse
 from joblib import load
-from pydantic import BaseModel, ConfigDict, Field, field_validator
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, field_validator, model_validator
 
-import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader, TensorDataset
@@ -14,11 +16,33 @@ import time
 import statistics
 import os
 import io
-import boto3
-import pandas as pd
-
-from customModel import UserEmbeddingModel, load_s3_object, QNetworkWithUserEmbedding, train, create_dataloader
-from dynamoFunctions import query_gsi, processIntoDataframeRolling, processIntoDataframe
+import base64
+import binascii
+import copy
+import hmac
+import weakref
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError, ClientError
+
+from customModel import (load_s3_object, load_user_embedder, save_user_embedder, embedder_path,
+                         QNetworkWithUserEmbedding, train_steps, transition_tensors, TransitionBatches, compile_policy,
+                         get_s3_client, FusedPolicy, TorchPolicy)
+from batchInference import MicroBatcher
+from inferenceExecutor import InferenceExecutor, configure_interop_threads
+from numpyPolicy import NumpyPolicy, export_weight_bundle
+from modelCache import ModelCache
+from modelRegistry import ModelRegistry
+from trainingWorker import TrainingWorker
+from weightBuffers import DoubleBufferedWeights
+from transitionStore import IncrementalTransitionBuilder
+from replayBuffer import ReplayBuffer
+from prioritizedReplay import PrioritizedReplay
+from targetSync import TargetSync
+from checkpointer import Checkpointer
+from embeddingCache import EmbeddingCache, EmbeddingCachedPolicy
+from predictionCache import PredictionCache, PredictionCachedPolicy
+from metrics import MetricsRegistry, MetricsMiddleware, RETRAIN_BUCKETS, render, read_snapshots, write_snapshot
+from dynamoFunctions import processIntoDataframeRolling, get_dynamo_resource
 
 
 
@@ -28,6 +52,115 @@ from os import getenv
 
 logger = logging.getLogger(__name__)
 
+# Micro-batching of concurrent /predict calls, a max batch size of 1 disables it
+PREDICT_MAX_BATCH_SIZE = int(getenv("PREDICT_MAX_BATCH_SIZE", "64"))
+PREDICT_MAX_WAIT_MS = float(getenv("PREDICT_MAX_WAIT_MS", "2"))
+PREDICT_BATCH_MAX_ROWS = int(getenv("PREDICT_BATCH_MAX_ROWS", "8192"))
+
+# Inference runs on INFERENCE_WORKERS threads off the event loop (0 runs it on the loop), each using
+# INFERENCE_TORCH_THREADS intra-op threads; TORCH_INTEROP_THREADS sizes torch's inter-op pool
+INFERENCE_WORKERS = int(getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_TORCH_THREADS = int(getenv("INFERENCE_TORCH_THREADS", "1"))
+TORCH_INTEROP_THREADS = int(getenv("TORCH_INTEROP_THREADS", "1"))
+
+MODEL_PATH = getenv("MODEL_PATH", "tst/models/primary_model_Mar_31.pt")
+# POST /admin/swap needs an "Authorization: Bearer <ADMIN_TOKEN>" header, and is disabled without an ADMIN_TOKEN
+ADMIN_TOKEN = getenv("ADMIN_TOKEN", "")
+MODEL_CACHE_DIR = getenv("MODEL_CACHE_DIR", "/tmp/neurobeacon-model-cache")
+
+# The user embedder is loaded from USER_EMBEDDER_PATH, by default the artifact next to the model
+# (primary_model.pt -> primary_model.embedder.pt), or initialised from USER_EMBEDDER_SEED if there is none.
+# USER_EMBEDDER_TRAINING "joint" trains it together with the Q-network on raw user features, "frozen" keeps it fixed
+USER_EMBEDDER_PATH = getenv("USER_EMBEDDER_PATH") or embedder_path(MODEL_PATH)
+USER_EMBEDDER_SEED = int(getenv("USER_EMBEDDER_SEED", "0"))
+USER_EMBEDDER_TRAINING = getenv("USER_EMBEDDER_TRAINING", "frozen")
+
+# Number of sk sub-ranges the retrain history query fetches in parallel
+RETRAIN_QUERY_WORKERS = int(getenv("RETRAIN_QUERY_WORKERS", "4"))
+
+# Where retraining keeps its transitions and ingestion watermark between retrains and restarts
+TRANSITION_STORE_DIR = getenv("TRANSITION_STORE_DIR", "/tmp/neurobeacon-transitions")
+# Each retrain re-reads the events of the RETRAIN_INGEST_OVERLAP_S before its watermark, for ones written within
+# the watermark's second or late on the GSI
+RETRAIN_INGEST_OVERLAP_S = int(getenv("RETRAIN_INGEST_OVERLAP_S", "60"))
+# Transitions kept in the replay buffer, the oldest are overwritten first
+REPLAY_BUFFER_CAPACITY = int(getenv("REPLAY_BUFFER_CAPACITY", "1000000"))
+# Prioritized replay: sampling probability ~ |TD error|^alpha, importance-sampling correction ^beta.
+# An alpha of 0 samples the replay buffer uniformly
+REPLAY_PRIORITY_ALPHA = float(getenv("REPLAY_PRIORITY_ALPHA", "0.6"))
+REPLAY_PRIORITY_BETA = float(getenv("REPLAY_PRIORITY_BETA", "0.4"))
+
+# Gradient steps per /retrain, each on a fresh batch from the replay buffer
+RETRAIN_STEPS = int(getenv("RETRAIN_STEPS", "1"))
+RETRAIN_BATCH_SIZE = int(getenv("RETRAIN_BATCH_SIZE", "10"))
+
+# How the target network follows training: "hard" copies the weights every TARGET_SYNC_EVERY gradient steps,
+# "polyak" moves it by TARGET_SYNC_TAU towards them on every step, "none" keeps the loaded target
+TARGET_SYNC = getenv("TARGET_SYNC", "hard")
+TARGET_SYNC_EVERY = int(getenv("TARGET_SYNC_EVERY", "100"))
+TARGET_SYNC_TAU = float(getenv("TARGET_SYNC_TAU", "0.005"))
+
+# Retrained weights are checkpointed under CHECKPOINT_PREFIX (empty to disable) at most every
+# CHECKPOINT_MIN_INTERVAL_S, keeping the newest CHECKPOINT_KEEP per model version, and resumed from on startup
+CHECKPOINT_PREFIX = getenv("CHECKPOINT_PREFIX", "checkpoints")
+CHECKPOINT_MIN_INTERVAL_S = float(getenv("CHECKPOINT_MIN_INTERVAL_S", "60"))
+CHECKPOINT_KEEP = int(getenv("CHECKPOINT_KEEP", "5"))
+
+# "eager" runs the modules as-is, "compiled" runs embedder + Q-network as one traced graph,
+# "numpy" runs the same network on exported weights with numpy matmuls
+INFERENCE_BACKEND = getenv("INFERENCE_BACKEND", "eager")
+
+# User embeddings are cached per user id (or per user features rounded to USER_EMBEDDING_CACHE_DECIMALS places),
+# at most USER_EMBEDDING_CACHE_SIZE of them (0, the default, disables it) for up to USER_EMBEDDING_CACHE_TTL_S
+USER_EMBEDDING_CACHE_SIZE = int(getenv("USER_EMBEDDING_CACHE_SIZE", "0"))
+USER_EMBEDDING_CACHE_TTL_S = float(getenv("USER_EMBEDDING_CACHE_TTL_S", "300"))
+USER_EMBEDDING_CACHE_DECIMALS = int(getenv("USER_EMBEDDING_CACHE_DECIMALS", "4"))
+
+# Predictions of exactly repeated input rows are memoized per model generation, at most PREDICTION_CACHE_SIZE
+# of them (0, the default, disables it)
+PREDICTION_CACHE_SIZE = int(getenv("PREDICTION_CACHE_SIZE", "0"))
+
+# Pre-fork serving (see prefork.py): generations are published to memory-mapped weight files under
+# SHARED_WEIGHTS_DIR, which the serving workers check for a new one every SHARED_WEIGHTS_POLL_S
+SHARED_WEIGHTS_DIR = getenv("SHARED_WEIGHTS_DIR", "/dev/shm/neurobeacon-weights")
+SHARED_WEIGHTS_POLL_S = float(getenv("SHARED_WEIGHTS_POLL_S", "0.5"))
+
+# How often a pre-fork worker shares its metrics with the others, so any of them can serve /metrics for all
+METRICS_SHARE_INTERVAL_S = float(getenv("METRICS_SHARE_INTERVAL_S", "1"))
+
+# Metrics served on /metrics (see metrics.py). /predict stages are observed per call: validation and
+# serialization per request, forward (the whole policy call) per micro-batch or /predict_batch call. The
+# embedding stage is the user embedding cache lookup within forward; without the cache the embedder runs inside
+# the fused forward pass and is not timed on its own
+serving_metrics = MetricsRegistry()
+http_requests = serving_metrics.counter("neurobeacon_http_requests_total", "Requests by route and status code",
+                                        ("route", "code"))
+http_errors = serving_metrics.counter("neurobeacon_http_errors_total",
+                                      "Failed requests by route and kind (client for 4xx, server for 5xx)",
+                                      ("route", "kind"))
+http_duration = serving_metrics.histogram("neurobeacon_http_request_duration_seconds", "Request duration by route",
+                                          ("route",))
+predict_stage_seconds = serving_metrics.histogram("neurobeacon_predict_stage_seconds",
+                                                  "Duration of the /predict and /predict_batch stages", ("stage",))
+cache_hits = serving_metrics.counter("neurobeacon_cache_hits_total", "Rows found in a serving cache, by cache", ("cache",))
+cache_misses = serving_metrics.counter("neurobeacon_cache_misses_total", "Rows not found in a serving cache, by cache",
+                                       ("cache",))
+cache_evictions = serving_metrics.counter("neurobeacon_cache_evictions_total",
+                                          "Entries evicted from a full serving cache, by cache", ("cache",))
+cache_invalidations = serving_metrics.counter("neurobeacon_cache_invalidations_total",
+                                              "Serving cache clears after a weight change, by cache", ("cache",))
+model_generation = serving_metrics.gauge("neurobeacon_model_generation", "Generation of the model served, by version",
+                                         ("version",), read=lambda: served_model())
+training_metrics = MetricsRegistry()
+retrain_stage_seconds = training_metrics.histogram("neurobeacon_retrain_stage_seconds",
+                                                   "Duration of the retraining stages", ("stage",), RETRAIN_BUCKETS)
+retrains = training_metrics.counter("neurobeacon_retrains_total", "Finished retraining jobs by status", ("status",))
+
+NUM_STATES = 8
+NUM_USER_FEATURES = 3
+NUM_GAME_TYPES = 5
+PACKED_ROW_WIDTH = NUM_STATES + NUM_USER_FEATURES + 1
+
 
 
 
@@ -38,6 +171,16 @@ class state_vars(BaseModel):
     states: list[float]
     user_features: list[float]
     game_type: int
+    user_id: str | None = None
+
+    @model_validator(mode='wrap')
+    @classmethod
+    def timedValidation(cls, data, handler):
+        start = time.perf_counter()
+        try:
+            return handler(data)
+        finally:
+            predict_stage_seconds.observe(time.perf_counter() - start, "validation")
 
     @field_validator('states')
     @classmethod
@@ -48,11 +191,97 @@ class state_vars(BaseModel):
     
     @field_validator('user_features')
     @classmethod
-    def validStates(cls, s: list[float]) -> list[float]:
+    def validUserFeatures(cls, s: list[float]) -> list[float]:
         if len(s) != 3:
             raise ValueError('Incorrect Number of user features')
         return s
 
+    @field_validator('game_type')
+    @classmethod
+    def validGameType(cls, g: int) -> int:
+        if not 0 <= g < NUM_GAME_TYPES:
+            raise ValueError('Unknown game type')
+        return g
+
+
+## Request Models For Batch Prediction
+class batch_state_vars(BaseModel):
+    """
+    Columnar batch of prediction inputs, given either as three parallel arrays or as `packed`:
+    a base64 encoded little-endian float32 buffer of rows of 12 values (8 states, 3 user features, game type).
+    Optional user_ids (one id or null per row) key the user embedding cache.
+
+    Shapes are checked once on the whole batch, the validated numpy arrays are available from `arrays`.
+    """
+    model_config = {"extra": "forbid"}
+
+    states: list[list[float]] | None = None
+    user_features: list[list[float]] | None = None
+    game_type: list[int] | None = None
+    packed: str | None = None
+    user_ids: list[str | None] | None = None
+
+    _arrays: tuple = PrivateAttr(default=None)
+
+    @model_validator(mode='wrap')
+    @classmethod
+    def timedValidation(cls, data, handler):
+        start = time.perf_counter()
+        try:
+            return handler(data)
+        finally:
+            predict_stage_seconds.observe(time.perf_counter() - start, "validation")
+
+    @model_validator(mode='after')
+    def validShapes(self):
+        columns = (self.states, self.user_features, self.game_type)
+        if self.packed is not None:
+            if any(c is not None for c in columns):
+                raise ValueError('Give either packed or states/user_features/game_type, not both')
+            try:
+                buffer = np.frombuffer(base64.b64decode(self.packed, validate=True), dtype='<f4')
+            except (binascii.Error, ValueError):
+                raise ValueError('packed is not a base64 encoded float32 buffer')
+            if buffer.size % PACKED_ROW_WIDTH:
+                raise ValueError(f'packed must hold rows of {PACKED_ROW_WIDTH} values')
+            rows = buffer.reshape(-1, PACKED_ROW_WIDTH)
+            states = rows[:, :NUM_STATES].copy()  # writable, contiguous copies of the read-only buffer
+            user_features = rows[:, NUM_STATES:-1].copy()
+            game_type = rows[:, -1].astype(np.int64)
+            if not np.array_equal(game_type, rows[:, -1]):
+                raise ValueError('Game types must be whole numbers')
+        else:
+            if any(c is None for c in columns):
+                raise ValueError('states, user_features and game_type are all required')
+            try:
+                states = np.array(self.states, dtype=np.float32)
+                user_features = np.array(self.user_features, dtype=np.float32)
+            except ValueError:  # ragged rows
+                raise ValueError('Every row must have the same number of values')
+            game_type = np.array(self.game_type, dtype=np.int64)
+
+        if len(game_type) == 0:
+            raise ValueError('Batch is empty')
+        if len(game_type) > PREDICT_BATCH_MAX_ROWS:
+            raise ValueError(f'Batch is larger than {PREDICT_BATCH_MAX_ROWS} rows')
+        if states.ndim != 2 or states.shape[1] != NUM_STATES:
+            raise ValueError('Incorrect Number of states')
+        if user_features.ndim != 2 or user_features.shape[1] != NUM_USER_FEATURES:
+            raise ValueError('Incorrect Number of user features')
+        if not len(states) == len(user_features) == len(game_type):
+            raise ValueError('states, user_features and game_type must have the same length')
+        if self.user_ids is not None and len(self.user_ids) != len(game_type):
+            raise ValueError('user_ids must have one entry per row')
+        if ((game_type < 0) | (game_type >= NUM_GAME_TYPES)).any():
+            raise ValueError('Unknown game type')
+
+        self._arrays = (states, user_features, game_type)
+        return self
+
+    @property
+    def arrays(self):
+        return self._arrays
+
 
 class Difficulty(BaseModel):
     model_config = {"extra": "forbid"}
@@ -60,43 +289,328 @@ class Difficulty(BaseModel):
     prediction: int
 
 
+class Difficulties(BaseModel):
+    model_config = {"extra": "forbid"}
+
+    predictions: list[int]
+
+
+## Request Models For Model Administration
+class swap_request(BaseModel):
+    model_config = {"extra": "forbid"}
+
+    model_path: str
+
+
+
+
+registry = None  # the ModelRegistry serving /predict, created on startup
+
+# Set by prefork.py in the processes it forks: role "worker" or "trainer", the shared weights, the control queue
+# to the trainer, the shared job states, and in the trainer the startup models the parent already loaded
+prefork = None
 
 
 @asynccontextmanager
 async def lifespan_mechanism(app: FastAPI):
     logging.info("Starting up Lab3 API")
+    configure_interop_threads(TORCH_INTEROP_THREADS)
 
+    if prefork is not None and prefork.role == "worker":
+        async with prefork_worker_lifespan():
+            yield
+        return
 
     # Load the Model on Startup
-    global primary_model
-    global target_model
-    global embedder
+    global registry
     global criterion
 
-    my_model_path = "tst/models/primary_model_Mar_31.pt" 
-    embedder = UserEmbeddingModel(3, 4)
-    primary_model = load_s3_object(my_model_path)
-    target_model = load_s3_object(my_model_path)
-    primary_model.game_embedding = nn.Embedding(5, 1)
-    target_model.game_embedding = nn.Embedding(5, 1)
+    open_model_stores()
+    if checkpointer is not None:
+        checkpointer.start()
+
+    global embedding_caches
+    embedding_caches = weakref.WeakKeyDictionary()  # one cache per embedder, dropped with it
+    registry = ModelRegistry(build_policy)
+    version, primary_model, target_model, embedder = load_startup_models() if prefork is None else prefork.startup
+    registry.publish(version, primary_model, target_model, embedder)
+    if prefork is not None:
+        registry.on_activate = publish_shared_weights  # the parent has published the startup models already
     criterion = nn.MSELoss()  # Use MSELoss for Q-value regression
 
+    await start_inference()
+
 
     global table_name
     global dyn_resource
     global ushx_table
 
     table_name = 'UserStateHxPrd'
-    dyn_resource = boto3.resource('dynamodb', region_name = 'us-east-1')
+    dyn_resource = get_dynamo_resource()
     ushx_table = dyn_resource.Table(table_name)
 
+    global training_worker
+    global training_weights
+    training_weights = DoubleBufferedWeights(make_optimizer=lambda params: optim.Adam(params, lr=0.0035),
+                                             train_embedder=USER_EMBEDDER_TRAINING == "joint")
+    global target_sync
+    target_sync = TargetSync(TARGET_SYNC, every=TARGET_SYNC_EVERY, tau=TARGET_SYNC_TAU)
+
+    global transition_builder
+    # The replay buffer stores raw user features, embedded at every training step by the embedder being trained (or
+    # served, when frozen), so its transitions stay valid when a swap or a checkpoint brings another embedder
+    store_dir = os.path.join(TRANSITION_STORE_DIR, "user-features")
+    replay = ReplayBuffer(os.path.join(store_dir, "replay"), capacity=REPLAY_BUFFER_CAPACITY,
+                          embedding_dim=NUM_USER_FEATURES)
+    if REPLAY_PRIORITY_ALPHA > 0:
+        replay = PrioritizedReplay(replay, alpha=REPLAY_PRIORITY_ALPHA, beta=REPLAY_PRIORITY_BETA)
+    transition_builder = IncrementalTransitionBuilder(os.path.join(store_dir, "ingest"), replay,
+                                                      overlap_sec=RETRAIN_INGEST_OVERLAP_S)
+    training_worker = TrainingWorker(run_retrain, on_change=retrain_changed)
+    training_worker.start()
+
 
     yield
-    # We don't need a shutdown event for our system, but we could put something
-    # here after the yield to deal with things during shutdown
+    await stop_inference()
+    training_worker.stop(timeout=30)
+    if checkpointer is not None:
+        checkpointer.stop(timeout=30)
     logging.info("Shutting down Lab3 API")
 
 
+@asynccontextmanager
+async def prefork_worker_lifespan():
+    """
+    Lifespan of a pre-fork serving worker: it serves the generations the training process publishes to the
+    shared weights instead of loading models itself, and forwards retraining jobs and swaps to that process.
+    """
+    global registry, embedding_caches, training_worker, checkpointer, shared_sequence
+    checkpointer = None
+    shared_sequence = None
+    embedding_caches = weakref.WeakKeyDictionary()
+    registry = ModelRegistry(build_policy)
+    if not attach_shared_weights():
+        raise RuntimeError(f"No model has been published to {prefork.shared_weights.root}")
+    follower = asyncio.create_task(follow_shared_weights())
+    sharer = asyncio.create_task(share_metrics_periodically())
+
+    await start_inference()
+    training_worker = prefork.jobs
+
+    yield
+    follower.cancel()
+    sharer.cancel()
+    await stop_inference()
+    logging.info("Shutting down Lab3 API worker")
+
+
+async def start_inference():
+    global executor, batcher
+    executor = InferenceExecutor(workers=INFERENCE_WORKERS, torch_threads=INFERENCE_TORCH_THREADS)
+    executor.start()
+    batcher = None
+    if PREDICT_MAX_BATCH_SIZE > 1:
+        batcher = MicroBatcher(predict_rows, max_batch_size=PREDICT_MAX_BATCH_SIZE, max_wait_ms=PREDICT_MAX_WAIT_MS,
+                               executor=executor)
+        await batcher.start()
+
+
+async def stop_inference():
+    if batcher is not None:
+        await batcher.stop()
+    executor.stop()
+
+
+def attach_shared_weights():
+    """
+    Serves the newest generation in the shared weights if this worker does not serve it yet. Returns whether
+    there was a new one.
+    """
+    global shared_sequence
+    manifest = prefork.shared_weights.current()
+    if manifest is None or manifest["sequence"] == shared_sequence:
+        return False
+    registry.publish(manifest["version"], *prefork.shared_weights.attach(manifest), generation=manifest["generation"])
+    shared_sequence = manifest["sequence"]
+    return True
+
+
+async def follow_shared_weights():
+    while True:
+        await asyncio.sleep(SHARED_WEIGHTS_POLL_S)
+        try:
+            await asyncio.to_thread(attach_shared_weights)
+        except Exception:
+            logger.exception("Attaching the newest shared weights failed")
+
+
+async def share_metrics_periodically():
+    while True:
+        await asyncio.sleep(METRICS_SHARE_INTERVAL_S)
+        try:
+            await asyncio.to_thread(share_metrics)
+        except Exception:
+            logger.exception("Could not share this worker's metrics")
+
+
+def publish_shared_weights(handle):
+    prefork.shared_weights.publish(handle.version, handle.generation, handle.model, handle.target_model,
+                                   handle.embedder)
+
+
+async def serve_control(stop):
+    """
+    Training process of pre-fork serving: runs the retraining jobs and swaps the workers forward over the
+    control queue until stop (an asyncio.Event) is set. Their results reach the workers through the registry's
+    on_activate.
+    """
+    while not stop.is_set():
+        try:
+            kind, argument = await asyncio.to_thread(prefork.control.get, timeout=0.5)
+        except queue.Empty:
+            continue
+        if kind == "retrain":
+            training_worker.submit(argument)
+        elif kind == "swap" and not start_swap(argument):
+            logger.warning(f"Not swapping to {argument}, a model swap is already in progress")
+
+
+def open_model_stores():
+    # The local model cache and, if enabled, the checkpointer (not started)
+    global model_cache, checkpointer
+    model_cache = ModelCache(MODEL_CACHE_DIR, client=get_s3_client())
+    checkpointer = None
+    if CHECKPOINT_PREFIX:
+        checkpointer = Checkpointer(get_s3_client(), CHECKPOINT_PREFIX, min_interval_s=CHECKPOINT_MIN_INTERVAL_S,
+                                    keep=CHECKPOINT_KEEP)
+
+
+def load_startup_models():
+    """
+    (version, primary model, target model, embedder) the service starts from: MODEL_PATH and its embedder,
+    resumed from their newest checkpoint if there is one. Needs open_model_stores().
+    """
+    embedder = load_serving_embedder(USER_EMBEDDER_PATH)
+    return (MODEL_PATH, *resume_serving_models(MODEL_PATH, embedder), embedder)
+
+
+def load_serving_models(model_path):
+    """
+    Loads the primary and target Q-networks for model_path (through the local model cache).
+    Checkpoints whose game embedding does not cover every game type get a fresh one.
+    """
+    primary_model = load_s3_object(model_path, cache=model_cache)
+    target_model = copy.deepcopy(primary_model)
+    if primary_model.game_embedding.num_embeddings < NUM_GAME_TYPES:
+        primary_model.game_embedding = nn.Embedding(NUM_GAME_TYPES, 1)
+        target_model.game_embedding = nn.Embedding(NUM_GAME_TYPES, 1)
+    return primary_model, target_model
+
+
+def load_serving_embedder(path, fallback=None):
+    """
+    Loads the user embedder artifact at path (through the local model cache), frozen for serving. If there is
+    none, serves fallback, or without one a seeded embedder that is the same in every worker and restart. The
+    seeded embedder is then stored at path, so the model keeps the embeddings it was first served with even if
+    a later torch or UserEmbeddingModel initialises them differently.
+    """
+    embedder, loaded = load_user_embedder(path, cache=model_cache, seed=USER_EMBEDDER_SEED)
+    if not loaded:
+        if fallback is not None:
+            return fallback
+        logger.warning(f"No user embedder at {path}, storing the one seeded with {USER_EMBEDDER_SEED} there")
+        try:
+            save_user_embedder(embedder, path)
+        except (BotoCoreError, ClientError, S3UploadFailedError) as err:
+            logger.warning(f"Could not store the user embedder at {path} ({err}), serving it all the same")
+    return embedder.eval().requires_grad_(False)
+
+
+def resume_serving_models(model_path, embedder):
+    """
+    load_serving_models, with the weights of the newest checkpoint retrained from model_path if there is one.
+    The embedder is restored too, so resumed weights see the same user embeddings they were trained on.
+    """
+    primary_model, target_model = load_serving_models(model_path)
+    if checkpointer is None:
+        return primary_model, target_model
+    try:
+        checkpoint = checkpointer.latest(model_path)
+    except (BotoCoreError, ClientError) as err:
+        logger.warning(f"Could not look up checkpoints of {model_path} ({err}), starting from the model itself")
+        return primary_model, target_model
+    if checkpoint is not None:
+        primary_model.load_state_dict(checkpoint["model"])
+        target_model.load_state_dict(checkpoint["target_model"])
+        embedder.load_state_dict(checkpoint["embedder"])
+        logger.info(f"Resumed {model_path} from {checkpoint['key']} (generation {checkpoint['generation']})")
+    return primary_model, target_model
+
+
+def build_policy(model, embedder):
+    """
+    Builds the INFERENCE_BACKEND policy predict_rows serves from, falling back to eager mode if that fails.
+    Both the compiled graph and the numpy bundle hold a copy of the weights, so the policy has to be
+    rebuilt (by publishing to the registry) whenever the model or embedder weights change.
+
+    With the user embedding cache enabled the backend runs the Q-network only, on embeddings from the cache of
+    the embedder, which every handle built on that embedder shares. The prediction cache in front of it is new
+    for every policy, so predictions of an older generation are never served. Both count into the cache_* metrics.
+    """
+    if USER_EMBEDDING_CACHE_SIZE <= 0:
+        policy = build_backend(model, embedder)
+    else:
+        cache = embedding_caches.get(embedder)
+        if cache is None:
+            cache = embedding_caches[embedder] = EmbeddingCache(embedder, max_entries=USER_EMBEDDING_CACHE_SIZE,
+                                                                ttl_s=USER_EMBEDDING_CACHE_TTL_S,
+                                                                decimals=USER_EMBEDDING_CACHE_DECIMALS,
+                                                                on_count=count_cache("embedding"))
+        policy = EmbeddingCachedPolicy(build_backend(model, None), cache,
+                                       on_lookup=lambda seconds: predict_stage_seconds.observe(seconds, "embedding"))
+    if PREDICTION_CACHE_SIZE > 0:
+        policy = PredictionCachedPolicy(policy, PredictionCache(PREDICTION_CACHE_SIZE,
+                                                                on_count=count_cache("prediction")))
+    return policy
+
+
+def count_cache(name):
+    # on_count of a serving cache: its hits, misses, evictions and invalidations add up across the caches of every
+    # published generation
+    counters = {"hits": cache_hits, "misses": cache_misses, "evictions": cache_evictions,
+                "invalidations": cache_invalidations}
+    return lambda event, amount: counters[event].inc(name, amount=amount)
+
+
+def build_backend(model, embedder):
+    # embedder None builds the policy on user embeddings instead of user features
+    try:
+        if INFERENCE_BACKEND == "compiled":
+            return TorchPolicy(compile_policy(model, embedder))
+        if INFERENCE_BACKEND == "numpy":
+            return NumpyPolicy(export_weight_bundle(model.state_dict(), {} if embedder is None else embedder.state_dict()),
+                               embedded=embedder is None)
+    except Exception:
+        logger.warning(f"Could not build the {INFERENCE_BACKEND} backend, serving in eager mode", exc_info=True)
+    return TorchPolicy(FusedPolicy(model, embedder))
+
+
+def predict_rows(states, user_features, game_types, user_ids=None):
+    """
+    Runs the active model on a batch of numpy rows and returns the predicted difficulty for each.
+    user_ids (one id or None per row) key the user embedding cache, other policies ignore them.
+    The call is timed as the "forward" stage.
+    """
+    policy = registry.active.policy
+    start = time.perf_counter()
+    if user_ids is not None and getattr(policy, "takes_user_ids", False):
+        actions = policy(states, user_features, game_types, user_ids)
+    else:
+        actions = policy(states, user_features, game_types)
+    predict_stage_seconds.observe(time.perf_counter() - start, "forward")
+    return actions
+
+
 sub_application_pickl_test = FastAPI(lifespan=lifespan_mechanism)
 
 @sub_application_pickl_test.get("/health")
@@ -118,21 +632,41 @@ async def get_prediction(predict_states: state_vars):
     It returns a JSON object made up of 1 parameter:
         prediction: int - The predicted difficulty from the model
 
+    Concurrent calls are grouped by the micro-batcher into a single forward pass when it is enabled.
+    The forward pass runs on the inference executor, not on the event loop.
+    """
+    if batcher is not None:
+        predictValue = await batcher.submit(predict_states.states, predict_states.user_features, predict_states.game_type,
+                                            predict_states.user_id)
+    else:
+        predictValue = int((await executor.run(predict_rows, np.array([predict_states.states], dtype=np.float32),
+                                               np.array([predict_states.user_features], dtype=np.float32),
+                                               np.array([predict_states.game_type], dtype=np.int64),
+                                               None if predict_states.user_id is None else [predict_states.user_id]))[0])
+
+    return serialize(Difficulty, prediction=predictValue)
+
+@sub_application_pickl_test.post("/predict_batch", response_model=Difficulties)
+async def get_batch_prediction(predict_states: batch_state_vars):
     """
-    state = torch.tensor([predict_states.states])
-    user_features = torch.tensor([predict_states.user_features]) 
-    user_embedding = embedder(user_features)
-    game_type = torch.tensor([predict_states.game_type])  
+    This is a method that predicts the difficulty of the next question for many users at once
 
+    It takes in parallel arrays of states, user_features and game_type (or one packed float32 buffer of rows).
+    It returns a JSON object made up of 1 parameter:
+        predictions: list[int] - The predicted difficulty for each row, in request order
 
-    # Make a prediction
-    with torch.no_grad():  # Disables gradient computation for inference
-        q_values = primary_model(state, user_embedding, game_type)
+    """
+    states, user_features, game_types = predict_states.arrays
+    actions = await executor.run(predict_rows, states, user_features, game_types, predict_states.user_ids)
+    return serialize(Difficulties, predictions=actions.tolist())
 
-    predictValue = torch.Tensor.argmax(q_values).item()
 
-    returnVal = Difficulty(prediction=predictValue)
-    return returnVal
+def serialize(response_model, **fields):
+    # The JSON response, built here rather than by FastAPI so the "serialization" stage can be timed
+    start = time.perf_counter()
+    body = Response(response_model(**fields).model_dump_json(), media_type="application/json")
+    predict_stage_seconds.observe(time.perf_counter() - start, "serialization")
+    return body
 
 @sub_application_pickl_test.get("/printWeights")
 async def get_weights():
@@ -140,59 +674,170 @@ async def get_weights():
     This method prints the current weights of the model
 
     """
-    return {"weights": primary_model.print_model_weights()}
+    return {"weights": registry.active.model.print_model_weights()}
 
 
-@sub_application_pickl_test.get("/retrain")
-async def retrain():
-    """
-    This method retrains the model
+def require_admin_token(authorization: str | None = Header(default=None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN to enable them")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
 
-    """
-    numInRetrainBatch = 10
-    
-    unix_current = int(time.time())
-    unix_1_week_prev = unix_current - (7 * 24 * 60 * 60)
-    current_data = query_gsi(ushx_table, gsi_index='state', unix_sec_str=str(unix_1_week_prev), limit=-1)
-    current_data = pd.DataFrame(current_data)
-    current_data = processIntoDataframe(current_data, embedder)
-    current_data = current_data.sample(numInRetrainBatch)
-    dataset, dataloader = create_dataloader(current_data['states'].to_list(), current_data['action'].to_list(), current_data['reward'].to_list(), 
-                                            current_data['user'].to_list(), current_data['game_type'].to_list(), 
-                                            current_data['next_states'].to_list(), current_data['next_user'].to_list(), 
-                                            current_data['next_game_type'].to_list(), 
-                                            batch_size=numInRetrainBatch)
-    optimizer = optim.Adam(primary_model.parameters(), lr=0.0035)
-    train(primary_model, target_model, dataloader, optimizer, criterion, batch_size=10, gamma=0.99)
-    return {"Retraining": "Done"}
 
+@sub_application_pickl_test.post("/admin/swap", status_code=202, dependencies=[Depends(require_admin_token)])
+async def swap_model(request: swap_request):
+    """
+    This method starts loading the model at model_path in the background and switches /predict over to it once it
+    is warmed up. Requests already running finish on the current version. It needs the ADMIN_TOKEN as bearer token.
 
+    """
+    if prefork is not None and prefork.role == "worker":
+        # The training process swaps, and the workers follow once it has published the new version
+        prefork.control.put(("swap", request.model_path))
+        return {"state": "forwarded", "version": request.model_path}
+    if not start_swap(request.model_path):
+        raise HTTPException(status_code=409, detail="A model swap is already in progress")
+    return registry.swap_status
 
 
+def start_swap(model_path):
+    def loader():
+        primary_model, target_model = load_serving_models(model_path)
+        # The new version's own embedder if it has one, so its Q-network sees the embeddings it was trained on
+        embedder = load_serving_embedder(embedder_path(model_path), fallback=registry.active.embedder)
+        return primary_model, target_model, embedder
 
+    return registry.start_swap(model_path, loader)
 
 
+@sub_application_pickl_test.get("/admin/model")
+async def model_status():
+    """
+    This method reports the model version being served and the state of the latest swap
 
+    """
+    active = registry.active
+    return {"version": active.version, "generation": active.generation,
+            "loaded_at": datetime.fromtimestamp(active.loaded_at).isoformat(), "swap": registry.swap_status}
 
 
+def run_retrain(job):
+    """
+    One retraining job, run on the training worker thread. Trains the shadow copy of the active model and
+    publishes a frozen snapshot of it as a new generation, so /predict only ever sees fully trained weights.
+    Its query, decode, features, train (all RETRAIN_STEPS steps) and publish stages are timed.
+    """
+    active = registry.active
+    model = training_weights.shadow_for(active)
+    joint = training_weights.train_embedder
+
+    new_transitions = transition_builder.update(ushx_table, None,
+                                                num_workers=RETRAIN_QUERY_WORKERS,
+                                                on_stage=lambda stage, seconds: retrain_stage_seconds.observe(seconds, stage))
+    replay = transition_builder.store
+    prioritized = isinstance(replay, PrioritizedReplay)
+    if not prioritized:
+        # Shuffled passes over the buffer's stored rows, batched straight from its memory-mapped columns
+        batches = TransitionBatches(replay.columns, RETRAIN_BATCH_SIZE,
+                                    indices=replay.positions(np.arange(len(replay)))).cycle()
+
+    def sample_batch():
+        if prioritized:
+            sample, positions, weights = replay.sample(RETRAIN_BATCH_SIZE)
+            return transition_tensors(sample), weights, positions
+        return next(batches), None, None
+
+    def update_priorities(positions, td_errors):
+        replay.update_priorities(positions, td_errors.numpy())
+
+    start = time.perf_counter()
+    loss = train_steps(model, training_weights.target, sample_batch, training_weights.optimizer, criterion,
+                       steps=RETRAIN_STEPS, gamma=0.99, on_td_errors=update_priorities if prioritized else None,
+                       target_sync=target_sync, embedder=training_weights.embedder)
+    trained = time.perf_counter()
+    retrain_stage_seconds.observe(trained - start, "train")
+
+    embedder = training_weights.snapshot(training_weights.embedder) if joint else active.embedder
+    published = registry.publish(active.version, training_weights.snapshot(),
+                                 training_weights.snapshot(training_weights.target), embedder, replaces=active)
+    if published is not None:
+        training_weights.published(published)
+        if checkpointer is not None:
+            checkpointer.submit(published)
+    retrain_stage_seconds.observe(time.perf_counter() - trained, "publish")
+    return {"loss": loss, "steps": RETRAIN_STEPS, "target_syncs": target_sync.syncs, "transitions": len(replay),
+            "new_transitions": new_transitions, "published": published is not None, "generation": published.generation if published else active.generation}
 
 
+@sub_application_pickl_test.get("/retrain")
+async def retrain():
+    """
+    This method queues a retraining of the model and returns straight away. If a retraining is already queued
+    it is returned instead, as it will ingest the same new events
 
+    It returns a JSON object with the job id, the progress can be followed on /retrain/{job_id}
+    """
+    job = training_worker.submit()
+    return {"Retraining": "Queued", "job_id": job.id}
 
 
+@sub_application_pickl_test.get("/retrain/{job_id}")
+async def retrain_status(job_id: str):
+    """
+    This method reports the status (queued, running, done or failed) and metrics of a retraining job
 
+    """
+    job = training_worker.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown retraining job")
+    return job.to_dict()
 
 
+def retrain_changed(job):
+    # on_change of the training worker: counts finished jobs and, in the pre-fork training process, shares the
+    # job's state and the training metrics with the serving workers
+    if job.status in ("done", "failed"):
+        retrains.inc(job.status)
+    if prefork is not None:
+        prefork.jobs.write(job)
+        if job.status in ("done", "failed"):
+            share_metrics()
 
 
+@sub_application_pickl_test.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    This method reports the service's metrics in the Prometheus text format: requests and errors by route, request
+    and /predict and /retrain stage latency histograms, serving cache hits, misses and evictions, the model version
+    and generation served and the number of retraining jobs. A pre-fork worker reports the metrics of all the workers and the training process.
 
+    """
+    if prefork is None:
+        text = render(collect_metrics())
+    else:
+        text = await asyncio.to_thread(lambda: render(*read_shared_metrics()))
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
+def collect_metrics():
+    return {**serving_metrics.snapshot(), **training_metrics.snapshot()}
 
 
+def served_model():
+    # {(version,): generation} of the active model, for the model generation gauge
+    active = registry.active if registry is not None else None
+    return {} if active is None else {(active.version,): active.generation}
 
 
+def share_metrics():
+    write_snapshot(os.path.join(prefork.metrics_dir, f"{os.getpid()}.json"), collect_metrics())
 
 
+def read_shared_metrics():
+    share_metrics()  # this process's own metrics up to date
+    return read_snapshots(prefork.metrics_dir)
 
 
+sub_application_pickl_test.add_middleware(MetricsMiddleware, requests=http_requests, errors=http_errors,
+                                          duration=http_duration)
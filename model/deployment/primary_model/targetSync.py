@@ -0,0 +1,54 @@
+import torch
+
+
+class TargetSync:
+    """
+    Keeps the target network following the trained one, called once per gradient step.
+
+    mode "hard" copies the trained weights into the target every `every` updates, "polyak" moves the target
+    towards them by tau on every update (target = target + tau * (model - target)), "none" leaves it frozen.
+    Both update the target's existing tensors in place with multi-tensor copy_ / lerp_, so a sync allocates
+    nothing. Parameters and buffers are matched by position, the two networks must have the same architecture.
+    """
+
+    MODES = ("none", "hard", "polyak")
+
+    def __init__(self, mode="hard", every=100, tau=0.005):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown target sync mode {mode!r}, expected one of {', '.join(self.MODES)}")
+        self.mode = mode
+        self.every = every
+        self.tau = tau
+        self.updates = 0
+        self.syncs = 0
+        self._pair = None
+        self._lists = None
+
+    def step(self, model, target_model):
+        self.updates += 1
+        if self.mode == "hard" and self.updates % self.every == 0:
+            self.hard(model, target_model)
+        elif self.mode == "polyak":
+            self.polyak(model, target_model)
+
+    def _tensors(self, model, target_model):
+        # (target params, params, target buffers, buffers), collected once per pair of networks
+        if self._pair is None or self._pair[0] is not model or self._pair[1] is not target_model:
+            self._pair = (model, target_model)
+            self._lists = (list(target_model.parameters()), list(model.parameters()),
+                           list(target_model.buffers()), list(model.buffers()))
+        return self._lists
+
+    @torch.no_grad()
+    def hard(self, model, target_model):
+        target_params, params, target_buffers, buffers = self._tensors(model, target_model)
+        torch._foreach_copy_(target_params + target_buffers, params + buffers)
+        self.syncs += 1
+
+    @torch.no_grad()
+    def polyak(self, model, target_model):
+        target_params, params, target_buffers, buffers = self._tensors(model, target_model)
+        torch._foreach_lerp_(target_params, params, self.tau)  # lerp_ on every parameter in one call
+        if buffers:
+            torch._foreach_copy_(target_buffers, buffers)  # running statistics and the like are not averaged
+        self.syncs += 1
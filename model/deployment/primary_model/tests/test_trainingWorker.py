@@ -0,0 +1,123 @@
+import queue
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from trainingWorker import SharedJobs, TrainingWorker
+
+
+class BlockingJob:
+    """run_job that holds every job until released, recording the job each run was given."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.runs = []
+
+    def __call__(self, job):
+        self.runs.append(job.id)
+        self.started.set()
+        assert self.release.wait(10)
+        return {"new_transitions": len(self.runs)}
+
+
+@pytest.fixture
+def blocking():
+    run_job = BlockingJob()
+    worker = TrainingWorker(run_job, max_history=2)
+    worker.start()
+    yield worker, run_job
+    run_job.release.set()
+    worker.stop(timeout=10)
+
+
+def wait_finished(*jobs):
+    for _ in range(1000):
+        if all(job.status in ("done", "failed") for job in jobs):
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError(f"jobs did not finish: {[job.status for job in jobs]}")
+
+
+def test_submit_coalesces_with_the_queued_job(blocking):
+    worker, run_job = blocking
+    running = worker.submit()
+    assert run_job.started.wait(10)
+
+    queued = worker.submit()
+    assert worker.submit() is queued
+    assert worker.submit() is queued
+    assert queued.status == "queued"
+
+    run_job.release.set()
+    wait_finished(running, queued)
+    assert run_job.runs == [running.id, queued.id]  # two runs for four submissions
+    assert queued.status == "done"
+
+
+def test_forwarded_job_ids_share_the_queued_run(blocking):
+    worker, run_job = blocking
+    worker.submit()
+    assert run_job.started.wait(10)
+
+    first, second = worker.submit("1-100-1"), worker.submit("1-200-1")
+    assert first is not second
+    assert worker.get("1-200-1") is second
+
+    run_job.release.set()
+    wait_finished(first, second)
+    assert len(run_job.runs) == 2
+    assert first.metrics == second.metrics and first.finished_at == second.finished_at
+
+
+def test_only_finished_jobs_are_evicted(blocking):
+    worker, run_job = blocking
+    running = worker.submit()
+    assert run_job.started.wait(10)
+    forwarded = [worker.submit(f"1-{n}-1") for n in range(5)]
+
+    # Over max_history, but nothing has finished yet
+    assert all(worker.get(job.id) is job for job in [running, *forwarded])
+
+    run_job.release.set()
+    wait_finished(running, *forwarded)
+    assert len(worker.jobs) == 2
+    assert worker.get(running.id) is None
+
+
+def test_shared_jobs_keep_unfinished_job_files(tmp_path):
+    jobs = SharedJobs(str(tmp_path), queue.Queue(), max_history=1)
+    first, second = jobs.submit(), jobs.submit()
+    assert jobs.get(first.id).status == "queued"
+
+    first.status = "done"
+    jobs.write(first)
+    assert jobs.get(first.id) is None
+    assert jobs.get(second.id).status == "queued"
+
+
+@pytest.fixture
+def api(monkeypatch, blocking):
+    import src.pickl_fastapi as api
+
+    worker, _ = blocking
+    monkeypatch.setattr(api, "training_worker", worker, raising=False)  # set by the lifespan
+    return api
+
+
+def test_retrain_status_of_a_queued_job(api, blocking):
+    worker, run_job = blocking
+    client = TestClient(api.sub_application_pickl_test)  # without its lifespan, the worker is the fixture's
+
+    running = client.get("/retrain").json()["job_id"]
+    assert run_job.started.wait(10)
+    queued = client.get("/retrain").json()["job_id"]
+    # More requests than max_history join the queued job instead of evicting it
+    assert {client.get("/retrain").json()["job_id"] for _ in range(5)} == {queued}
+
+    response = client.get(f"/retrain/{queued}")
+    assert response.status_code == 200
+    assert response.json()["status"] == "queued"
+    assert client.get(f"/retrain/{running}").json()["status"] == "running"
+    assert client.get("/retrain/unknown").status_code == 404
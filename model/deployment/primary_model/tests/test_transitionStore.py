@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+from localStores import LocalDynamoTable, synthetic_state_items
+from replayBuffer import ReplayBuffer
+from transitionStore import IncrementalTransitionBuilder
+
+
+def event(item, pk, sk):
+    return dict(item, user_state_pk=pk, sk=str(sk))
+
+
+@pytest.fixture
+def builder(tmp_path):
+    replay = ReplayBuffer(str(tmp_path / "replay"), capacity=100, embedding_dim=3)
+    return IncrementalTransitionBuilder(str(tmp_path / "ingest"), replay)
+
+
+def test_update_picks_up_events_written_within_the_watermark_second(builder):
+    now = int(time.time())
+    item = synthetic_state_items(1)[0]
+    table = LocalDynamoTable([event(item, "MATH#user-a", now - 20), event(item, "MATH#user-a", now - 10),
+                              event(item, "MATH#user-b", now - 15)])
+    assert builder.update(table, None) == 1
+    assert builder.watermark == str(now - 10)
+
+    # user-b's next event lands in the same second as the watermark, after the last update
+    table.put_items([event(item, "MATH#user-b", now - 10)])
+    assert builder.update(table, None) == 1
+    assert len(builder.store) == 2
+    assert builder.last["MATH#user-b"]["sk"] == str(now - 10)
+
+    # Re-reading the overlap adds nothing twice
+    assert builder.update(table, None) == 0
+    assert len(builder.store) == 2
+
+
+def test_update_skips_events_older_than_the_users_last_one(builder):
+    now = int(time.time())
+    item = synthetic_state_items(1)[0]
+    table = LocalDynamoTable([event(item, "MATH#user-a", now - 20), event(item, "MATH#user-a", now - 10)])
+    assert builder.update(table, None) == 1
+
+    # Shows up on the GSI only after a newer event of the same user was ingested
+    table.put_items([event(item, "MATH#user-a", now - 15), event(item, "MATH#user-a", now - 5)])
+    assert builder.update(table, None) == 1
+    assert builder.last["MATH#user-a"]["sk"] == str(now - 5)
+    assert builder.watermark == str(now - 5)
@@ -0,0 +1,170 @@
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TrainingJob:
+    id: str
+    status: str = "queued"  # queued, running, done or failed
+    submitted_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    metrics: dict = field(default_factory=dict)
+    error: str | None = None
+
+    def to_dict(self):
+        return asdict(self)
+
+
+class TrainingWorker:
+    """
+    Runs retraining jobs one at a time on a dedicated thread, off the request event loop.
+
+    run_job(job) does the work and returns a dict of metrics. A job submitted while another one is still queued
+    is coalesced with it: that job will ingest everything written before it starts, so a second run would find
+    nothing new. submit() then returns the queued job, or, for a job id given by another process, a job that
+    shares the queued job's run and results. Only the latest max_history finished jobs are kept for status
+    lookups, jobs that have not finished are always kept. on_change(job), if given, is called whenever a job
+    is queued, starts or finishes.
+    """
+
+    def __init__(self, run_job, max_history=100, on_change=None):
+        self.run_job = run_job
+        self.max_history = max_history
+        self.on_change = on_change
+        self.jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._pending = []  # jobs of the queued run, the first one is passed to run_job
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="training-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, job_id=None):
+        # job_id is only given for jobs submitted through another process (see SharedJobs)
+        with self._lock:
+            if self._pending and job_id is None:
+                return self._pending[0]
+            job = TrainingJob(id=job_id or f"{int(time.time())}-{next(self._ids)}")
+            self.jobs[job.id] = job
+            self._evict()
+            self._pending.append(job)
+            queue_run = len(self._pending) == 1
+        self._changed(job)
+        if queue_run:
+            self._queue.put(True)
+        return job
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in ("done", "failed")]
+        for job_id in finished[:len(self.jobs) - self.max_history]:
+            del self.jobs[job_id]
+
+    def _changed(self, job):
+        if self.on_change is not None:
+            try:
+                self.on_change(job)
+            except Exception:
+                logger.exception(f"Reporting the state of retraining job {job.id} failed")
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _loop(self):
+        while self._queue.get() is not None:
+            with self._lock:
+                jobs, self._pending = self._pending, []
+            started_at = time.time()
+            for job in jobs:
+                job.status = "running"
+                job.started_at = started_at
+                self._changed(job)
+            status, metrics, error = "done", {}, None
+            try:
+                metrics = self.run_job(jobs[0]) or {}
+            except Exception as err:
+                logger.exception(f"Retraining job {jobs[0].id} failed")
+                status, error = "failed", str(err)
+            finished_at = time.time()
+            for job in jobs:
+                job.metrics = metrics
+                job.error = error
+                job.finished_at = finished_at
+                job.status = status
+                self._changed(job)
+            with self._lock:
+                self._evict()
+
+
+class SharedJobs:
+    """
+    TrainingWorker stand-in for a process that does not train itself, such as a pre-fork serving worker.
+
+    submit() forwards the job over `control` (a multiprocessing queue) to the training process, which runs it
+    on its own TrainingWorker with write() as on_change. Job states are kept as one JSON file per job under
+    root, so any process can look them up with get().
+    """
+
+    _VALID_ID = re.compile(r"[\w-]+")
+
+    def __init__(self, root, control, max_history=100):
+        self.root = root
+        self.control = control
+        self.max_history = max_history
+        self._ids = itertools.count(1)
+        os.makedirs(root, exist_ok=True)
+
+    def submit(self):
+        job = TrainingJob(id=f"{int(time.time())}-{os.getpid()}-{next(self._ids)}")
+        self.write(job)
+        self.control.put(("retrain", job.id))
+        return job
+
+    def get(self, job_id):
+        if not self._VALID_ID.fullmatch(job_id):
+            return None
+        try:
+            with open(os.path.join(self.root, f"{job_id}.json")) as f:
+                return TrainingJob(**json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def write(self, job):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".job-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp_path, os.path.join(self.root, f"{job.id}.json"))
+        self.collect_garbage()
+
+    def collect_garbage(self):
+        # Job ids start with their submission time, so the oldest sort first. Jobs that have not finished are kept
+        files = sorted(f for f in os.listdir(self.root) if f.endswith(".json"))
+        for file_name in files[:-self.max_history]:
+            job = self.get(file_name[:-len(".json")])
+            if job is None or job.status not in ("done", "failed"):
+                continue
+            try:
+                os.remove(os.path.join(self.root, file_name))
+            except FileNotFoundError:  # another process got there first
+                pass
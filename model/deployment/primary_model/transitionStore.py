@@ -0,0 +1,110 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+from dynamoFunctions import STATE_COLUMNS, buildTransitions, decode_items_columnar, query_gsi_items
+
+logger = logging.getLogger(__name__)
+
+
+def _save_npz(path, arrays):
+    # Write next to path and rename, so readers never see a partial file
+    with open(path + '.part', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + '.part', path)
+
+
+class IncrementalTransitionBuilder:
+    """
+    Rolling ingestion of state items into a transition store (a ReplayBuffer), in O(new events) per update.
+
+    Keeps the decoded STATE_COLUMNS of each user_state_pk's last seen event and a watermark, the newest sk ingested
+    so far, both persisted under state_dir. update() queries items with sk > watermark - overlap_sec, so events
+    written later within the watermark's second, or showing up late on the eventually consistent GSI, are still
+    picked up. Of those, only each user's events newer than their stored last event are new: the oldest of them
+    is paired with the stored event (and the rest among themselves, exactly like buildTransitions), and just those
+    transitions are appended to the store. An event older than its user's stored last one arrived too late to be
+    paired in order and is skipped.
+    """
+
+    def __init__(self, state_dir, store, lookback_sec=7 * 24 * 60 * 60, overlap_sec=60):
+        self.state_dir = state_dir
+        self.store = store
+        self.lookback_sec = lookback_sec
+        self.overlap_sec = overlap_sec
+        self.path = os.path.join(state_dir, 'last_state.npz')
+        self.last = {}  # user_state_pk -> {column: value} of their newest ingested event
+        self.watermark = None
+        os.makedirs(state_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            with np.load(self.path, allow_pickle=True) as saved:
+                self.watermark = str(saved['watermark'])
+                columns = {name: saved[name] for name in STATE_COLUMNS}
+            for n, pk in enumerate(columns['user_state_pk']):
+                self.last[pk] = {name: values[n] for name, values in columns.items()}
+        store.discard_after(self.watermark)
+
+    def update(self, table, embedder, gsi_index='state', num_workers=1, on_stage=None):
+        """
+        Pulls the items newer than overlap_sec before the watermark (or the last lookback_sec on a first run) and
+        ingests the new ones.
+        Returns the number of new transitions. on_stage(stage, seconds), if given, is told how long the "query",
+        "decode" and "features" (transition building and storing) stages took.
+        """
+        if self.watermark is None:
+            since = str(int(time.time()) - self.lookback_sec)
+        else:
+            since = str(int(self.watermark) - self.overlap_sec)
+        start = time.perf_counter()
+        items = query_gsi_items(table, gsi_index, since, limit=-1, num_workers=num_workers)
+        queried = time.perf_counter()
+        columns = decode_items_columnar(items)
+        decoded = time.perf_counter()
+        new_transitions = self.ingest(columns, embedder)
+        if on_stage is not None:
+            on_stage("query", queried - start)
+            on_stage("decode", decoded - queried)
+            on_stage("features", time.perf_counter() - decoded)
+        return new_transitions
+
+    def ingest(self, columns, embedder):
+        """
+        Ingests decoded columns (see decode_items_columnar), most recent first as query_gsi returns them. Events
+        no newer than their user's last ingested one are dropped.
+        """
+        if not columns or not len(columns['sk']):
+            return 0
+        sks = columns['sk'].astype(np.int64)
+        last_sks = np.fromiter((int(self.last[pk]['sk']) if pk in self.last else -1
+                                for pk in columns['user_state_pk'].astype(str)), dtype=np.int64, count=len(sks))
+        new = sks > last_sks
+        if not new.any():
+            return 0
+        if not new.all():
+            columns = {name: values[new] for name, values in columns.items()}
+        pks = columns['user_state_pk']
+        newest_pks, newest = np.unique(pks.astype(str), return_index=True)
+
+        # Each known user's last event goes after the batch, i.e. as their oldest event in it
+        known = [pk for pk in newest_pks if pk in self.last]
+        combined = {name: np.concatenate([columns[name],
+                                          np.array([self.last[pk][name] for pk in known], dtype=columns[name].dtype)])
+                    for name in STATE_COLUMNS}
+        transitions = buildTransitions(combined, embedder)
+        transitions['sk'] = combined['sk'][transitions['row']].astype(np.int64)
+
+        watermark = str(max(columns['sk'].astype(np.int64).max(), int(self.watermark or 0)))
+        if len(transitions['row']):
+            self.store.append(transitions, watermark)
+        for pk, n in zip(newest_pks, newest):
+            self.last[pk] = {name: columns[name][n] for name in STATE_COLUMNS}
+        self.watermark = watermark
+        self._save()
+        return len(transitions['row'])
+
+    def _save(self):
+        pks = list(self.last)
+        columns = {name: np.array([self.last[pk][name] for pk in pks]) for name in STATE_COLUMNS}
+        _save_npz(self.path, {'watermark': np.array(self.watermark), **columns})
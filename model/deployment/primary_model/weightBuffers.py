@@ -0,0 +1,58 @@
+import copy
+
+
+class DoubleBufferedWeights:
+    """
+    Training side of the training/serving handoff.
+
+    Training only ever updates `shadow`, a private trainable copy of the served model that lives across retrains.
+    snapshot() copies the shadow into a frozen module that is handed to the registry, where publishing is a
+    single reference swap. Snapshots are never written to again, so serving always reads fully published weights.
+
+    The shadow follows a registry handle: if the active handle is no longer the one the shadow was synced with
+    or last published (e.g. after a hot swap), the shadow is re-copied from it.
+
+    With make_optimizer(parameters), the shadow also owns an optimizer that lives as long as it does, so
+    optimizer state such as Adam's moment estimates carries over from one retrain to the next. `target` is the
+    training copy of the handle's target network, kept up to date by a TargetSync and published alongside.
+
+    With train_embedder, `embedder` is a trainable copy of the handle's user embedder, optimized together with
+    the shadow and published as a snapshot of its own; otherwise it is the handle's embedder itself.
+    """
+
+    def __init__(self, make_optimizer=None, train_embedder=False):
+        self.make_optimizer = make_optimizer
+        self.train_embedder = train_embedder
+        self.shadow = None
+        self.embedder = None
+        self.optimizer = None
+        self.target = None
+        self.source = None
+
+    def shadow_for(self, handle):
+        if self.source is not handle:
+            self.shadow = copy.deepcopy(handle.model)
+            parameters = list(self.shadow.parameters())
+            if self.train_embedder:
+                self.embedder = copy.deepcopy(handle.embedder)
+                parameters += list(self.embedder.parameters())
+            else:
+                self.embedder = handle.embedder
+            for param in parameters:
+                param.requires_grad_(True)
+            if self.make_optimizer is not None:
+                self.optimizer = self.make_optimizer(parameters)
+            self.target = copy.deepcopy(handle.target_model).eval()
+            self.source = handle
+        return self.shadow
+
+    def snapshot(self, module=None):
+        # Frozen copy of the shadow (or of module, e.g. the training target)
+        snapshot = copy.deepcopy(self.shadow if module is None else module).eval()
+        for param in snapshot.parameters():
+            param.requires_grad_(False)
+        return snapshot
+
+    def published(self, handle):
+        # The shadow now matches this handle, keep training from it
+        self.source = handle